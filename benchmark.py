@@ -0,0 +1,292 @@
+import itertools
+import json
+import os
+import platform
+import time
+from functools import partial
+
+import numpy as np
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+import distributions
+import model as scm
+import utils
+from training import compile_sc_model, make_style_metrics
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('bench_suites', ['distributions', 'feat_model', 'train_step'], 'benchmark suites to run')
+flags.DEFINE_list('bench_batch', ['1'], 'batch sizes for the distribution functions')
+flags.DEFINE_list('bench_locs', ['1024', '16384', '65536'], 'number of locations for the distribution functions')
+flags.DEFINE_list('bench_channels', ['64', '256', '512'], 'number of channels for the distribution functions')
+flags.DEFINE_float('bench_sort_noise', 1e-3, 'noise added to the features between the calls of the changing '
+                                             'incremental sort benchmarks')
+flags.DEFINE_list('bench_feat_models', ['vgg19', 'fast'], 'feature models to benchmark')
+flags.DEFINE_list('bench_imsizes', ['128', '256', '512'], 'image sizes for the feature model benchmarks')
+flags.DEFINE_integer('bench_train_imsize', 128, 'image size for the train step benchmarks')
+flags.DEFINE_integer('bench_sample_size', None, 'feature sample size for the train step benchmarks')
+flags.DEFINE_bool('bench_metrics', True, 'measure metrics in the train step benchmarks')
+flags.DEFINE_list('bench_policies', ['float32', 'mixed_bfloat16'], 'precision policies to compare')
+flags.DEFINE_integer('bench_quality_steps', 200, 'training steps before measuring the quality of each policy')
+flags.DEFINE_integer('bench_warmup', 2, 'untimed calls before measuring')
+flags.DEFINE_integer('bench_iters', 10, 'timed calls per benchmark')
+flags.DEFINE_bool('bench_offline', False, 'only use the fast feature model on the CPU. '
+                                          'nothing is downloaded in this mode')
+flags.DEFINE_string('bench_out', 'out/bench.json', 'where to write the benchmark results')
+flags.DEFINE_string('bench_baseline', None, 'benchmark results to compare against (optional)')
+flags.DEFINE_float('bench_tolerance', 0.1, 'relative slowdown that counts as a regression')
+flags.DEFINE_bool('bench_fail_on_regression', False, 'exit with an error if any benchmark regressed')
+
+LOSS_FNS = [distributions.compute_wass_dist, distributions.compute_mean_loss, distributions.compute_var_loss,
+            distributions.compute_covar_loss, distributions.compute_co_raw_m2_loss, distributions.compute_skew_loss]
+
+CHUNKED_LOSS_FNS = [distributions.compute_var_loss, distributions.compute_covar_loss,
+                    distributions.compute_co_raw_m2_loss, distributions.compute_skew_loss]
+
+TRAIN_LOSSES = [None, 'm1', 'm1_m2', 'm1_covar', 'corawm2', 'wass']
+TRAIN_DISC_MODELS = [None, 'mlp', 'fast']
+
+
+def _sync(outputs):
+    # Pulling the values to the host waits for the computation to finish
+    for output in tf.nest.flatten(outputs):
+        if isinstance(output, (tf.Tensor, tf.Variable)):
+            output.numpy()
+
+
+def time_fn(fn, *args):
+    for _ in range(FLAGS.bench_warmup):
+        _sync(fn(*args))
+
+    times = []
+    for _ in range(FLAGS.bench_iters):
+        start = time.perf_counter()
+        _sync(fn(*args))
+        times.append(time.perf_counter() - start)
+    times = 1e3 * np.array(times)
+    return {'median_ms': float(np.median(times)), 'min_ms': float(np.min(times)), 'iters': len(times)}
+
+
+def _int_list(values):
+    return [int(v) for v in values]
+
+
+def bench_distributions():
+    results = {}
+    for bsz in _int_list(FLAGS.bench_batch):
+        for num_locs in _int_list(FLAGS.bench_locs):
+            for channels in _int_list(FLAGS.bench_channels):
+                y_true = tf.random.normal([bsz, num_locs, channels])
+                y_pred = tf.random.normal([bsz, num_locs, channels])
+                suffix = f'b{bsz}_n{num_locs}_c{channels}'
+                for fn in LOSS_FNS:
+                    loss_fn = tf.function(partial(fn, p=2))
+                    results[f'distributions/{fn.__name__}/{suffix}'] = time_fn(loss_fn, y_true, y_pred)
+
+                    @tf.function
+                    def grad_fn(y_true, y_pred):
+                        with tf.GradientTape() as tape:
+                            tape.watch(y_pred)
+                            loss = fn(y_true, y_pred, p=2)
+                        return tape.gradient(loss, y_pred)
+
+                    results[f'distributions/{fn.__name__}_grad/{suffix}'] = time_fn(grad_fn, y_true, y_pred)
+
+                if FLAGS.moment_chunk is not None:
+                    for fn in CHUNKED_LOSS_FNS:
+                        loss_fn = tf.function(partial(fn, p=2, chunk_size=FLAGS.moment_chunk))
+                        results[f'distributions/{fn.__name__}_chunked/{suffix}'] = time_fn(loss_fn, y_true, y_pred)
+
+                side = int(np.sqrt(num_locs))
+                spatial_feats = tf.random.normal([bsz, side, side, channels])
+                sample_fn = tf.function(partial(distributions.process_spatial_feats, k=1024))
+                results[f'distributions/process_spatial_feats/{suffix}'] = time_fn(sample_fn, spatial_feats)
+                logging.info(f'benchmarked distribution functions ({suffix})')
+    return results
+
+
+def bench_wass_sort():
+    # tf.sort against the incremental sort of the wass loss, on fixed features like the style targets
+    # and on features that change slightly between calls like the generated features
+    results = {}
+    full_sort = tf.function(partial(tf.sort, axis=1))
+    for bsz in _int_list(FLAGS.bench_batch):
+        for num_locs in _int_list(FLAGS.bench_locs):
+            for channels in _int_list(FLAGS.bench_channels):
+                x = tf.random.normal([bsz, num_locs, channels])
+                changing = itertools.cycle([x + FLAGS.bench_sort_noise * tf.random.normal(x.shape) for _ in range(2)])
+                suffix = f'b{bsz}_n{num_locs}_c{channels}'
+                results[f'wass_sort/tf_sort/{suffix}'] = time_fn(full_sort, x)
+
+                fixed_sort = tf.function(distributions.IncrementalSort())
+                results[f'wass_sort/incremental_fixed/{suffix}'] = time_fn(fixed_sort, x)
+
+                changing_sort = tf.function(distributions.IncrementalSort(FLAGS.wass_repair_passes))
+                results[f'wass_sort/incremental_changing/{suffix}'] = time_fn(lambda: changing_sort(next(changing)))
+                logging.info(f'benchmarked wass sorts ({suffix})')
+    return results
+
+
+def bench_feat_model():
+    results = {}
+    for feat_model in FLAGS.bench_feat_models:
+        FLAGS.feat_model = feat_model
+        for imsize in _int_list(FLAGS.bench_imsizes):
+            model = scm.make_feat_model([imsize, imsize, 3])
+            image = tf.Variable(tf.random.uniform([1, imsize, imsize, 3], maxval=255))
+
+            def reduce_feats(feats):
+                return tf.add_n([tf.reduce_mean(f) for f in tf.nest.flatten(feats)])
+
+            @tf.function
+            def forward_fn():
+                return reduce_feats(model((image, image), training=False))
+
+            @tf.function
+            def backward_fn():
+                with tf.GradientTape() as tape:
+                    loss = reduce_feats(model((image, image), training=False))
+                return tape.gradient(loss, image)
+
+            results[f'feat_model/{feat_model}_forward/s{imsize}'] = time_fn(forward_fn)
+            results[f'feat_model/{feat_model}_backward/s{imsize}'] = time_fn(backward_fn)
+            logging.info(f'benchmarked {feat_model} feature model (imsize={imsize})')
+    return results
+
+
+def make_bench_images(imsize):
+    return tf.random.uniform([1, imsize, imsize, 3], maxval=255), tf.random.uniform([1, imsize, imsize, 3], maxval=255)
+
+
+def make_bench_sc_model(strategy, loss, disc_model, images):
+    FLAGS.disc_model = disc_model
+    style_image, content_image = images
+    with strategy.scope():
+        feat_model = scm.make_feat_model(style_image.shape[1:])
+        sc_model = scm.SCModel(feat_model, FLAGS.bench_sample_size, loss_warmup=0)
+        sc_model.configure(style_image, content_image)
+    feats = sc_model.feat_model((style_image, content_image), training=False)
+    compile_sc_model(strategy, sc_model, loss, with_metrics=FLAGS.bench_metrics)
+    return sc_model, ((style_image, content_image), feats)
+
+
+def bench_train_step():
+    results = {}
+    strategy = tf.distribute.get_strategy()
+    imsize = FLAGS.bench_train_imsize
+    for loss in TRAIN_LOSSES:
+        for disc_model in TRAIN_DISC_MODELS:
+            if loss is None and disc_model is None:
+                continue
+            sc_model, data = make_bench_sc_model(strategy, loss, disc_model, make_bench_images(imsize))
+            train_fn = tf.function(sc_model.train_step)
+            results[f'train_step/{FLAGS.feat_model}_{loss}_{disc_model}/s{imsize}'] = time_fn(train_fn, data)
+            logging.info(f'benchmarked train step (loss={loss}, disc_model={disc_model})')
+    return results
+
+
+def measure_quality(images, gen_image):
+    # Float32 metrics of the generated image, like the totals in raw_metrics.csv
+    feat_model = scm.make_feat_model(gen_image.shape[1:])
+    feats = feat_model(images, training=False)
+    gen_feats = feat_model((gen_image, gen_image), training=False)
+    totals = {}
+    for y_true, y_pred in zip(feats['style'], gen_feats['style']):
+        y_true = distributions.process_spatial_feats(y_true, None)
+        y_pred = distributions.process_spatial_feats(y_pred, None)
+        for metric in make_style_metrics():
+            metric.update_state(y_true, y_pred)
+            for name, value in metric.result().items():
+                totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+def bench_precision():
+    results = {}
+    strategy = tf.distribute.get_strategy()
+    if FLAGS.style_image is not None:
+        images = utils.load_sc_images()
+    else:
+        images = make_bench_images(FLAGS.bench_train_imsize)
+    imsize = images[0].shape[1]
+    for policy in FLAGS.bench_policies:
+        tf.keras.mixed_precision.set_global_policy(policy)
+        tf.random.set_seed(0)
+        sc_model, data = make_bench_sc_model(strategy, 'wass', None, images)
+        train_fn = tf.function(sc_model.train_step)
+        result = time_fn(train_fn, data)
+        for _ in range(FLAGS.bench_quality_steps):
+            train_fn(data)
+        gen_image = tf.identity(sc_model.gen_image)
+
+        tf.keras.mixed_precision.set_global_policy('float32')
+        result['metrics'] = measure_quality(images, gen_image)
+        results[f'precision/{FLAGS.feat_model}_{policy}/s{imsize}'] = result
+        logging.info(f'benchmarked {policy} policy: {result}')
+    return results
+
+
+SUITES = {'distributions': bench_distributions, 'feat_model': bench_feat_model, 'train_step': bench_train_step,
+          'precision': bench_precision, 'wass_sort': bench_wass_sort}
+
+
+def compare_results(results, baseline, tolerance):
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_ms'] / max(baseline[name]['median_ms'], 1e-9)
+        comparison[name] = {'baseline_ms': baseline[name]['median_ms'], 'median_ms': result['median_ms'],
+                            'speedup': 1 / ratio, 'regression': ratio > 1 + tolerance}
+    return comparison
+
+
+def main(argv):
+    del argv  # Unused.
+
+    if FLAGS.bench_offline:
+        tf.config.set_visible_devices([], 'GPU')
+        FLAGS.bench_feat_models = ['fast']
+        FLAGS.feat_model = 'fast'
+        logging.info('offline mode: fast feature model on the CPU')
+
+    results = {}
+    for suite in FLAGS.bench_suites:
+        if suite not in SUITES:
+            raise ValueError(f'unknown benchmark suite: {suite}')
+        logging.info(f'running {suite} benchmarks')
+        results.update(SUITES[suite]())
+
+    report = {
+        'meta': {'tf_version': tf.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                 'devices': [d.name for d in tf.config.get_visible_devices()], 'iters': FLAGS.bench_iters},
+        'results': results,
+    }
+
+    regressions = []
+    if FLAGS.bench_baseline is not None:
+        with open(FLAGS.bench_baseline) as f:
+            baseline = json.load(f)['results']
+        comparison = compare_results(results, baseline, FLAGS.bench_tolerance)
+        report['comparison'] = comparison
+        for name, cmp in sorted(comparison.items()):
+            logging.info(f'{name}: {cmp["baseline_ms"]:.3f}ms -> {cmp["median_ms"]:.3f}ms '
+                         f'({cmp["speedup"]:.2f}x)')
+        regressions = [name for name, cmp in comparison.items() if cmp['regression']]
+        for name in regressions:
+            logging.warning(f'regression: {name}')
+
+    os.makedirs(os.path.dirname(FLAGS.bench_out) or '.', exist_ok=True)
+    with open(FLAGS.bench_out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info(f'benchmark results saved to {FLAGS.bench_out}')
+
+    if regressions and FLAGS.bench_fail_on_regression:
+        raise SystemExit(f'{len(regressions)} benchmark(s) regressed')
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -8,6 +8,96 @@ def _flatten_spatial(x):
     return x
 
 
+def _upcast(x):
+    # Low precision features are accumulated in float32 for stability
+    if x.dtype in (tf.float16, tf.bfloat16):
+        x = tf.cast(x, tf.float32)
+    return x
+
+
+def sort_locations(x):
+    return tf.sort(x, axis=1)
+
+
+def gather_locations(x, perm):
+    # x[b, perm[b, n, c], c] for every batch, location and channel
+    shape = tf.shape(x)
+    channels = shape[2]
+    flat_perm = tf.reshape(perm * channels + tf.range(channels), [shape[0], -1])
+    return tf.reshape(tf.gather(tf.reshape(x, [shape[0], -1]), flat_perm, batch_dims=1), shape)
+
+
+def _is_sorted(x):
+    return tf.reduce_all(x[:, 1:] >= x[:, :-1])
+
+
+def _compare_swap(x, perm, start):
+    # Orders the location pairs (start, start + 1), (start + 2, start + 3), ... of each channel
+    num_locs = tf.shape(x)[1]
+    end = start + (num_locs - start) // 2 * 2
+
+    def swap_pairs(t, swap=None):
+        pairs = tf.reshape(t[:, start:end], [tf.shape(t)[0], -1, 2, tf.shape(t)[2]])
+        first, second = pairs[:, :, 0], pairs[:, :, 1]
+        if swap is None:
+            swap = first > second
+        pairs = tf.stack([tf.where(swap, second, first), tf.where(swap, first, second)], axis=2)
+        t = tf.concat([t[:, :start], tf.reshape(pairs, [tf.shape(t)[0], -1, tf.shape(t)[2]]), t[:, end:]], axis=1)
+        return t, swap
+
+    x, swap = swap_pairs(x)
+    perm, _ = swap_pairs(perm, swap)
+    return x, perm
+
+
+def sort_with_permutation(x):
+    # Same values as tf.sort(x, axis=1), along with the (stable) permutation that sorts x
+    neg_values, indices = tf.math.top_k(-tf.transpose(x, [0, 2, 1]), k=tf.shape(x)[1])
+    return -tf.transpose(neg_values, [0, 2, 1]), tf.transpose(indices, [0, 2, 1])
+
+
+class IncrementalSort:
+    # Sorts the locations of features by reusing the previous call's permutation.
+    # Fixed features, like the style targets, are still sorted by it, which only costs a gather and a check.
+    # Features that change slightly, like the generated features, can be repaired with odd-even transposition passes.
+    # Otherwise it falls back to a full sort, so the result always equals tf.sort(x, axis=1)
+    def __init__(self, max_passes=0):
+        self.max_passes = max_passes
+        self.perm = None
+
+    def build(self, shape):
+        if not shape.is_fully_defined():
+            raise ValueError(f'incremental sorting needs a static feature shape. got {shape}')
+        with tf.init_scope():
+            # Starts from the identity permutation. Each replica keeps the permutation of its own features
+            identity = tf.broadcast_to(tf.range(shape[1])[None, :, None], shape)
+            self.perm = tf.Variable(identity, trainable=False,
+                                    synchronization=tf.VariableSynchronization.ON_READ,
+                                    aggregation=tf.VariableAggregation.NONE)
+
+    def __call__(self, x):
+        if self.perm is None:
+            self.build(x.shape)
+        elif self.perm.shape != x.shape:
+            raise ValueError(f'features changed shape from {self.perm.shape} to {x.shape}')
+
+        perm = self.perm.read_value()
+        stale = gather_locations(x, perm)
+
+        def cond(i, done, _, __):
+            return tf.logical_and(i < self.max_passes, tf.logical_not(done))
+
+        def body(i, _, partial_sort, perm):
+            partial_sort, perm = _compare_swap(partial_sort, perm, start=0)
+            partial_sort, perm = _compare_swap(partial_sort, perm, start=1)
+            return i + 1, _is_sorted(partial_sort), partial_sort, perm
+
+        _, done, repaired, perm = tf.while_loop(cond, body, (tf.constant(0), _is_sorted(stale), stale, perm))
+        sorted_x, perm = tf.cond(done, lambda: (repaired, perm), lambda: sort_with_permutation(x))
+        with tf.control_dependencies([self.perm.assign(perm)]):
+            return tf.identity(sorted_x)
+
+
 def get_p_fn(p):
     if p == 1:
         return tf.abs
@@ -20,8 +110,12 @@ def get_p_fn(p):
 def sample_k(x, k):
     if k is not None:
         x = tf.transpose(x, [1, 0, 2])
+        static_n = x.shape[0]
         n = tf.shape(x)[0]
         x = tf.gather(x, tf.random.shuffle(tf.range(n))[:tf.minimum(k, n)])
+        if static_n is not None:
+            # Keep the static shape so the layers with equal sample sizes can be stacked
+            x.set_shape([min(k, static_n)] + x.shape[1:])
         x = tf.transpose(x, [1, 0, 2])
     return x
 
@@ -33,13 +127,19 @@ def process_spatial_feats(x, k):
 
 
 def compute_wass_dist(y_true, y_pred, p):
-    y, x = tf.sort(y_true, axis=1), tf.sort(y_pred, axis=1)
+    # Sorting commutes with the cast, so sort in the (cheaper) input precision
+    return compute_sorted_wass_dist(sort_locations(y_true), sort_locations(y_pred), p)
+
+
+def compute_sorted_wass_dist(sorted_y_true, sorted_y_pred, p):
+    y, x = _upcast(sorted_y_true), _upcast(sorted_y_pred)
     p_fn = get_p_fn(p)
     wass_dist = tf.reduce_mean(p_fn(y - x), axis=1)
     return tf.reduce_mean(wass_dist, axis=-1)
 
 
 def compute_mean_loss(y_true, y_pred, p):
+    y_true, y_pred = _upcast(y_true), _upcast(y_pred)
     mu1 = tf.reduce_mean(y_true, axis=1)
     mu2 = tf.reduce_mean(y_pred, axis=1)
     p_fn = get_p_fn(p)
@@ -47,26 +147,120 @@ def compute_mean_loss(y_true, y_pred, p):
     return mean_loss
 
 
-def compute_co_raw_m2_loss(y_true, y_pred, p):
-    shape = tf.shape(y_true)
-    num_locs = tf.cast(shape[1], y_true.dtype)
-    raw_m2_1 = tf.einsum('bnc,bnd->bcd', y_true, y_true) / num_locs
-    raw_m2_2 = tf.einsum('bnc,bnd->bcd', y_pred, y_pred) / num_locs
+def compute_chunked_moments(x, chunk_size, cross=False, third=False):
+    # Single pass over the locations in chunks of chunk_size, so the temporaries are at most [B, chunk_size, C].
+    # The sums are taken around the first chunk's mean for numerical stability.
+    # The gradient is accumulated over the same chunks, so the backward pass doesn't keep the chunks of every
+    # iteration either. Only x and its gradient are [B, N, C]
+    x = _upcast(x)
+    num_locs = tf.shape(x)[1]
+    num_chunks = (num_locs + chunk_size - 1) // chunk_size
+    pivot = tf.stop_gradient(tf.reduce_mean(x[:, :chunk_size], axis=1, keepdims=True))
+
+    def get_chunk(x, i):
+        return x[:, i * chunk_size:(i + 1) * chunk_size] - pivot
+
+    @tf.custom_gradient
+    def chunked_sums(x):
+        def body(i, sums):
+            chunk = get_chunk(x, i)
+            new_sums = [sums[0] + tf.reduce_sum(chunk, axis=1)]
+            if cross:
+                new_sums.append(sums[1] + tf.einsum('bnc,bnd->bcd', chunk, chunk))
+            else:
+                new_sums.append(sums[1] + tf.reduce_sum(chunk ** 2, axis=1))
+            if third:
+                new_sums.append(sums[2] + tf.reduce_sum(chunk ** 3, axis=1))
+            return i + 1, new_sums
+
+        zeros = tf.zeros_like(x[:, 0])
+        sums = [zeros, tf.einsum('bc,bd->bcd', zeros, zeros) if cross else zeros]
+        if third:
+            sums.append(zeros)
+        # One iteration at a time to bound the temporaries
+        _, sums = tf.while_loop(lambda i, _: i < num_chunks, body, (tf.constant(0), sums), parallel_iterations=1)
+
+        def grad(*grads):
+            if cross:
+                # The second sums are symmetric in the channels
+                grads = [grads[0], grads[1] + tf.linalg.matrix_transpose(grads[1]), *grads[2:]]
+
+            def grad_body(i, grad_chunks):
+                chunk = get_chunk(x, i)
+                grad_chunk = tf.broadcast_to(grads[0][:, None], tf.shape(chunk))
+                if cross:
+                    grad_chunk += tf.einsum('bnc,bcd->bnd', chunk, grads[1])
+                else:
+                    grad_chunk += 2 * chunk * grads[1][:, None]
+                if third:
+                    grad_chunk += 3 * chunk ** 2 * grads[2][:, None]
+                # The chunks are concatenated along the first axis
+                return i + 1, grad_chunks.write(i, tf.transpose(grad_chunk, [1, 0, 2]))
+
+            grad_chunks = tf.TensorArray(x.dtype, size=num_chunks, infer_shape=False)
+            _, grad_chunks = tf.while_loop(lambda i, _: i < num_chunks, grad_body, (tf.constant(0), grad_chunks),
+                                           parallel_iterations=1)
+            return tf.transpose(grad_chunks.concat(), [1, 0, 2])
+
+        return sums, grad
+
+    sums = dict(zip(['s1', 's2', 's3'], chunked_sums(x)))
+
+    n = tf.cast(num_locs, x.dtype)
+    a1 = sums['s1'] / n
+    moments = {'mean': tf.squeeze(pivot, 1) + a1}
+    if cross:
+        raw_a2 = sums['s2'] / n
+        moments['covar'] = raw_a2 - tf.einsum('bc,bd->bcd', a1, a1)
+        a2 = tf.linalg.diag_part(raw_a2)
+    else:
+        a2 = sums['s2'] / n
+    moments['var'] = a2 - a1 ** 2
+    if third:
+        moments['m3'] = sums['s3'] / n - 3 * a1 * a2 + 2 * a1 ** 3
+    return moments
+
+
+def _raw_m2(x, chunk_size):
+    if chunk_size is None:
+        num_locs = tf.cast(tf.shape(x)[1], x.dtype)
+        return tf.einsum('bnc,bnd->bcd', x, x) / num_locs
+    moments = compute_chunked_moments(x, chunk_size, cross=True)
+    return moments['covar'] + tf.einsum('bc,bd->bcd', moments['mean'], moments['mean'])
+
+
+def compute_co_raw_m2_loss(y_true, y_pred, p, chunk_size=None):
+    y_true, y_pred = _upcast(y_true), _upcast(y_pred)
+    raw_m2_1 = _raw_m2(y_true, chunk_size)
+    raw_m2_2 = _raw_m2(y_pred, chunk_size)
     p_fn = get_p_fn(p)
     raw_m2_loss = tf.reduce_mean(p_fn(raw_m2_1 - raw_m2_2), axis=1)
     return tf.reduce_mean(raw_m2_loss, axis=-1)
 
 
-def compute_var_loss(y_true, y_pred, p):
-    var1 = tf.math.reduce_variance(y_true, axis=1)
-    var2 = tf.math.reduce_variance(y_pred, axis=1)
+def compute_var_loss(y_true, y_pred, p, chunk_size=None):
+    y_true, y_pred = _upcast(y_true), _upcast(y_pred)
+    if chunk_size is None:
+        var1 = tf.math.reduce_variance(y_true, axis=1)
+        var2 = tf.math.reduce_variance(y_pred, axis=1)
+    else:
+        var1 = compute_chunked_moments(y_true, chunk_size)['var']
+        var2 = compute_chunked_moments(y_pred, chunk_size)['var']
 
     p_fn = get_p_fn(p)
     var_loss = tf.reduce_mean(p_fn(var1 - var2), axis=-1)
     return var_loss
 
 
-def compute_covar_loss(y_true, y_pred, p):
+def compute_covar_loss(y_true, y_pred, p, chunk_size=None):
+    y_true, y_pred = _upcast(y_true), _upcast(y_pred)
+    if chunk_size is not None:
+        covar1 = compute_chunked_moments(y_true, chunk_size, cross=True)['covar']
+        covar2 = compute_chunked_moments(y_pred, chunk_size, cross=True)['covar']
+        p_fn = get_p_fn(p)
+        covar_loss = tf.reduce_mean(p_fn(covar1 - covar2), axis=1)
+        return tf.reduce_mean(covar_loss, axis=-1)
+
     mu1 = tf.reduce_mean(y_true, axis=1, keepdims=True)
     mu2 = tf.reduce_mean(y_pred, axis=1, keepdims=True)
     centered_y1 = y_true - mu1
@@ -75,14 +269,57 @@ def compute_covar_loss(y_true, y_pred, p):
     return covar_loss
 
 
-def compute_skew_loss(y_true, y_pred, p):
-    mu1, var1 = tf.nn.moments(y_true, axes=1, keepdims=True)
-    mu2, var2 = tf.nn.moments(y_pred, axes=1, keepdims=True)
-    z1 = (y_true - mu1) * tf.math.rsqrt(var1 + 1e-3)
-    z2 = (y_pred - mu2) * tf.math.rsqrt(var2 + 1e-3)
+def _skew(x, chunk_size):
+    if chunk_size is None:
+        mu, var = tf.nn.moments(x, axes=1, keepdims=True)
+        z = (x - mu) * tf.math.rsqrt(var + 1e-3)
+        return tf.reduce_mean(z ** 3, axis=1)
+    moments = compute_chunked_moments(x, chunk_size, third=True)
+    return moments['m3'] * tf.math.rsqrt(moments['var'] + 1e-3) ** 3
 
-    skew1 = tf.reduce_mean(z1 ** 3, axis=1)
-    skew2 = tf.reduce_mean(z2 ** 3, axis=1)
+
+def compute_skew_loss(y_true, y_pred, p, chunk_size=None):
+    y_true, y_pred = _upcast(y_true), _upcast(y_pred)
+    skew1 = _skew(y_true, chunk_size)
+    skew2 = _skew(y_pred, chunk_size)
     p_fn = get_p_fn(p)
     skew_loss = tf.reduce_mean(p_fn(skew1 - skew2), axis=-1)
     return skew_loss
+
+
+def compute_layer_stats(x, chunk_size=None, sorted_x=None):
+    # All the statistics used by the metrics, sharing the mean and the centered second moments.
+    # sorted_x are the already sorted locations of x, if any
+    stats = {'sorted': _upcast(sort_locations(x) if sorted_x is None else sorted_x)}
+    x = _upcast(x)
+    if chunk_size is None:
+        mean = tf.reduce_mean(x, axis=1, keepdims=True)
+        centered = x - mean
+        num_locs = tf.cast(tf.shape(x)[1], x.dtype)
+        stats['mean'] = tf.squeeze(mean, 1)
+        stats['covar'] = tf.einsum('bnc,bnd->bcd', centered, centered) / num_locs
+        stats['var'] = tf.linalg.diag_part(stats['covar'])
+        m3 = tf.reduce_mean(centered ** 3, axis=1)
+    else:
+        moments = compute_chunked_moments(x, chunk_size, cross=True, third=True)
+        stats.update({key: moments[key] for key in ['mean', 'covar', 'var']})
+        m3 = moments['m3']
+    stats['gram'] = stats['covar'] + tf.einsum('bc,bd->bcd', stats['mean'], stats['mean'])
+    stats['skew'] = m3 * tf.math.rsqrt(stats['var'] + 1e-3) ** 3
+    return stats
+
+
+def compute_fused_losses(y_true, y_pred, p, chunk_size=None, sorted_feats=None):
+    # Same values as the individual loss functions, but each statistic is only computed once.
+    # sorted_feats are the already sorted (y_true, y_pred), if any
+    sorted_feats = sorted_feats or (None, None)
+    stats1 = compute_layer_stats(y_true, chunk_size, sorted_feats[0])
+    stats2 = compute_layer_stats(y_pred, chunk_size, sorted_feats[1])
+    p_fn = get_p_fn(p)
+
+    def reduce_loss(key):
+        loss = p_fn(stats1[key] - stats2[key])
+        return tf.reduce_mean(tf.reshape(loss, [tf.shape(loss)[0], -1]), axis=-1)
+
+    return {'wass_dist': reduce_loss('sorted'), 'mean_loss': reduce_loss('mean'), 'var_loss': reduce_loss('var'),
+            'covar_loss': reduce_loss('covar'), 'skew_loss': reduce_loss('skew'), 'gram_loss': reduce_loss('gram')}
@@ -0,0 +1,88 @@
+import numpy as np
+import tensorflow as tf
+
+from distributions import _flatten_spatial, _upcast, gather_locations
+from distributions.sharded import compute_quantile_summary, interpolate, merge_quantile_summaries
+
+# Pooled targets of several style images. The features of the styles are merged once into one tensor with the
+# shape of a single style's features, so the losses and metrics treat it like the features of a single style
+
+
+def get_mixture_counts(weights, num_locs):
+    # Locations drawn from each style, proportional to the weights (largest remainders) and summing to num_locs
+    weights = np.asarray(weights, np.float64) / np.sum(weights)
+    counts = np.floor(weights * num_locs).astype(np.int64)
+    remainders = weights * num_locs - counts
+    counts[np.argsort(-remainders)[:num_locs - counts.sum()]] += 1
+    return counts
+
+
+def resample_mixture(all_feats, weights):
+    # Real locations of the flattened [B, N, C] features of each style, drawn in proportion to the weights
+    num_locs = all_feats[0].shape[1]
+    samples = []
+    for feats, count in zip(all_feats, get_mixture_counts(weights, num_locs)):
+        n = tf.shape(feats)[1]
+        # Without replacement as long as the style has enough locations
+        repeats = (count + n - 1) // n
+        indices = tf.concat([tf.random.shuffle(tf.range(n)) for _ in range(max(int(repeats), 1))], 0)[:count]
+        samples.append(tf.gather(feats, indices, axis=1))
+    return tf.concat(samples, axis=1)
+
+
+def compute_mixture_moments(all_feats, weights):
+    # Mean [B, C] and covariance [B, C, C] of the weighted mixture of the styles' locations, in float64
+    weights = np.asarray(weights, np.float64) / np.sum(weights)
+    mean, raw_m2 = 0, 0
+    for feats, weight in zip(all_feats, weights):
+        feats = tf.cast(feats, tf.float64)
+        num_locs = tf.cast(tf.shape(feats)[1], tf.float64)
+        mean += weight * tf.reduce_mean(feats, axis=1)
+        raw_m2 += weight * tf.einsum('bnc,bnd->bcd', feats, feats) / num_locs
+    return mean, raw_m2 - tf.einsum('bc,bd->bcd', mean, mean)
+
+
+def _sqrtm(covar, inverse=False):
+    e, v = tf.linalg.eigh(covar)
+    e = tf.maximum(e, 1e-12)
+    e = tf.math.rsqrt(e) if inverse else tf.sqrt(e)
+    return tf.matmul(v * e[:, None], v, transpose_b=True)
+
+
+def match_moments(x, mean, covar):
+    # Whitening and coloring transform of x [B, N, C] to the given mean and covariance
+    x = tf.cast(x, tf.float64)
+    x_mean = tf.reduce_mean(x, axis=1, keepdims=True)
+    centered = x - x_mean
+    x_covar = tf.einsum('bnc,bnd->bcd', centered, centered) / tf.cast(tf.shape(x)[1], tf.float64)
+    transform = tf.matmul(_sqrtm(x_covar, inverse=True), _sqrtm(covar))
+    return tf.matmul(centered, transform) + mean[:, None]
+
+
+def compute_mixture_quantiles(all_feats, weights, num_quantiles):
+    # Quantiles [B, C, num_quantiles] of each channel of the weighted mixture of the styles
+    summaries = tf.stack([compute_quantile_summary(feats, feats.shape[1]) for feats in all_feats])
+    values, levels = merge_quantile_summaries(summaries, tf.constant(weights, summaries.dtype))
+    target_levels = (tf.range(num_quantiles, dtype=values.dtype) + 0.5) / num_quantiles
+    return interpolate(tf.broadcast_to(target_levels, tf.concat([tf.shape(values)[:2], [num_quantiles]], 0)),
+                       levels, values)
+
+
+def match_quantiles(x, quantiles):
+    # Replaces the values of each channel of x [B, N, C] by the quantiles [B, C, N] of the same rank
+    ranks = tf.argsort(tf.argsort(x, axis=1, stable=True), axis=1)
+    return gather_locations(tf.transpose(quantiles, [0, 2, 1]), ranks)
+
+
+def pool_style_feats(all_feats, weights, loss_key):
+    # One target with the shape of the first style's features [B, H, W, C].
+    # The Wasserstein loss gets the exact quantiles of the mixture and the other losses its exact mean and covariance,
+    # both arranged on resampled locations of the styles so the other statistics stay close to the mixture's
+    shape, dtype = all_feats[0].shape, all_feats[0].dtype
+    all_feats = [_upcast(_flatten_spatial(feats)) for feats in all_feats]
+    pooled = resample_mixture(all_feats, weights)
+    if loss_key == 'wass':
+        pooled = match_quantiles(pooled, compute_mixture_quantiles(all_feats, weights, pooled.shape[1]))
+    else:
+        pooled = match_moments(pooled, *compute_mixture_moments(all_feats, weights))
+    return tf.cast(tf.reshape(pooled, shape), dtype)
@@ -1,11 +1,18 @@
 import tensorflow as tf
 from absl import flags
 
-from distributions import compute_wass_dist, compute_co_raw_m2_loss, compute_covar_loss, compute_mean_loss, \
-    compute_var_loss
+from distributions import compute_co_raw_m2_loss, compute_covar_loss, compute_mean_loss, \
+    compute_var_loss, compute_sorted_wass_dist, IncrementalSort, sort_locations
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_bool('wass_incremental', False, 'sort the features of the wass loss by the previous step\'s order when '
+                                            'it still sorts them, which skips re-sorting the fixed style features. '
+                                            'not useful with --sample_size, which resamples them every step')
+flags.DEFINE_integer('wass_repair_passes', 0, 'odd-even transposition passes that try to repair the previous step\'s '
+                                              'order of the generated features before falling back to a full sort. '
+                                              'only used with --wass_incremental')
+
 
 class NoOpLoss(tf.keras.losses.Loss):
     def call(self, y_true, y_pred):
@@ -17,28 +24,53 @@ class M1Loss(tf.keras.losses.Loss):
         return compute_mean_loss(y_true, y_pred, p=2)
 
 
-class M1M2Loss(tf.keras.losses.Loss):
+class MomentLoss(tf.keras.losses.Loss):
+    # Losses of the second or third moments, which can be accumulated over chunks of chunk_size locations
+    def __init__(self, chunk_size=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_size = chunk_size
+
+
+class M1M2Loss(MomentLoss):
     def call(self, y_true, y_pred):
         mean_loss = compute_mean_loss(y_true, y_pred, p=2)
-        var_loss = compute_var_loss(y_true, y_pred, p=2)
+        var_loss = compute_var_loss(y_true, y_pred, p=2, chunk_size=self.chunk_size)
         return mean_loss + var_loss
 
 
-class M1CovarLoss(tf.keras.losses.Loss):
+class M1CovarLoss(MomentLoss):
     def call(self, y_true, y_pred):
         mean_loss = compute_mean_loss(y_true, y_pred, p=2)
-        covar_loss = compute_covar_loss(y_true, y_pred, p=2)
+        covar_loss = compute_covar_loss(y_true, y_pred, p=2, chunk_size=self.chunk_size)
         return mean_loss + covar_loss
 
 
-class CoRawM2Loss(tf.keras.losses.Loss):
+class CoRawM2Loss(MomentLoss):
     def call(self, y_true, y_pred):
-        return compute_co_raw_m2_loss(y_true, y_pred, p=2)
+        return compute_co_raw_m2_loss(y_true, y_pred, p=2, chunk_size=self.chunk_size)
 
 
 class WassLoss(tf.keras.losses.Loss):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sorts = None
+        if FLAGS.wass_incremental:
+            # The generated features change every step, so they are only sorted incrementally when they can be repaired
+            gen_sort = IncrementalSort(FLAGS.wass_repair_passes) if FLAGS.wass_repair_passes else None
+            self.sorts = [IncrementalSort(), gen_sort]
+
+    def sort_feats(self, y_true, y_pred):
+        if self.sorts is None:
+            return sort_locations(y_true), sort_locations(y_pred)
+        return tuple(sort_locations(feats) if incremental_sort is None else incremental_sort(feats)
+                     for feats, incremental_sort in zip([y_true, y_pred], self.sorts))
+
+    def compute_from_sorted(self, sorted_true, sorted_pred):
+        # Unreduced loss of features the caller already sorted with sort_feats, e.g. to share them with the metrics
+        return compute_sorted_wass_dist(sorted_true, sorted_pred, p=2)
+
     def call(self, y_true, y_pred):
-        return compute_wass_dist(y_true, y_pred, p=2)
+        return self.compute_from_sorted(*self.sort_feats(y_true, y_pred))
 
 
 loss_dict = {'m1': M1Loss, 'm1_m2': M1M2Loss, 'm1_covar': M1CovarLoss, 'corawm2': CoRawM2Loss, 'wass': WassLoss,
@@ -1,9 +1,10 @@
 from functools import partial
 
+import tensorflow as tf
 import tensorflow_addons as tfa
 
 from distributions import compute_mean_loss, compute_var_loss, \
-    compute_covar_loss, compute_co_raw_m2_loss, compute_skew_loss, compute_wass_dist
+    compute_covar_loss, compute_co_raw_m2_loss, compute_skew_loss, compute_wass_dist, compute_fused_losses
 
 
 class MeanLoss(tfa.metrics.MeanMetricWrapper):
@@ -12,25 +13,57 @@ class MeanLoss(tfa.metrics.MeanMetricWrapper):
 
 
 class VarLoss(tfa.metrics.MeanMetricWrapper):
-    def __init__(self, name="var_loss", **kwargs):
-        super().__init__(partial(compute_var_loss, p=1), name=name, **kwargs)
+    def __init__(self, name="var_loss", chunk_size=None, **kwargs):
+        super().__init__(partial(compute_var_loss, p=1, chunk_size=chunk_size), name=name, **kwargs)
 
 
 class CovarLoss(tfa.metrics.MeanMetricWrapper):
-    def __init__(self, name="covar_loss", **kwargs):
-        super().__init__(partial(compute_covar_loss, p=1), name=name, **kwargs)
+    def __init__(self, name="covar_loss", chunk_size=None, **kwargs):
+        super().__init__(partial(compute_covar_loss, p=1, chunk_size=chunk_size), name=name, **kwargs)
 
 
 class GramLoss(tfa.metrics.MeanMetricWrapper):
-    def __init__(self, name="gram_loss", **kwargs):
-        super().__init__(partial(compute_co_raw_m2_loss, p=1), name=name, **kwargs)
+    def __init__(self, name="gram_loss", chunk_size=None, **kwargs):
+        super().__init__(partial(compute_co_raw_m2_loss, p=1, chunk_size=chunk_size), name=name, **kwargs)
 
 
 class SkewLoss(tfa.metrics.MeanMetricWrapper):
-    def __init__(self, name="skew_loss", **kwargs):
-        super().__init__(partial(compute_skew_loss, p=1), name=name, **kwargs)
+    def __init__(self, name="skew_loss", chunk_size=None, **kwargs):
+        super().__init__(partial(compute_skew_loss, p=1, chunk_size=chunk_size), name=name, **kwargs)
 
 
 class WassDist(tfa.metrics.MeanMetricWrapper):
     def __init__(self, name="wass_dist", **kwargs):
         super().__init__(partial(compute_wass_dist, p=1), name=name, **kwargs)
+
+
+class StyleMetrics(tf.keras.metrics.Metric):
+    # All of the above metrics in a single pass. The result is a dict keyed by the individual metric names
+    names = ['wass_dist', 'mean_loss', 'var_loss', 'covar_loss', 'skew_loss', 'gram_loss']
+
+    def __init__(self, name="style_metrics", chunk_size=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.base_name = name
+        self.chunk_size = chunk_size
+        self.means = [tf.keras.metrics.Mean(name=metric_name) for metric_name in self.names]
+
+    def update_state(self, y_true, y_pred, sample_weight=None, sorted_feats=None):
+        # sorted_feats are the already sorted (y_true, y_pred), if the caller shares them with the loss
+        y_true, y_pred = tf.cast(y_true, self.dtype), tf.cast(y_pred, self.dtype)
+        if sorted_feats is not None:
+            sorted_feats = [tf.cast(feats, self.dtype) for feats in sorted_feats]
+        losses = compute_fused_losses(y_true, y_pred, p=1, chunk_size=self.chunk_size, sorted_feats=sorted_feats)
+        for metric_name, mean in zip(self.names, self.means):
+            mean.update_state(losses[metric_name], sample_weight)
+
+    def result(self):
+        return {metric_name: mean.result() for metric_name, mean in zip(self.names, self.means)}
+
+    def named_results(self):
+        # Keras prefixes the output name to the metric name
+        prefix = self.name[:len(self.name) - len(self.base_name)]
+        return {prefix + metric_name: value for metric_name, value in self.result().items()}
+
+    def reset_state(self):
+        for mean in self.means:
+            mean.reset_state()
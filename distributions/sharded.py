@@ -0,0 +1,108 @@
+import tensorflow as tf
+
+from distributions import _upcast, get_p_fn
+
+# Statistics of features that are split by location between shards.
+# The moments are sums that add up over the shards, and the distributions are summarized by quantiles
+# that merge into quantiles of the whole. Summing or gathering them between the shards is left to the caller.
+
+
+def compute_shard_sums(x, pivot, cross=False):
+    # Sums around a pivot shared by all the shards, like the style mean, for numerical stability
+    x = _upcast(x) - pivot[:, None]
+    sums = {'n': tf.cast(tf.shape(x)[1], x.dtype), 's1': tf.reduce_sum(x, axis=1)}
+    if cross:
+        sums['s2'] = tf.einsum('bnc,bnd->bcd', x, x)
+    else:
+        sums['s2'] = tf.reduce_sum(x ** 2, axis=1)
+    return sums
+
+
+def moments_from_sums(sums, pivot, cross=False):
+    a1 = sums['s1'] / sums['n']
+    moments = {'mean': pivot + a1}
+    if cross:
+        raw_a2 = sums['s2'] / sums['n']
+        moments['covar'] = raw_a2 - tf.einsum('bc,bd->bcd', a1, a1)
+        moments['var'] = tf.linalg.diag_part(moments['covar'])
+        moments['gram'] = moments['covar'] + tf.einsum('bc,bd->bcd', moments['mean'], moments['mean'])
+    else:
+        moments['var'] = sums['s2'] / sums['n'] - a1 ** 2
+    return moments
+
+
+def needs_cross_moments(loss_key):
+    return loss_key in ['m1_covar', 'corawm2']
+
+
+def compute_moment_loss(loss_key, moments1, moments2, p):
+    # Same losses as distributions.losses, from the moments of the whole features
+    p_fn = get_p_fn(p)
+
+    def reduce_loss(key):
+        loss = p_fn(moments1[key] - moments2[key])
+        return tf.reduce_mean(tf.reshape(loss, [tf.shape(loss)[0], -1]), axis=-1)
+
+    if loss_key == 'm1':
+        return reduce_loss('mean')
+    elif loss_key == 'm1_m2':
+        return reduce_loss('mean') + reduce_loss('var')
+    elif loss_key == 'm1_covar':
+        return reduce_loss('mean') + reduce_loss('covar')
+    elif loss_key == 'corawm2':
+        return reduce_loss('gram')
+    else:
+        raise ValueError(f'no moment loss for {loss_key}')
+
+
+def compute_quantile_summary(x, num_quantiles):
+    # Values at the levels (k + 0.5) / num_quantiles of each channel, as [B, C, num_quantiles]
+    x = tf.transpose(_upcast(x), [0, 2, 1])
+    num_locs = tf.shape(x)[-1]
+    levels = (tf.range(num_quantiles, dtype=x.dtype) + 0.5) / num_quantiles
+    ranks = tf.cast(levels * tf.cast(num_locs, x.dtype), tf.int32)
+    return tf.gather(tf.sort(x, axis=-1), tf.minimum(ranks, num_locs - 1), axis=-1)
+
+
+def merge_quantile_summaries(summaries, counts):
+    # Merges the [W, B, C, Q] summaries of W shards with counts [W] into a piecewise linear CDF.
+    # Returns the sorted values [B, C, W * Q] and their levels of the whole features
+    num_quantiles = tf.shape(summaries)[-1]
+    values = tf.reshape(tf.transpose(summaries, [1, 2, 0, 3]), tf.concat([tf.shape(summaries)[1:3], [-1]], 0))
+    counts = tf.cast(counts, values.dtype)
+    weights = tf.repeat(counts / tf.reduce_sum(counts) / tf.cast(num_quantiles, values.dtype), num_quantiles)
+    order = tf.argsort(values, axis=-1, stable=True)
+    sorted_weights = tf.gather(weights, order)
+    levels = tf.cumsum(sorted_weights, axis=-1) - sorted_weights / 2
+    return tf.gather(values, order, batch_dims=2), levels
+
+
+def interpolate(x, xp, fp, side='right'):
+    # Piecewise linear interpolation along the last axis, constant beyond the ends.
+    # At repeated xp values, side='left' gives the lowest fp and side='right' the highest
+    num_points = tf.shape(xp)[-1]
+    i = tf.clip_by_value(tf.searchsorted(xp, x, side=side), 1, num_points - 1)
+    batch_dims = len(x.shape) - 1
+    x0, x1 = tf.gather(xp, i - 1, batch_dims=batch_dims), tf.gather(xp, i, batch_dims=batch_dims)
+    f0, f1 = tf.gather(fp, i - 1, batch_dims=batch_dims), tf.gather(fp, i, batch_dims=batch_dims)
+    t = tf.clip_by_value(tf.math.divide_no_nan(x - x0, x1 - x0), 0, 1)
+    return f0 + t * (f1 - f0)
+
+
+def compute_wass_targets(x, values, levels, style_values, style_levels):
+    # The style value matched to each location of x in the sorted order of the whole features,
+    # from the merged quantiles of the generated (values, levels) and style features.
+    # Tied locations, like zero activations, are spread uniformly over the levels they span like a sort would
+    x = tf.transpose(_upcast(x), [0, 2, 1])
+    low = interpolate(x, values, levels, side='left')
+    high = interpolate(x, values, levels, side='right')
+    x_levels = low + tf.random.uniform(tf.shape(x), dtype=x.dtype) * (high - low)
+    targets = interpolate(x_levels, style_levels, style_values)
+    return tf.transpose(tf.stop_gradient(targets), [0, 2, 1])
+
+
+def compute_shard_wass_sum(x, targets, p):
+    # Sum over the locations of the shard. Divided by the total locations it is the Wasserstein distance,
+    # and its gradient is that of the sorted distance
+    p_fn = get_p_fn(p)
+    return tf.reduce_mean(tf.reduce_sum(p_fn(_upcast(x) - targets), axis=1), axis=-1)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('image_store', None, 'directory of the pre-decoded images. '
+                                         'images that are not in the store are decoded as usual (optional)')
+flags.DEFINE_list('ingest', None, 'image files or directories to decode into the image store')
+flags.DEFINE_list('ingest_sizes', None, 'image sizes to store, matching --imsize. '
+                                        'defaults to only storing the original sizes')
+flags.DEFINE_integer('ingest_workers', None, 'parallel decoders. defaults to the number of cores')
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+
+def hash_file(filepath):
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def decode_image(filepath, imsize):
+    # Same decoding and resizing as utils.load_sc_images, rounded to uint8
+    image = tf.image.decode_image(tf.io.read_file(filepath), channels=3, expand_animations=False)
+    if imsize:
+        image = tf.keras.preprocessing.image.smart_resize(image, [imsize, imsize])
+        image = tf.cast(tf.round(tf.clip_by_value(image, 0, 255)), tf.uint8)
+    return image.numpy()
+
+
+class ImageStore:
+    # Decoded uint8 images concatenated in one memory-mapped file.
+    # index.json maps each (path, content hash, size) to its offset and shape in the file
+    def __init__(self, root):
+        self.root = root
+        self.data_path = os.path.join(root, 'images.u8')
+        self.index_path = os.path.join(root, 'index.json')
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        return self._data
+
+    def find(self, filepath, imsize):
+        # The path and file stats find unchanged files without hashing them.
+        # Otherwise the content hash also finds moved and copied files
+        imsize = imsize or 0
+        realpath, stat = os.path.realpath(filepath), os.stat(filepath)
+        candidates = [entry for entry in self.entries if entry['imsize'] == imsize]
+        for entry in candidates:
+            if entry['path'] == realpath and entry['mtime_ns'] == stat.st_mtime_ns and entry['bytes'] == stat.st_size:
+                return entry
+        sha1 = hash_file(filepath)
+        for entry in candidates:
+            if entry['sha1'] == sha1:
+                return entry
+        return None
+
+    def read(self, entry):
+        # Zero-copy view into the memory map
+        size = int(np.prod(entry['shape']))
+        return self.data[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+
+    def ingest(self, filepaths, imsizes, workers=None):
+        todo = [(filepath, imsize) for filepath in filepaths for imsize in imsizes
+                if self.find(filepath, imsize) is None]
+
+        def decode(job):
+            filepath, imsize = job
+            return decode_image(filepath, imsize), hash_file(filepath), os.stat(filepath)
+
+        os.makedirs(self.root, exist_ok=True)
+        offset = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        with ThreadPoolExecutor(workers) as executor, open(self.data_path, 'ab') as f:
+            for (filepath, imsize), (image, sha1, stat) in zip(todo, executor.map(decode, todo)):
+                f.write(image.tobytes())
+                self.entries.append({'path': os.path.realpath(filepath), 'sha1': sha1, 'imsize': imsize or 0,
+                                     'mtime_ns': stat.st_mtime_ns, 'bytes': stat.st_size,
+                                     'shape': list(image.shape), 'offset': offset})
+                offset += image.nbytes
+                logging.info(f'ingested {filepath} (imsize={imsize})')
+
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+        self._data = None
+        return len(todo)
+
+
+def load_stored_image(filepath, imsize):
+    # Returns the stored uint8 image or None
+    if FLAGS.image_store is None or not os.path.exists(os.path.join(FLAGS.image_store, 'index.json')):
+        return None
+    store = ImageStore(FLAGS.image_store)
+    entry = store.find(filepath, imsize)
+    if entry is None:
+        logging.info(f'{filepath} (imsize={imsize}) is not in the image store')
+        return None
+    return store.read(entry)
+
+
+def find_images(paths):
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                             if name.lower().endswith(IMAGE_EXTS))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+def main(argv):
+    del argv  # Unused.
+
+    filepaths = find_images(FLAGS.ingest)
+    imsizes = [int(imsize) for imsize in FLAGS.ingest_sizes or [0]]
+    store = ImageStore(FLAGS.image_store)
+    num_new = store.ingest(filepaths, imsizes, FLAGS.ingest_workers)
+    logging.info(f'ingested {num_new} new images into {FLAGS.image_store} '
+                 f'({len(store.entries)} images, {os.path.getsize(store.data_path) / 2 ** 20:.1f}MB)')
+
+
+if __name__ == '__main__':
+    app.run(main)
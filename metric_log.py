@@ -0,0 +1,87 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('log_every', 1, 'log the training metrics of every n-th epoch. the last epoch is always logged')
+flags.DEFINE_integer('log_flush', 100, 'number of logged epochs buffered in memory before writing them to disk')
+
+LOG_FILES = ['logs.json', 'logs.bin']
+
+
+class MetricLog:
+    # Float32 rows of the logged metrics appended to logs.bin, with the column names in logs.json.
+    # Rows are buffered and written in batches of flush rows
+    def __init__(self, out_dir, every=1, flush=100, append=False):
+        self.header_path = os.path.join(out_dir, 'logs.json')
+        self.data_path = os.path.join(out_dir, 'logs.bin')
+        self.every, self.flush_rows = every, flush
+        self.columns, self.rows = None, []
+        if append and os.path.exists(self.header_path):
+            with open(self.header_path) as f:
+                self.columns = json.load(f)['columns']
+            # An interrupted flush may have written a partial row
+            row_bytes = 4 * len(self.columns)
+            if os.path.exists(self.data_path) and os.path.getsize(self.data_path) % row_bytes:
+                with open(self.data_path, 'r+b') as f:
+                    f.truncate(os.path.getsize(self.data_path) // row_bytes * row_bytes)
+        else:
+            for filepath in [self.header_path, self.data_path]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+    def log(self, epoch, num_epochs, logs):
+        if (epoch + 1) % self.every != 0 and epoch + 1 != num_epochs:
+            return
+        if self.columns is None:
+            self.columns = ['epoch'] + sorted(logs.keys())
+            with open(self.header_path, 'w') as f:
+                json.dump({'columns': self.columns}, f)
+        row = {'epoch': epoch, **logs}
+        self.rows.append([float(row.get(column, np.nan)) for column in self.columns])
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            with open(self.data_path, 'ab') as f:
+                f.write(np.asarray(self.rows, np.float32).tobytes())
+            self.rows = []
+
+
+def read_logs(out_dir):
+    # Returns the logged metrics as a DataFrame or None
+    header_path, data_path = os.path.join(out_dir, 'logs.json'), os.path.join(out_dir, 'logs.bin')
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as f:
+        columns = json.load(f)['columns']
+    data = np.fromfile(data_path, np.float32) if os.path.exists(data_path) else np.zeros(0, np.float32)
+    num_rows = len(data) // len(columns)
+    logs_df = pd.DataFrame(data[:num_rows * len(columns)].reshape(num_rows, len(columns)), columns=columns)
+    logs_df['epoch'] = logs_df['epoch'].astype(int)
+    return logs_df
+
+
+def open_metric_log(out_dir, append=False):
+    return MetricLog(out_dir, FLAGS.log_every, FLAGS.log_flush, append)
+
+
+class MetricLogger(tf.keras.callbacks.Callback):
+    # Replaces the CSVLogger, which writes and flushes a text row of every metric each epoch
+    def __init__(self, out_dir, append=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metric_log = open_metric_log(out_dir, append)
+        logging.info(f'logging the metrics every {self.metric_log.every} epochs')
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.metric_log.log(epoch, self.params['epochs'], logs or {})
+
+    def on_train_end(self, logs=None):
+        self.metric_log.flush()
@@ -1,18 +1,40 @@
 import tensorflow as tf
-import tensorflow_addons as tfa
 from absl import flags
 from absl import logging
 
-from distributions import process_spatial_feats
-from model.layers import Preprocess, Standardize, PCA, FastICA
+from distributions import process_spatial_feats, sample_k
+from distributions.losses import WassLoss
+from distributions.metrics import StyleMetrics
+from model.layers import Preprocess, Standardize, PCA, FastICA, GroupedSNDense, FrozenConv2D, fold_transforms
+from profiling import PhaseTimer
+from weight_store import load_arrays
 
 FLAGS = flags.FLAGS
 
-flags.DEFINE_enum('start_image', 'rand', ['rand', 'black'], 'image initialization')
+START_IMAGES = ['rand', 'black', 'content', 'content_color', 'content_hist', 'content_wct']
+flags.DEFINE_enum('start_image', 'rand', START_IMAGES + ['nearest'],
+                  'image initialization. content_color, content_hist and content_wct start from the content image '
+                  'with the per channel mean and std, the per channel histograms, '
+                  'or the mean and covariance of the RGB values matched to the style image. '
+                  'nearest starts from the nearest image in the --warm_start_index')
+flags.DEFINE_enum('warm_start_fallback', 'rand', START_IMAGES, 'image initialization when --start_image=nearest '
+                                                               'finds no similar image')
 
 flags.DEFINE_enum('feat_model', 'vgg19', ['vgg19', 'nasnetlarge', 'fast'], 'feature model architecture')
 flags.DEFINE_integer('layers', 5, 'number of layers to use from the feature model')
 flags.DEFINE_enum('disc_model', None, ['mlp', 'fast'], 'discriminator model architecture (optional)')
+flags.DEFINE_integer('n_critic', 1, 'discriminator updates per generator update')
+flags.DEFINE_integer('disc_every', 1, 'update the discriminator every n generator steps')
+flags.DEFINE_list('disc_acc_bounds', None, 'low,high discriminator accuracies. skips the discriminator updates while '
+                                           'its last accuracy is at or outside these bounds (optional)')
+flags.DEFINE_integer('disc_max_skip', 50, 'maximum generator steps between discriminator updates with '
+                                          '--disc_acc_bounds')
+flags.register_validator('n_critic', lambda n: n >= 1, message='--n_critic must be at least 1')
+flags.register_validator('disc_every', lambda n: n >= 1, message='--disc_every must be at least 1')
+# Only vgg19 is built from the weight store, so the other feature models would silently load their Keras weights
+flags.register_multi_flags_validator(['weight_store', 'feat_model'],
+                                     lambda f: f['weight_store'] is None or f['feat_model'] == 'vgg19',
+                                     message='--weight_store only supports --feat_model=vgg19')
 
 flags.DEFINE_bool('shift', False, 'center the features based on the style features')
 flags.DEFINE_bool('scale', False, 'set the variance of the features to 1 based on the style features')
@@ -21,17 +43,41 @@ flags.DEFINE_integer('pca', None, 'reduce the feature dimensions with PCA (optio
 flags.DEFINE_integer('ica', None, 'reduce the feature dimensions with FastICA (optional)')
 flags.DEFINE_bool('whiten', False, 'whiten the components of PCA/ICA')
 
+VGG19_BLOCKS = [2, 2, 4, 4, 4]
+
+
+def make_stored_vgg19(root, output_names):
+    # VGG19 built from the memory-mapped weights of the weight store, up to the deepest of the output layers
+    weights = load_arrays(root, 'vgg19')
+    remaining = set(output_names)
+    inputs = tf.keras.Input([None, None, 3])
+    x = inputs
+    for block, num_convs in enumerate(VGG19_BLOCKS, start=1):
+        if block > 1:
+            x = tf.keras.layers.MaxPooling2D(2, name=f'block{block - 1}_pool')(x)
+        for i in range(1, num_convs + 1):
+            name = f'block{block}_conv{i}'
+            x = FrozenConv2D(weights[f'{name}/kernel'], weights[f'{name}/bias'], name=name)(x)
+            remaining.discard(name)
+            if not remaining:
+                return tf.keras.Model(inputs, x, name='vgg19')
+    raise ValueError(f'unknown vgg19 layers: {sorted(remaining)}')
+
 
 def make_feat_model(input_shape):
     style_input = tf.keras.Input(input_shape, name='style')
     content_input = tf.keras.Input(input_shape, name='content')
     if FLAGS.feat_model == 'vgg19':
         preprocess_fn = Preprocess(tf.keras.applications.vgg19.preprocess_input)
-        vgg19 = tf.keras.applications.VGG19(include_top=False)
-        vgg19.trainable = False
-
         content_layers = ['block5_conv2']
         style_layers = [f'block{i}_conv1' for i in range(1, FLAGS.layers + 1)]
+        if FLAGS.weight_store is not None:
+            vgg19 = make_stored_vgg19(FLAGS.weight_store, style_layers + content_layers)
+            logging.info(f'built vgg19 up to the deepest output layer from the weights in {FLAGS.weight_store}')
+        else:
+            vgg19 = tf.keras.applications.VGG19(include_top=False)
+        vgg19.trainable = False
+
         vgg_style_outputs = [vgg19.get_layer(name).output for name in style_layers]
         vgg_content_outputs = [vgg19.get_layer(name).output for name in content_layers]
 
@@ -85,80 +131,253 @@ def make_feat_model(input_shape):
     style_model = tf.keras.Model(style_input, style_output)
     content_model = tf.keras.Model(content_input, content_output)
     if FLAGS.shift or FLAGS.scale:
-        new_style_outputs = [Standardize(FLAGS.shift, FLAGS.scale)(output) for output in style_model.outputs]
-        new_content_outputs = [Standardize(FLAGS.shift, FLAGS.scale)(output) for output in content_model.outputs]
+        standardize_layers = {'style': [Standardize(FLAGS.shift, FLAGS.scale) for _ in style_model.outputs],
+                              'content': [Standardize(FLAGS.shift, FLAGS.scale) for _ in content_model.outputs]}
+        new_style_outputs = [layer(output) for layer, output in zip(standardize_layers['style'], style_model.outputs)]
+        new_content_outputs = [layer(output)
+                               for layer, output in zip(standardize_layers['content'], content_model.outputs)]
 
         sc_model = tf.keras.Model([style_model.input, content_model.input],
                                   {'style': new_style_outputs, 'content': new_content_outputs})
         logging.info('standardizing features')
     else:
+        standardize_layers = None
         sc_model = tf.keras.Model([style_model.input, content_model.input],
                                   {'style': style_model.outputs, 'content': content_model.outputs})
+    sc_model.standardize_layers = standardize_layers
     return sc_model
 
 
+def get_style_branch(feat_model):
+    # The style features of a style image alone, without running the content layers
+    return tf.keras.Model(feat_model.input[0], {'style': feat_model.output['style']})
+
+
+def get_backbone_feats(feat_model, feats, key):
+    # The style or content (key) features of make_feat_model's model before its standardize layers
+    if feat_model.standardize_layers is None:
+        return feats
+    return [layer.invert(layer_feats) for layer, layer_feats in zip(feat_model.standardize_layers[key], feats)]
+
+
+def fuse_feat_transforms(feat_model, transforms):
+    # Replaces the configured standardize and projection layers after each feature output
+    # with one affine transform, so the features are computed without conditionals or extra passes.
+    # transforms are the layers applied after each style and content output of the backbone, in order
+    all_new_outputs = {}
+    for key in ['style', 'content']:
+        new_outputs = []
+        for output, layers in zip(feat_model.output[key], transforms[key]):
+            if layers:
+                x = layers[0].input
+                output = fold_transforms(layers, x.shape[-1])(x)
+            new_outputs.append(output)
+        all_new_outputs[key] = new_outputs
+    return tf.keras.Model(feat_model.input, all_new_outputs)
+
+
+class Discriminator(tf.keras.Model):
+    # Per layer discriminators. Layers with the same feature width share batched weights,
+    # so their forward pass and spectral normalization run as one op per dense layer.
+    def __init__(self, feat_dims, arch, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.group_indices = []
+        for feat_dim in sorted(set(feat_dims)):
+            self.group_indices.append([i for i, d in enumerate(feat_dims) if d == feat_dim])
+
+        self.group_layers = []
+        for indices in self.group_indices:
+            feat_dim = feat_dims[indices[0]]
+            hdim = max(256, 2 * feat_dim)
+            if arch == 'fast':
+                dims = [feat_dim, 1]
+            elif arch == 'mlp':
+                dims = [feat_dim, hdim, hdim, hdim, 1]
+            else:
+                raise ValueError(f'unknown discriminator model: {arch}')
+            layers = [GroupedSNDense(len(indices), in_dim, out_dim) for in_dim, out_dim in zip(dims[:-1], dims[1:])]
+            for layer in layers:
+                layer.build(None)
+            self.group_layers.append(layers)
+
+    def call(self, inputs, training=None, mask=None):
+        # Returns the logits of every group with the layers stacked in front [layers, batch, locations, 1].
+        # Group members with different numbers of locations are returned separately
+        outputs = []
+        for indices, layers in zip(self.group_indices, self.group_layers):
+            if training:
+                for layer in layers:
+                    layer.normalize_weights()
+
+            feats = [inputs[i] for i in indices]
+            shapes = [f.shape for f in feats]
+            if shapes[0].is_fully_defined() and all(shape == shapes[0] for shape in shapes):
+                outputs.append(self.apply_group(layers, tf.stack(feats)))
+            else:
+                for j, f in enumerate(feats):
+                    outputs.append(self.apply_group(layers, f[None], members=slice(j, j + 1)))
+        return outputs
+
+    @staticmethod
+    def apply_group(layers, x, members=None):
+        for layer in layers[:-1]:
+            x = tf.nn.relu(layer(x, members=members))
+        return layers[-1](x, members=members)
+
+
 def make_discriminator(feat_model):
     if FLAGS.disc_model is None:
         return None
 
-    inputs, outputs = [], []
-    for style_output in feat_model.output['style']:
-        input_shape = style_output.shape[1:]
-        feat_dim = input_shape[-1]
-        hdim = max(256, 2 * feat_dim)
-        if FLAGS.disc_model == 'fast':
-            layer_disc = tf.keras.Sequential([
-                tfa.layers.SpectralNormalization(tf.keras.layers.Dense(1)),
-            ])
-        elif FLAGS.disc_model == 'mlp':
-            layer_disc = tf.keras.Sequential([
-                tfa.layers.SpectralNormalization(tf.keras.layers.Dense(hdim)),
-                tf.keras.layers.ReLU(),
-                tfa.layers.SpectralNormalization(tf.keras.layers.Dense(hdim)),
-                tf.keras.layers.ReLU(),
-                tfa.layers.SpectralNormalization(tf.keras.layers.Dense(hdim)),
-                tf.keras.layers.ReLU(),
-                tfa.layers.SpectralNormalization(tf.keras.layers.Dense(1)),
-            ])
-        else:
-            raise ValueError(f'unknown discriminator model: {FLAGS.disc_model}')
-        input = tf.keras.Input([input_shape[0] * input_shape[1], feat_dim])
-        output = layer_disc(input)
-        inputs.append(input)
-        outputs.append(output)
-    return tf.keras.Model(inputs, outputs)
+    feat_dims = [style_output.shape[-1] for style_output in feat_model.output['style']]
+    return Discriminator(feat_dims, FLAGS.disc_model)
+
+
+def match_color(image, style_image):
+    # Per channel mean and std
+    mean, var = tf.nn.moments(image, axes=[0, 1, 2])
+    style_mean, style_var = tf.nn.moments(style_image, axes=[0, 1, 2])
+    return (image - mean) * tf.sqrt((style_var + 1e-5) / (var + 1e-5)) + style_mean
+
+
+def match_histograms(image, style_image):
+    # Maps the rank of every pixel to the style's value at the same quantile, per channel
+    pixels = tf.transpose(tf.reshape(image, [-1, 3]))
+    style_pixels = tf.sort(tf.transpose(tf.reshape(style_image, [-1, 3])), axis=-1)
+    n, style_n = tf.shape(pixels, tf.int64)[1], tf.shape(style_pixels, tf.int64)[1]
+    # In int64, since ranks * style_n overflows int32 beyond about 46k pixels
+    ranks = tf.cast(tf.argsort(tf.argsort(pixels, axis=-1), axis=-1), tf.int64)
+    quantiles = (ranks * style_n) // n
+    matched = tf.gather(style_pixels, quantiles, batch_dims=1)
+    return tf.reshape(tf.transpose(matched), tf.shape(image))
+
+
+def _sqrtm(covar, inverse=False):
+    e, v = tf.linalg.eigh(covar)
+    e = tf.maximum(e, 1e-5)
+    e = tf.math.rsqrt(e) if inverse else tf.sqrt(e)
+    return tf.matmul(v * e, v, transpose_b=True)
+
+
+def transfer_moments(image, style_image):
+    # Whitening and coloring transform of the RGB values.
+    # Without a decoder for the feature space, the moments are matched in the image space
+    pixels = tf.reshape(image, [-1, 3])
+    style_pixels = tf.reshape(style_image, [-1, 3])
+    mean = tf.reduce_mean(pixels, axis=0)
+    style_mean = tf.reduce_mean(style_pixels, axis=0)
+    centered, style_centered = pixels - mean, style_pixels - style_mean
+    covar = tf.matmul(centered, centered, transpose_a=True) / tf.cast(tf.shape(pixels)[0], pixels.dtype)
+    style_covar = tf.matmul(style_centered, style_centered, transpose_a=True) / tf.cast(tf.shape(style_pixels)[0],
+                                                                                          pixels.dtype)
+    transform = tf.matmul(_sqrtm(covar, inverse=True), _sqrtm(style_covar))
+    return tf.reshape(tf.matmul(centered, transform) + style_mean, tf.shape(image))
+
+
+def make_content_start_image(start_image, style_image, content_image):
+    if start_image == 'content':
+        return content_image
+    elif start_image == 'content_color':
+        return match_color(content_image, style_image)
+    elif start_image == 'content_hist':
+        return match_histograms(content_image, style_image)
+    elif start_image == 'content_wct':
+        return transfer_moments(content_image, style_image)
+    raise ValueError(f'unknown start image: {start_image}')
+
+
+def make_start_image(start_image, shape, dtype, style_image=None, content_image=None, warm_start_image=None):
+    if start_image == 'nearest':
+        image = tf.cast(warm_start_image, dtype)
+    elif start_image == 'rand':
+        image = tf.random.uniform(shape, maxval=255, dtype=dtype)
+    elif start_image == 'black':
+        image = tf.zeros(shape, dtype)
+    else:
+        image = make_content_start_image(start_image, tf.cast(style_image, dtype), tf.cast(content_image, dtype))
+    return tf.clip_by_value(image, 0, 255)
+
+
+def _to_float32(logits):
+    # Low precision policies output low precision logits
+    return tf.nest.map_structure(lambda x: tf.cast(x, tf.float32), logits)
+
+
+def _build_optimizer(optimizer, var_list):
+    if hasattr(optimizer, 'build'):
+        optimizer.build(var_list)
+    else:
+        optimizer._create_all_weights(var_list)
+
+
+def _scale_loss(optimizer, loss):
+    # Keras wraps the optimizers with loss scaling under the mixed_float16 policy
+    if hasattr(optimizer, 'get_scaled_loss'):
+        loss = optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def _unscale_grads(optimizer, grads):
+    if hasattr(optimizer, 'get_unscaled_gradients'):
+        grads = optimizer.get_unscaled_gradients(grads)
+    return grads
 
 
 class SCModel(tf.keras.Model):
-    def __init__(self, feat_model, sample_size, loss_warmup, *args, **kwargs):
+    def __init__(self, feat_model, sample_size, loss_warmup, profile_every=0, disc_sample_size=None,
+                 *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.feat_model = feat_model
         self.sample_size = sample_size
+        self.disc_sample_size = disc_sample_size or sample_size
+        self.phase_timer = PhaseTimer(profile_every)
         self.bce_loss = tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
         self.loss_warmup = tf.Variable(loss_warmup, trainable=False, dtype=self.dtype)
         self.curr_step = tf.Variable(0, trainable=False, dtype=self.dtype)
+        self.targets = None
+        self.sort_sharers = []
+        # Loss metrics of the style layers whose losses the steps compute from the shared sorts
+        self.shared_loss_metrics = [tf.keras.metrics.Mean(f'style_{i + 1}_loss')
+                                    for i in range(len(feat_model.output['style']))]
+
+        # Discriminator schedule state
+        aggregation = tf.VariableAggregation.ONLY_FIRST_REPLICA
+        self.last_d_loss = tf.Variable(0, trainable=False, dtype=tf.float32, aggregation=aggregation)
+        self.last_d_acc = tf.Variable(0, trainable=False, dtype=tf.float32, aggregation=aggregation)
+        self.disc_updates = tf.Variable(0, trainable=False, dtype=tf.int64, aggregation=aggregation)
+        self.disc_skips = tf.Variable(0, trainable=False, dtype=tf.int64, aggregation=aggregation)
+        self.n_critic, self.disc_every, self.disc_acc_bounds, self.disc_max_skip = 1, 1, None, 0
 
     def build(self, input_shape):
         if FLAGS.start_image == 'rand':
             initializer = tf.keras.initializers.RandomUniform(minval=0, maxval=255)
         else:
-            assert FLAGS.start_image == 'black'
+            # The content based images are set by reinit_gen_image
             initializer = tf.keras.initializers.Zeros()
         logging.info(f'initialzed gen image with {initializer.__class__.__name__}')
         shape = input_shape[0]
         self.gen_image = self.add_weight('gen_image', shape, initializer=initializer)
+        self.built = True
 
-    def configure(self, style_image, content_image):
+    def configure(self, style_image, content_image, feats_dict=None):
+        # feats_dict are the features of the style and content images if they were already computed
+        # (e.g. loaded from the --feat_cache), which also configured the standardize layers
         feat_model = self.feat_model
 
         # Configure the standardize layers if any
         # Standardize layers before building the generated image
         # or else the standardize layers will be configured on the gen image
-        logging.info(f'configuring standardize layers (shift={FLAGS.shift}, scale={FLAGS.scale})')
-        feats_dict = feat_model((style_image, content_image))
+        if feats_dict is None:
+            logging.info(f'configuring standardize layers (shift={FLAGS.shift}, scale={FLAGS.scale})')
+            feats_dict = feat_model((style_image, content_image))
+
+        # Build the gen image without running the feature model on it
+        self.build([style_image.shape, content_image.shape])
 
-        # Build the gen image
-        self((style_image, content_image))
+        # The standardize and projection layers after each output of the backbone
+        transforms = {key: [[] for _ in feat_model.output[key]] for key in ['style', 'content']}
+        if feat_model.standardize_layers is not None:
+            transforms = {key: [[layer] for layer in layers] for key, layers in feat_model.standardize_layers.items()}
 
         # Add and configure the PCA layers if requested
         if (FLAGS.pca is not None and FLAGS.pca > 0) or (FLAGS.ica is not None and FLAGS.ica > 0):
@@ -168,12 +387,13 @@ class SCModel(tf.keras.Model):
 
             for key in ['style', 'content']:
                 new_outputs = []
-                for old_output, feats, in zip(feat_model.output[key], feats_dict[key]):
+                for old_output, feats, layers in zip(feat_model.output[key], feats_dict[key], transforms[key]):
                     n_samples = old_output.shape[1] * old_output.shape[2]
                     n_features = old_output.shape[-1]
                     proj = ProjClass(min(proj_dim, n_features, n_samples))
                     new_outputs.append(proj(old_output))
                     proj.configure(feats)
+                    layers.append(proj)
                 all_new_outputs.append(new_outputs)
 
             new_feat_model = tf.keras.models.Model(feat_model.input,
@@ -182,22 +402,62 @@ class SCModel(tf.keras.Model):
 
             self.feat_model = new_feat_model
 
+        if FLAGS.shift or FLAGS.scale or self.feat_model is not feat_model:
+            self.feat_model = fuse_feat_transforms(self.feat_model, transforms)
+            logging.info('fused the feature transforms')
+
         # Add discriminator if requested
         if FLAGS.disc_model is not None:
             self.discriminator = make_discriminator(self.feat_model)
             logging.info(f'added discriminator')
+            self.n_critic, self.disc_every, self.disc_max_skip = FLAGS.n_critic, FLAGS.disc_every, FLAGS.disc_max_skip
+            if FLAGS.disc_acc_bounds is not None:
+                self.disc_acc_bounds = tuple(float(bound) for bound in FLAGS.disc_acc_bounds)
+            if self.disc_scheduled and tf.distribute.get_strategy().num_replicas_in_sync > 1:
+                # The optimizer can't synchronize the replicas from inside a conditional branch
+                raise ValueError('--disc_every and --disc_acc_bounds are only supported on a single replica')
+            logging.info(f'discriminator schedule: n_critic={self.n_critic}, disc_every={self.disc_every}, '
+                         f'acc_bounds={self.disc_acc_bounds}, disc_sample_size={self.disc_sample_size}')
 
     def compile(self, disc_opt, gen_opt, *args, **kwargs):
+        # The Wasserstein loss and the style metrics of a style layer sort the same features,
+        # so the steps sort them once and pass the sorts to both.
+        # The compiled loss leaves out the sharing layers, and the steps add their losses to it
+        self.sort_sharers = []
+        loss, metrics = kwargs.get('loss'), kwargs.get('metrics')
+        if isinstance(loss, dict) and isinstance(metrics, dict):
+            for layer_loss, layer_metrics in zip(loss.get('style', []), metrics.get('style', [])):
+                layer_metrics = tf.nest.flatten(layer_metrics)
+                shared = isinstance(layer_loss, WassLoss) and any(isinstance(m, StyleMetrics) for m in layer_metrics)
+                self.sort_sharers.append((layer_loss, layer_metrics) if shared else None)
+        if any(self.sort_sharers):
+            kwargs['loss'] = {**loss, 'style': [None if sharers else layer_loss
+                                                for sharers, layer_loss in zip(self.sort_sharers, loss['style'])]}
         super().compile(gen_opt, *args, **kwargs)
         if disc_opt is not None:
             self.disc_opt = self._get_optimizer(disc_opt)
             logging.info(f'discriminator optimizer: {disc_opt.__class__.__name__}')
+            if hasattr(self, 'discriminator'):
+                # Scheduled updates run the optimizer in a conditional branch, which can't create the slots
+                _build_optimizer(self.disc_opt, self.discriminator.trainable_weights)
 
         gen_opt = self.optimizer
         logging.info(f'generator optimizer: {gen_opt.__class__.__name__}')
 
-    def reinit_gen_image(self):
-        self.gen_image.assign(tf.random.uniform(self.gen_image.shape, maxval=255, dtype=self.gen_image.dtype))
+    @property
+    def metrics(self):
+        # Only the loss metrics of the layers that currently share their sorts, the compiled loss has the others
+        shared = [m for m, sharers in zip(self.shared_loss_metrics, self.sort_sharers) if sharers]
+        return [m for m in super().metrics if all(m is not s for s in self.shared_loss_metrics)] + shared
+
+    def reinit_gen_image(self, style_image=None, content_image=None, warm_start_image=None):
+        start_image = FLAGS.start_image
+        if start_image == 'nearest' and warm_start_image is None:
+            start_image = FLAGS.warm_start_fallback
+        image = make_start_image(start_image, self.gen_image.shape, self.gen_image.dtype, style_image, content_image,
+                                 warm_start_image)
+        self.gen_image.assign(image)
+        logging.info(f'initialized gen image with {start_image}')
 
     def call(self, inputs, training=None, mask=None):
         return self.feat_model((self.gen_image, self.gen_image), training=training)
@@ -209,34 +469,92 @@ class SCModel(tf.keras.Model):
                      'content': [process_spatial_feats(f, sample_size) for f in gen_feats['content']]}
         return feats, gen_feats
 
+    def sort_style_feats(self, feats, gen_feats):
+        # The sorted (style, generated) features of each style layer whose loss and metrics share them
+        return [sharers[0].sort_feats(f, g) if sharers else None
+                for sharers, f, g in zip(self.sort_sharers, feats['style'], gen_feats['style'])]
+
+    def compute_loss_from_sorted(self, feats, gen_feats, sorted_feats):
+        # The losses of the sharing layers are added to the compiled loss like regularization losses
+        shared_losses = []
+        for sharers, layer_sorts, loss_metric in zip(self.sort_sharers, sorted_feats, self.shared_loss_metrics):
+            if sharers:
+                layer_loss = _to_float32(tf.reduce_mean(sharers[0].compute_from_sorted(*layer_sorts)))
+                loss_metric.update_state(layer_loss)
+                shared_losses.append(layer_loss)
+        return self.compiled_loss(feats, gen_feats, regularization_losses=self.losses + shared_losses)
+
+    def update_metrics_from_sorted(self, feats, gen_feats, sorted_feats):
+        # The compiled metrics skip the outputs without targets, which are the sharing layers
+        targets = feats
+        if any(self.sort_sharers):
+            targets = {**feats, 'style': [None if sharers else f for sharers, f in zip(self.sort_sharers,
+                                                                                      feats['style'])]}
+        self.compiled_metrics.update_state(targets, gen_feats)
+        for sharers, y_true, y_pred, layer_sorts in zip(self.sort_sharers, feats['style'], gen_feats['style'],
+                                                        sorted_feats):
+            if sharers:
+                for metric in sharers[1]:
+                    if isinstance(metric, StyleMetrics):
+                        metric.update_state(y_true, y_pred, sorted_feats=layer_sorts)
+                    else:
+                        metric.update_state(y_true, y_pred)
+
+    def set_targets(self, images, feats):
+        # Holds the fixed style/content images and features in the model, so the steps don't need any data.
+        # New variables are made since the raw and projected features have different shapes
+        targets = {'images': list(images), 'feats': feats}
+        self.targets = tf.nest.map_structure(lambda x: tf.Variable(x, trainable=False), targets)
+
+    def unpack_data(self, data):
+        if self.targets is None:
+            return data
+        targets = tf.nest.map_structure(lambda v: v.value(), self.targets)
+        return tuple(targets['images']), targets['feats']
+
     def test_step(self, data):
-        images, feats = data
+        images, feats = self.unpack_data(data)
         gen_feats = self(images, training=False)
         feats, gen_feats = self.process_spatial_feats(feats, gen_feats)
 
         # Updates stateful loss metrics.
-        self.compiled_loss(
-            feats, gen_feats, regularization_losses=self.losses)
+        sorted_feats = self.sort_style_feats(feats, gen_feats)
+        self.compute_loss_from_sorted(feats, gen_feats, sorted_feats)
 
-        self.compiled_metrics.update_state(feats, gen_feats)
-        return {m.name: m.result() for m in self.metrics}
+        self.update_metrics_from_sorted(feats, gen_feats, sorted_feats)
+        return self.get_metric_results()
 
     def train_step(self, data):
-        images, feats = data
+        images, feats = self.unpack_data(data)
+        self.phase_timer.start([images, feats])
 
         # Train the discriminator
         d_metrics = {}
         if hasattr(self, 'discriminator'):
-            d_metrics = self.disc_step(images, feats)
+            if self.disc_scheduled:
+                d_metrics = self.scheduled_disc_step(images, feats)
+            else:
+                d_metrics = self.disc_step(images, feats)
 
         # Train the generated image
         self.gen_step(images, feats)
 
         # Clip to RGB range
         self.gen_image.assign(tf.clip_by_value(self.gen_image, 0, 255))
+        self.phase_timer.mark('clip', self.gen_image)
+        self.phase_timer.record()
 
         # Return a dict mapping metric names to current value + the discriminator loss
-        return {**{m.name: m.result() for m in self.metrics}, **d_metrics}
+        return {**self.get_metric_results(), **d_metrics}
+
+    def get_metric_results(self):
+        results = {}
+        for m in self.metrics:
+            if hasattr(m, 'named_results'):
+                results.update(m.named_results())
+            else:
+                results[m.name] = m.result()
+        return results
 
     def get_loss_warmup_alpha(self):
         alpha = tf.ones_like(self.curr_step / self.loss_warmup)
@@ -245,61 +563,113 @@ class SCModel(tf.keras.Model):
                         lambda: tf.minimum(alpha, self.curr_step / self.loss_warmup))
         return alpha
 
+    def get_disc_losses(self, logits, label):
+        # Per layer cross entropy and accuracy, reduced over each group of stacked layer logits at once
+        losses, accs = [], []
+        for group_logits in logits:
+            labels = tf.fill(tf.shape(group_logits), tf.constant(label, group_logits.dtype))
+            losses.append(tf.reduce_mean(self.bce_loss(labels, group_logits), axis=[1, 2]))
+            accs.append(tf.reduce_mean(tf.keras.metrics.binary_accuracy(labels, group_logits, threshold=0),
+                                       axis=[1, 2]))
+        return tf.concat(losses, axis=0), tf.concat(accs, axis=0)
+
     def gen_step(self, images, feats):
         alpha = self.get_loss_warmup_alpha()
         self.curr_step.assign_add(tf.ones_like(self.curr_step))
         with tf.GradientTape() as tape:
             # Compute generated features
             gen_feats = self(images, training=False)
+            self.phase_timer.mark('gen_feats', gen_feats)
 
             # Process the feats
             feats, gen_feats = self.process_spatial_feats(feats, gen_feats, self.sample_size)
-            loss = alpha * self.compiled_loss(feats, gen_feats, regularization_losses=self.losses)
+            self.phase_timer.mark('process_feats', gen_feats)
+            sorted_feats = self.sort_style_feats(feats, gen_feats)
+            loss = alpha * self.compute_loss_from_sorted(feats, gen_feats, sorted_feats)
+            self.phase_timer.mark('loss', loss)
 
             # Add discriminator loss if any
             if hasattr(self, 'discriminator'):
-                d_logits = self.discriminator(gen_feats['style'], training=True)
-                if isinstance(d_logits, list):
-                    gen_loss = [tf.reduce_mean(self.bce_loss(tf.ones_like(logits), logits)) for logits in d_logits]
-                    gen_loss = tf.reduce_sum(gen_loss)
-                else:
-                    gen_loss = tf.reduce_mean(self.bce_loss(tf.ones_like(d_logits), d_logits))
+                d_feats = [sample_k(f, self.disc_sample_size) for f in gen_feats['style']]
+                d_logits = _to_float32(self.discriminator(d_feats, training=True))
+                gen_loss, _ = self.get_disc_losses(d_logits, label=1)
+                gen_loss = tf.reduce_sum(gen_loss)
                 loss += gen_loss
+                self.phase_timer.mark('adversarial', loss)
+            scaled_loss = _scale_loss(self.optimizer, loss)
         # Optimize generated image
-        grad = tape.gradient(loss, [self.gen_image])
+        grad = _unscale_grads(self.optimizer, tape.gradient(scaled_loss, [self.gen_image]))
+        self.phase_timer.mark('backward', grad)
         self.optimizer.apply_gradients(zip(grad, [self.gen_image]))
+        self.phase_timer.mark('apply', self.gen_image)
 
         # Update metrics
-        self.compiled_metrics.update_state(feats, gen_feats)
+        self.update_metrics_from_sorted(feats, gen_feats, sorted_feats)
+        self.phase_timer.mark('metrics', [m.variables for m in self.compiled_metrics.metrics])
+
+    @property
+    def disc_scheduled(self):
+        return self.disc_every > 1 or self.disc_acc_bounds is not None
+
+    def should_update_disc(self):
+        update = tf.equal(tf.math.floormod(self.curr_step, tf.cast(self.disc_every, self.curr_step.dtype)), 0)
+        if self.disc_acc_bounds is not None:
+            # Skip while the discriminator is saturated or no better than chance,
+            # but re-measure its accuracy at least every disc_max_skip steps
+            low, high = self.disc_acc_bounds
+            informative = tf.logical_and(self.last_d_acc > low, self.last_d_acc < high)
+            stale = tf.logical_or(tf.equal(self.disc_updates, 0), self.disc_skips >= self.disc_max_skip)
+            update = tf.logical_and(update, tf.logical_or(informative, stale))
+        return update
+
+    def scheduled_disc_step(self, images, feats):
+        def update():
+            d_metrics = self.disc_step(images, feats)
+            return d_metrics['d_loss'], d_metrics['d_acc']
+
+        def skip():
+            self.disc_skips.assign_add(1)
+            return tf.identity(self.last_d_loss), tf.identity(self.last_d_acc)
+
+        # Timestamps can't leave the conditional branch, so the whole update is timed as one phase
+        with self.phase_timer.suspended():
+            d_loss, d_acc = tf.cond(self.should_update_disc(), update, skip)
+        self.phase_timer.mark('disc_scheduled', [d_loss, d_acc])
+        return {'d_loss': d_loss, 'd_acc': d_acc, 'd_updates': self.disc_updates.value()}
 
     def disc_step(self, images, feats):
+        # The generated image doesn't change between the critic updates, so its features are only computed once
         gen_feats = self(images, training=False)
-        feats, gen_feats = self.process_spatial_feats(feats, gen_feats, self.sample_size)
+        real_feats = [process_spatial_feats(f, None) for f in feats['style']]
+        gen_feats = [process_spatial_feats(f, None) for f in gen_feats['style']]
+        for _ in range(self.n_critic):
+            d_loss, d_acc = self.critic_update([sample_k(f, self.disc_sample_size) for f in real_feats],
+                                               [sample_k(f, self.disc_sample_size) for f in gen_feats])
+
+        self.last_d_loss.assign(d_loss)
+        self.last_d_acc.assign(d_acc)
+        self.disc_updates.assign_add(1)
+        self.disc_skips.assign(0)
+        return {'d_loss': d_loss, 'd_acc': d_acc}
+
+    def critic_update(self, real_feats, gen_feats):
+        self.phase_timer.mark('disc_feats', gen_feats)
         with tf.GradientTape() as tape:
-            real_logits = self.discriminator(feats['style'], training=True)
-            gen_logits = self.discriminator(gen_feats['style'], training=True)
-            if isinstance(real_logits, list):
-                d_loss, d_acc = 0, 0
-                for rl, gl in zip(real_logits, gen_logits):
-                    d_loss += tf.reduce_mean(self.bce_loss(tf.ones_like(rl), rl) + self.bce_loss(tf.zeros_like(gl), gl))
-                    d_acc += tf.reduce_mean(tf.keras.metrics.binary_accuracy(tf.ones_like(rl), rl, threshold=0))
-                    d_acc += tf.reduce_mean(tf.keras.metrics.binary_accuracy(tf.zeros_like(gl), gl, threshold=0))
-                d_loss = tf.reduce_sum(d_loss)
-                d_acc /= (len(real_logits) * 2)
-            else:
-                real_loss = tf.reduce_mean(self.bce_loss(tf.ones_like(real_logits), real_logits))
-                gen_loss = tf.reduce_mean(self.bce_loss(tf.zeros_like(gen_logits), gen_logits))
-                d_loss = real_loss + gen_loss
-                d_acc = (
-                        0.5 * tf.reduce_mean(
-                    tf.keras.metrics.binary_accuracy(tf.ones_like(real_logits), real_logits, threshold=0)) +
-                        0.5 * tf.reduce_mean(
-                    tf.keras.metrics.binary_accuracy(tf.zeros_like(gen_logits), gen_logits, threshold=0))
-                )
-        d_grads = tape.gradient(d_loss, self.discriminator.trainable_weights)
+            # Real and generated features go through the discriminator together
+            both_feats = [tf.concat([real, gen], axis=0) for real, gen in zip(real_feats, gen_feats)]
+            logits = _to_float32(self.discriminator(both_feats, training=True))
+            real_logits, gen_logits = zip(*[tf.split(group_logits, 2, axis=1) for group_logits in logits])
+            real_loss, real_acc = self.get_disc_losses(real_logits, label=1)
+            gen_loss, gen_acc = self.get_disc_losses(gen_logits, label=0)
+            d_loss = tf.reduce_sum(real_loss + gen_loss)
+            d_acc = tf.reduce_mean(tf.concat([real_acc, gen_acc], axis=0))
+            scaled_d_loss = _scale_loss(self.disc_opt, d_loss)
+        self.phase_timer.mark('disc_forward', [d_loss, d_acc])
+        d_grads = _unscale_grads(self.disc_opt, tape.gradient(scaled_d_loss, self.discriminator.trainable_weights))
+        self.phase_timer.mark('disc_backward', d_grads)
         self.disc_opt.apply_gradients(zip(d_grads, self.discriminator.trainable_weights))
-
-        return {'d_loss': d_loss, 'd_acc': d_acc}
+        self.phase_timer.mark('disc_apply', self.discriminator.trainable_weights)
+        return d_loss, d_acc
 
     def get_gen_image(self):
         return tf.constant(tf.cast(self.gen_image, tf.uint8))
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from absl import flags
 from sklearn import decomposition
@@ -41,6 +42,22 @@ class Standardize(tf.keras.layers.Layer):
             self.configured.assign(tf.ones_like(self.configured))
         return (inputs - self.mean) * tf.math.rsqrt(self.variance + 1e-5)
 
+    def invert(self, outputs):
+        # The features before standardization, in float32
+        return tf.cast(outputs, tf.float32) * tf.math.sqrt(self.variance + 1e-5) + self.mean
+
+
+class FrozenConv2D(tf.keras.layers.Layer):
+    # Same padded convolution with ReLU, like the VGG19 layers, with constant kernel and bias tensors.
+    # Unlike variables, the tensors aren't copied, so they can alias memory-mapped weights
+    def __init__(self, kernel, bias, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kernel, self.bias = kernel, bias
+
+    def call(self, inputs, **kwargs):
+        x = tf.nn.conv2d(inputs, tf.cast(self.kernel, inputs.dtype), strides=1, padding='SAME')
+        return tf.nn.relu(tf.nn.bias_add(x, tf.cast(self.bias, inputs.dtype)))
+
 
 class PCA(tf.keras.layers.Layer):
     def __init__(self, out_dim, *args, **kwargs):
@@ -98,3 +115,92 @@ class FastICA(tf.keras.layers.Layer):
         x = inputs - self.mean
         components = tf.einsum('bhwc,cd->bhwd', x, self.projection)
         return tf.concat([inputs, components], axis=-1)
+
+
+class AffineTransform(tf.keras.layers.Layer):
+    # Configured standardize and projection layers folded into one frozen transform without control flow.
+    # Outputs the standardized features x * scale + bias, concatenated with their components x @ kernel + kernel_bias
+    # if there is a projection
+    def __init__(self, scale, bias, kernel=None, kernel_bias=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_values = {'scale': scale, 'bias': bias, 'kernel': kernel, 'kernel_bias': kernel_bias}
+
+    def build(self, input_shape):
+        for name, value in self.init_values.items():
+            weight = None
+            if value is not None:
+                weight = self.add_weight(name, value.shape, trainable=False,
+                                         initializer=tf.keras.initializers.Constant(value))
+            setattr(self, name, weight)
+
+    def call(self, inputs, **kwargs):
+        x = inputs * self.scale + self.bias
+        if self.kernel is None:
+            return x
+        components = tf.einsum('bhwc,cd->bhwd', inputs, self.kernel) + self.kernel_bias
+        return tf.concat([x, components], axis=-1)
+
+
+def fold_transforms(transforms, feat_dim):
+    # Folds a chain of configured Standardize, PCA and FastICA layers into an AffineTransform.
+    # The folding is done in float64 so the outputs match the chain up to float32 rounding
+    scale, bias = np.ones(feat_dim), np.zeros(feat_dim)
+    kernel = kernel_bias = None
+    for layer in transforms:
+        if kernel is not None:
+            raise ValueError(f'can only fold one projection at the end of the transforms, not before {layer.name}')
+        if isinstance(layer, Standardize):
+            mean = np.reshape(layer.mean.numpy(), [-1]).astype(np.float64)
+            rstd = 1 / np.sqrt(np.reshape(layer.variance.numpy(), [-1]).astype(np.float64) + 1e-5)
+            scale, bias = scale * rstd, (bias - mean) * rstd
+        elif isinstance(layer, (PCA, FastICA)):
+            mean = np.reshape(layer.mean.numpy(), [-1]).astype(np.float64)
+            projection = layer.projection.numpy().astype(np.float64)
+            kernel, kernel_bias = scale[:, None] * projection, (bias - mean) @ projection
+        else:
+            raise ValueError(f'cannot fold {layer.name}')
+    values = [value if value is None else value.astype(np.float32) for value in [scale, bias, kernel, kernel_bias]]
+    return AffineTransform(*values)
+
+
+class GroupedSNDense(tf.keras.layers.Layer):
+    # A group of independent spectrally normalized dense layers, applied with one batched matmul.
+    # Like tfa.layers.SpectralNormalization, training calls normalize the kernels in place.
+    def __init__(self, num_groups, in_dim, units, power_iterations=1, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_groups, self.in_dim, self.units = num_groups, in_dim, units
+        self.power_iterations = power_iterations
+
+    def build(self, input_shape):
+        def kernel_initializer(shape, dtype=None):
+            # Glorot uniform with the fans of each member. One draw, so the members start independently
+            limit = (6 / (self.in_dim + self.units)) ** 0.5
+            return tf.random.uniform(shape, -limit, limit, dtype=dtype)
+
+        self.kernel = self.add_weight('kernel', [self.num_groups, self.in_dim, self.units],
+                                      initializer=kernel_initializer)
+        self.bias = self.add_weight('bias', [self.num_groups, 1, 1, self.units], initializer='zeros')
+        self.u = self.add_weight('sn_u', [self.num_groups, 1, self.units], trainable=False,
+                                 initializer=tf.keras.initializers.TruncatedNormal(stddev=0.02))
+        super().build(input_shape)
+
+    def normalize_weights(self):
+        w = tf.cast(self.kernel, tf.float32)
+        u = tf.cast(self.u, tf.float32)
+        for _ in range(self.power_iterations):
+            v = tf.math.l2_normalize(tf.matmul(u, w, transpose_b=True), axis=[1, 2])
+            u = tf.math.l2_normalize(tf.matmul(v, w), axis=[1, 2])
+        u, v = tf.stop_gradient(u), tf.stop_gradient(v)
+        sigma = tf.matmul(tf.matmul(v, w), u, transpose_b=True)
+        self.u.assign(tf.cast(u, self.u.dtype))
+        self.kernel.assign(tf.cast(w / sigma, self.kernel.dtype))
+
+    def call(self, inputs, members=None, **kwargs):
+        # Inputs are [groups, batch, locations, features]. Members selects a slice of the groups
+        kernel, bias = self.kernel, self.bias
+        if members is not None:
+            kernel, bias = kernel[members], bias[members]
+        shape = tf.shape(inputs)
+        x = tf.reshape(inputs, [shape[0], shape[1] * shape[2], shape[3]])
+        x = tf.matmul(x, kernel)
+        return tf.reshape(x, [shape[0], shape[1], shape[2], self.units]) + bias
@@ -0,0 +1,162 @@
+import json
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+import benchmark
+import sweep
+import utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('packer_jobs', None, 'file with the run.py flags of one transfer job per line')
+flags.DEFINE_string('packer_dir', 'out/packer', 'directory of the jobs and the report')
+flags.DEFINE_integer('packer_workers', None, 'concurrent jobs. calibrated from the train step speed if not set')
+flags.DEFINE_integer('packer_calibrate_iters', 5, 'timed train steps per worker in the calibration runs')
+flags.DEFINE_bool('packer_calibrate', False, 'internal. time the train step of the job flags and print the steps '
+                                             'per second')
+
+PACKER_SCRIPT = os.path.abspath(__file__)
+
+
+def read_jobs(filepath):
+    jobs = []
+    with open(filepath) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                jobs.append(shlex.split(line))
+    return jobs
+
+
+def get_cpu_sets(num_workers, cpus=None):
+    # Contiguous disjoint sets of the available cores, so neighbouring cores (and their caches) stay together
+    cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+    size = len(cpus) // num_workers
+    if size == 0:
+        raise ValueError(f'cannot pack {num_workers} workers on {len(cpus)} cores')
+    return [cpus[i * size:(i + 1) * size] for i in range(num_workers)]
+
+
+def get_candidate_workers(num_cpus, num_jobs):
+    candidates, workers = [], 1
+    while workers <= min(num_cpus, num_jobs):
+        candidates.append(workers)
+        workers *= 2
+    return candidates
+
+
+def make_worker_launch(cpus):
+    # Pins the subprocess to its cores with matching thread counts
+    def preexec_fn():
+        os.sched_setaffinity(0, cpus)
+
+    args = [f'--intra_threads={len(cpus)}', f'--inter_threads={sweep.get_inter_threads(len(cpus))}']
+    return args, sweep.get_thread_env(len(cpus)), preexec_fn
+
+
+def calibrate(base_args, num_workers):
+    # Runs every worker at once, so the measured speed includes the contention for memory bandwidth
+    procs = []
+    for cpus in get_cpu_sets(num_workers):
+        thread_args, env, preexec_fn = make_worker_launch(cpus)
+        cmd = [sys.executable, PACKER_SCRIPT, *base_args, *thread_args, '--packer_calibrate']
+        procs.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+                                      preexec_fn=preexec_fn, text=True))
+    steps_per_sec = []
+    for proc in procs:
+        stdout, _ = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f'calibration with {num_workers} workers failed')
+        steps_per_sec.append(json.loads(stdout.strip().splitlines()[-1])['steps_per_sec'])
+    return {'workers': num_workers, 'cpus_per_worker': len(get_cpu_sets(num_workers)[0]),
+            'steps_per_sec': sum(steps_per_sec)}
+
+
+def choose_workers(base_args, num_jobs):
+    results = []
+    for num_workers in get_candidate_workers(len(os.sched_getaffinity(0)), num_jobs):
+        result = calibrate(base_args, num_workers)
+        results.append(result)
+        logging.info(f'calibration: {result["workers"]} workers x {result["cpus_per_worker"]} cores -> '
+                     f'{result["steps_per_sec"]:.2f} steps/s')
+    best = max(results, key=lambda result: result['steps_per_sec'])
+    return best['workers'], results
+
+
+def run_calibration():
+    # Times SCModel.train_step on the first job's images and flags
+    utils.set_threads()
+    tf.keras.mixed_precision.set_global_policy(FLAGS.policy)
+    images = utils.load_sc_images()
+    FLAGS.bench_sample_size = FLAGS.sample_size
+    FLAGS.bench_warmup, FLAGS.bench_iters = 1, FLAGS.packer_calibrate_iters
+    sc_model, data = benchmark.make_bench_sc_model(tf.distribute.get_strategy(), FLAGS.loss, FLAGS.disc_model,
+                                                   images)
+    result = benchmark.time_fn(tf.function(sc_model.train_step), data)
+    print(json.dumps({'steps_per_sec': 1e3 / result['median_ms']}))
+
+
+def main(argv):
+    del argv  # Unused.
+
+    if FLAGS.packer_calibrate:
+        run_calibration()
+        return
+
+    jobs = read_jobs(FLAGS.packer_jobs)
+    base_args = sweep.get_forwarded_args(exclude=['out_dir', 'intra_threads', 'inter_threads'],
+                                         launcher_modules=[__name__])
+    os.makedirs(FLAGS.packer_dir, exist_ok=True)
+    sweep.prefetch_weights([{}])
+
+    calibration = []
+    num_workers = FLAGS.packer_workers
+    if num_workers is None:
+        num_workers, calibration = choose_workers(base_args + jobs[0], len(jobs))
+    num_workers = min(num_workers, len(jobs))
+    cpu_sets = get_cpu_sets(num_workers)
+    logging.info(f'packing {len(jobs)} jobs on {num_workers} workers of {len(cpu_sets[0])} cores')
+
+    free_cpu_sets = queue.Queue()
+    for cpus in cpu_sets:
+        free_cpu_sets.put(cpus)
+
+    def run_job(i):
+        out_dir = os.path.join(FLAGS.packer_dir, f'{i:04d}')
+        cpus = free_cpu_sets.get()
+        try:
+            thread_args, env, preexec_fn = make_worker_launch(cpus)
+            cmd = sweep.make_run_cmd({}, out_dir, base_args + jobs[i] + thread_args)
+            status = sweep.launch_run(cmd, out_dir, env=env, preexec_fn=preexec_fn)
+        finally:
+            free_cpu_sets.put(cpus)
+        if status['returncode'] != 0:
+            logging.warning(f'{out_dir} failed. see {out_dir}.log')
+        return {'run': f'{i:04d}', 'args': ' '.join(jobs[i]), **status, **sweep.collect_results(out_dir)}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_workers) as executor:
+        rows = list(executor.map(run_job, range(len(jobs))))
+    hours = (time.perf_counter() - start) / 3600
+
+    sweep.write_summary(rows, os.path.join(FLAGS.packer_dir, 'summary.csv'))
+    done = sum(row['returncode'] == 0 for row in rows)
+    report = {'jobs': len(jobs), 'done': done, 'workers': num_workers, 'cpus_per_worker': len(cpu_sets[0]),
+              'hours': hours, 'images_per_hour': done / hours, 'calibration': calibration}
+    with open(os.path.join(FLAGS.packer_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f'{done}/{len(jobs)} jobs done at {report["images_per_hour"]:.1f} images/hour')
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,187 @@
+import contextlib
+import csv
+import os
+import time
+
+import tensorflow as tf
+from absl import flags
+from absl import logging
+
+from distributions import process_spatial_feats
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('profile_every', 0, 'time the phases of every n-th training step. 0 disables phase timing')
+flags.DEFINE_integer('profile_flush', 10, 'number of timed steps averaged into each row of phase_timings.csv')
+flags.DEFINE_list('profile_trace', None, 'start,end training steps to capture with the tf.profiler (optional)')
+
+PHASES = ['disc_feats', 'disc_forward', 'disc_backward', 'disc_apply', 'disc_scheduled',
+          'gen_feats', 'process_feats', 'loss', 'adversarial', 'backward', 'apply', 'metrics', 'clip']
+
+
+class PhaseTimer(tf.Module):
+    # Times the phases of a step with in-graph timestamps.
+    # Each timestamp only waits on the outputs of its phase, so the rest of the graph isn't serialized.
+    def __init__(self, every=0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.every = every
+        aggregation = tf.VariableAggregation.ONLY_FIRST_REPLICA
+        self.totals = tf.Variable(tf.zeros(len(PHASES), tf.float64), trainable=False, aggregation=aggregation,
+                                  name='totals')
+        self.count = tf.Variable(0, trainable=False, dtype=tf.int64, aggregation=aggregation, name='count')
+        self.step = tf.Variable(0, trainable=False, dtype=tf.int64, aggregation=aggregation, name='step')
+        self._marks = []
+
+    @property
+    def enabled(self):
+        return self.every > 0
+
+    def start(self, inputs):
+        # The start waits on the step's inputs, so it isn't taken before the previous step is done with them
+        if self.enabled:
+            self._marks = [(None, self._timestamp(inputs))]
+
+    def mark(self, phase, outputs):
+        if self.enabled:
+            self._marks.append((phase, self._timestamp(outputs)))
+
+    def _timestamp(self, tensors):
+        tensors = [x.value() if isinstance(x, tf.Variable) else x for x in tf.nest.flatten(tensors)]
+        with tf.control_dependencies(tensors):
+            return tf.timestamp()
+
+    @contextlib.contextmanager
+    def suspended(self):
+        every, self.every = self.every, 0
+        try:
+            yield
+        finally:
+            self.every = every
+
+    def record(self):
+        if not self.enabled:
+            return
+        indices, durations = [], []
+        for (_, prev_time), (phase, curr_time) in zip(self._marks[:-1], self._marks[1:]):
+            indices.append([PHASES.index(phase)])
+            durations.append(curr_time - prev_time)
+        self._marks = []
+
+        def update():
+            self.totals.scatter_nd_add(indices, tf.stack(durations))
+            self.count.assign_add(1)
+            return tf.constant(True)
+
+        sample = tf.equal(self.step % self.every, 0)
+        tf.cond(sample, update, lambda: tf.constant(False))
+        self.step.assign_add(1)
+
+    def pop_averages(self):
+        count = int(self.count.numpy())
+        averages = self.totals.numpy() / max(count, 1)
+        self.totals.assign(tf.zeros_like(self.totals))
+        self.count.assign(0)
+        return count, {phase: 1e3 * avg for phase, avg in zip(PHASES, averages)}
+
+
+class PhaseTimingLogger(tf.keras.callbacks.Callback):
+    def __init__(self, out_dir, flush, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filepath = os.path.join(out_dir, 'phase_timings.csv')
+        self.flush = flush
+        self.curr_step = 0
+        with open(self.filepath, 'w', newline='') as f:
+            csv.writer(f).writerow(['step', 'timed_steps'] + [f'{phase}_ms' for phase in PHASES])
+
+    def write_row(self):
+        timer = self.model.phase_timer
+        count, averages = timer.pop_averages()
+        if count > 0:
+            with open(self.filepath, 'a', newline='') as f:
+                csv.writer(f).writerow([self.curr_step, count] + [averages[phase] for phase in PHASES])
+
+    def on_epoch_end(self, epoch, logs=None):
+        prev_step = self.curr_step
+        self.curr_step += self.params['steps']
+        period = self.model.phase_timer.every * self.flush
+        if self.curr_step // period > prev_step // period:
+            self.write_row()
+
+    def on_train_end(self, logs=None):
+        self.write_row()
+
+
+class TraceWindow(tf.keras.callbacks.Callback):
+    def __init__(self, logdir, start_step, end_step, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logdir = logdir
+        self.start_step, self.end_step = start_step, end_step
+        self.curr_step = 0
+        self.tracing = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if not self.tracing and self.start_step <= self.curr_step < self.end_step:
+            tf.profiler.experimental.start(self.logdir)
+            self.tracing = True
+            logging.info(f'started profiler trace at step {self.curr_step}')
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.curr_step += self.params['steps']
+        if self.tracing and self.curr_step >= self.end_step:
+            self.stop()
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.tracing = False
+        logging.info(f'profiler trace saved to {self.logdir}')
+
+
+def make_profiling_callbacks(out_dir):
+    callbacks = []
+    if FLAGS.profile_every > 0:
+        callbacks.append(PhaseTimingLogger(out_dir, FLAGS.profile_flush))
+        logging.info(f'timing the step phases every {FLAGS.profile_every} steps')
+    if FLAGS.profile_trace is not None:
+        start_step, end_step = [int(step) for step in FLAGS.profile_trace]
+        callbacks.append(TraceWindow(os.path.join(out_dir, 'trace'), start_step, end_step))
+    return callbacks
+
+
+def _time_fn(fn, iters):
+    def sync_fn():
+        for output in tf.nest.flatten(fn()):
+            if isinstance(output, tf.Tensor):
+                output.numpy()
+
+    sync_fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        sync_fn()
+    return 1e3 * (time.perf_counter() - start) / iters
+
+
+def log_layer_costs(sc_model, images, feats, loss_fn, metric_fns, filepath, iters=5):
+    gen_feats = sc_model(images, training=False)
+    rows = []
+    for i, (y_true, y_pred) in enumerate(zip(feats['style'], gen_feats['style'])):
+        y_true = process_spatial_feats(y_true, sc_model.sample_size)
+        y_pred = process_spatial_feats(y_pred, sc_model.sample_size)
+        shape = 'x'.join(str(d) for d in y_pred.shape)
+        for name, fn in [('loss', loss_fn)] + [(metric.name, metric) for metric in metric_fns]:
+            if isinstance(fn, tf.keras.metrics.Metric):
+                graph_fn = tf.function(lambda: fn.update_state(y_true, y_pred))
+            else:
+                graph_fn = tf.function(lambda: fn(y_true, y_pred))
+            rows.append([i, shape, name, _time_fn(graph_fn, iters)])
+        for metric in metric_fns:
+            metric.reset_state()
+
+    with open(filepath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['layer', 'shape', 'name', 'ms'])
+        writer.writerows(rows)
+    logging.info(f'per-layer loss/metric costs saved to {filepath}')
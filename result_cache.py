@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from absl import flags
+from absl import logging
+
+from style_blend import read_style_bytes
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('result_cache', None, 'directory of the cached transfers. '
+                                          'repeated runs return the cached result and runs with more steps resume '
+                                          'from it (optional)')
+flags.DEFINE_integer('result_cache_mb', 1024, 'size limit of the result cache in MB. '
+                                              'the least recently used results are evicted first')
+
+# Flags that don't change the generated image. The images are keyed by their bytes instead of their paths
+UNKEYED_FLAGS = ['train_steps', 'style_image', 'blend_styles', 'content_image', 'out_dir', 'intra_threads',
+                 'inter_threads', 'feat_cache', 'verbose', 'checkpoints', 'profile_every', 'profile_flush',
+                 'profile_trace', 'train_metrics', 'result_cache', 'result_cache_mb', 'wass_incremental',
+                 'wass_repair_passes', 'log_every', 'log_flush', 'weight_store']
+
+RESULT_FILES = ['logs.json', 'logs.bin', 'raw_metrics.csv']
+
+
+def get_flags_key():
+    items = []
+    for module, module_flags in FLAGS.flags_by_module_dict().items():
+        if module.startswith('absl') or module.startswith('tensorflow'):
+            continue
+        for flag in module_flags:
+            if flag.name not in UNKEYED_FLAGS:
+                items.append(f'{flag.name}={flag.value}')
+    return ';'.join(sorted(items))
+
+
+def read_bytes(filepath):
+    if filepath is None:
+        return b''
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+class ResultCache:
+    # Stores the generated image and metrics of finished transfers under {key}/{train_steps},
+    # where the key hashes the image bytes and the flags
+    def __init__(self, root, max_mb):
+        self.root = root
+        self.max_bytes = max_mb * 2 ** 20
+        os.makedirs(root, exist_ok=True)
+
+    def get_key(self, style_bytes, content_bytes, flags_key):
+        h = hashlib.sha256()
+        for part in [style_bytes, content_bytes, flags_key.encode()]:
+            h.update(hashlib.sha256(part).digest())
+        return h.hexdigest()
+
+    def get_entries(self, key):
+        key_dir = os.path.join(self.root, key)
+        if not os.path.isdir(key_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(key_dir) if name.isdigit())
+
+    def lookup(self, key, train_steps):
+        # Returns (steps, entry dir) of the exact result, else of the longest shorter run, else None
+        steps = [s for s in self.get_entries(key) if s <= train_steps]
+        if not steps:
+            return None
+        entry_dir = os.path.join(self.root, key, str(steps[-1]))
+        self.touch(entry_dir)
+        return steps[-1], entry_dir
+
+    def touch(self, entry_dir):
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['last_access'] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def load_gen_image(self, entry_dir):
+        return np.load(os.path.join(entry_dir, 'gen_image.npy'))
+
+    def restore(self, entry_dir, out_dir, filenames=RESULT_FILES):
+        for filename in filenames:
+            src = os.path.join(entry_dir, filename)
+            if os.path.exists(src):
+                shutil.copy(src, os.path.join(out_dir, filename))
+
+    def save(self, key, train_steps, gen_image, out_dir):
+        entry_dir = os.path.join(self.root, key, str(train_steps))
+        # Concurrent runs may save the same entry, so build it aside and move it into place
+        tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'gen_image.npy'), gen_image)
+        for filename in RESULT_FILES:
+            src = os.path.join(out_dir, filename)
+            if os.path.exists(src):
+                shutil.copy(src, os.path.join(tmp_dir, filename))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'train_steps': train_steps, 'last_access': time.time()}, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        logging.info(f'saved result to {entry_dir}')
+        self.evict()
+
+    def evict(self):
+        entries, total_bytes = [], 0
+        for key in os.listdir(self.root):
+            for steps in self.get_entries(key):
+                entry_dir = os.path.join(self.root, key, str(steps))
+                try:
+                    with open(os.path.join(entry_dir, 'meta.json')) as f:
+                        last_access = json.load(f)['last_access']
+                    size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                except (OSError, ValueError):
+                    continue
+                entries.append((last_access, size, entry_dir))
+                total_bytes += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
+            logging.info(f'evicted {entry_dir} from the result cache')
+
+
+def make_result_cache():
+    if FLAGS.result_cache is None:
+        return None, None
+    cache = ResultCache(FLAGS.result_cache, FLAGS.result_cache_mb)
+    key = cache.get_key(read_style_bytes(), read_bytes(FLAGS.content_image), get_flags_key())
+    return cache, key
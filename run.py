@@ -5,8 +5,15 @@ from absl import flags
 from absl import logging
 
 import model as scm
-from training import train, compile_sc_model, make_dataset
-from utils import plot_loss, log_feat_distribution, plot_layer_grams, setup, load_sc_images
+from metric_log import LOG_FILES, read_logs
+from profiling import log_layer_costs
+from result_cache import make_result_cache
+from style_blend import load_blend_images, blend_style_feats
+from warm_start import find_warm_start, add_to_warm_start_index, get_content_descriptor
+from training import train, compile_sc_model, make_dataset, make_step_dataset, make_style_metrics, \
+    make_style_loss
+from utils import plot_loss, log_feat_distribution, plot_layer_grams, setup, load_sc_images, get_feats, \
+    to_pixel_range
 
 FLAGS = flags.FLAGS
 
@@ -18,7 +25,39 @@ flags.DEFINE_integer('sample_size', None, 'mini-batch sample size of the feature
                                           'if low on memory or want to speed up training, '
                                           'set this value to something like 1024')
 
+flags.DEFINE_integer('disc_sample_size', None, 'sample size of the features per layer for the discriminator. '
+                                              'defaults to --sample_size')
 flags.DEFINE_bool('train_metrics', True, 'measure metrics during training')
+flags.DEFINE_bool('in_graph_targets', False, 'hold the style and content targets in the model '
+                                             'instead of streaming them through the dataset every step')
+
+
+def _check_content_start(flags_dict):
+    # Without a content image, load_sc_images uses the style image as the content image
+    start_image = flags_dict['start_image']
+    if start_image == 'nearest':
+        start_image = flags_dict['warm_start_fallback']
+    return flags_dict['content_image'] is not None or not start_image.startswith('content')
+
+
+flags.register_multi_flags_validator(['start_image', 'warm_start_fallback', 'content_image'], _check_content_start,
+                                     message='starting from the content image requires --content_image')
+
+
+def save_images(loss_dir, style_image, content_image, gen_image):
+    for filename, image in [('style.jpg', style_image), ('content.jpg', content_image),
+                            (f'{FLAGS.loss}.jpg', gen_image)]:
+        tf.keras.preprocessing.image.save_img(f'{loss_dir}/{filename}', tf.squeeze(image, 0))
+    logging.info(f'images saved to {loss_dir}')
+
+
+def get_raw_targets(raw_feat_model, images, blend_images, raw_feats_dict=None):
+    # The features of the images, with the features of the blended styles pooled into one set of style targets
+    if raw_feats_dict is None:
+        raw_feats_dict = get_feats(raw_feat_model, images)
+    style_branch = scm.get_style_branch(raw_feat_model)
+    return blend_style_feats(raw_feats_dict, [get_feats(style_branch, [blend_image])['style']
+                                              for blend_image in blend_images])
 
 
 def main(argv):
@@ -30,48 +69,103 @@ def main(argv):
     # Load style/content image
     logging.info('loading images')
     style_image, content_image = load_sc_images()
+    blend_images = load_blend_images(style_image)
+
+    # Check for a cached result of the same transfer
+    result_cache, cache_key = make_result_cache()
+    cached = None
+    if result_cache is not None:
+        cached = result_cache.lookup(cache_key, FLAGS.train_steps)
+    if cached is not None:
+        cached_steps, entry_dir = cached
+        if cached_steps == FLAGS.train_steps:
+            logging.info(f'returning the cached result from {entry_dir}')
+            result_cache.restore(entry_dir, loss_dir)
+            gen_image = tf.cast(result_cache.load_gen_image(entry_dir), tf.uint8)
+            save_images(loss_dir, style_image, content_image, gen_image)
+            logs_df = read_logs(loss_dir)
+            if logs_df is not None:
+                plot_loss(logs_df, path=f'{loss_dir}/plots.jpg')
+            return
+        logging.info(f'resuming from the cached result of {cached_steps} steps in {entry_dir}')
+        # Continue the training logs. The raw metrics are measured again at the end
+        result_cache.restore(entry_dir, loss_dir, filenames=LOG_FILES)
 
     # Create the style-content model
     logging.info('making style-content model')
     image_shape = style_image.shape[1:]
     with strategy.scope():
         raw_feat_model = scm.make_feat_model(image_shape)
-        sc_model = scm.SCModel(raw_feat_model, FLAGS.sample_size, FLAGS.loss_warmup)
+        sc_model = scm.SCModel(raw_feat_model, FLAGS.sample_size, FLAGS.loss_warmup, FLAGS.profile_every,
+                               FLAGS.disc_sample_size)
+
+    # Get the style and content features, from the --feat_cache if they were cached
+    raw_feats_dict = get_feats(raw_feat_model, (style_image, content_image))
+    # The standardized content features average to about zero, so the warm start descriptor uses the backbone's
+    content_descriptor = get_content_descriptor(scm.get_backbone_feats(raw_feat_model, raw_feats_dict['content'],
+                                                                       'content'))
 
-        # Configure the model to the style and content images
-        sc_model.configure(style_image, content_image)
+    # Configure the model to the style and content images with their features
+    with strategy.scope():
+        sc_model.configure(style_image, content_image, raw_feats_dict)
 
     # Plot the feature model structure
-    tf.keras.utils.plot_model(sc_model.feat_model, './out/feat_model.jpg')
+    tf.keras.utils.plot_model(sc_model.feat_model, f'{loss_dir}/feat_model.jpg')
 
-    # Get the style and content features
-    raw_feats_dict = raw_feat_model((style_image, content_image), training=False)
-    feats_dict = sc_model.feat_model((style_image, content_image), training=False)
+    raw_feats_dict = get_raw_targets(raw_feat_model, (style_image, content_image), blend_images, raw_feats_dict)
+    feats_dict = raw_feats_dict
+    if sc_model.feat_model is not raw_feat_model:
+        feats_dict = sc_model.feat_model((style_image, content_image), training=False)
+        style_branch = scm.get_style_branch(sc_model.feat_model)
+        feats_dict = blend_style_feats(feats_dict, [style_branch(blend_image, training=False)['style']
+                                                    for blend_image in blend_images])
 
     # Make the dataset
-    ds = make_dataset(strategy, (style_image, content_image), feats_dict)
+    if FLAGS.in_graph_targets:
+        with strategy.scope():
+            sc_model.set_targets((style_image, content_image), feats_dict)
+        ds = make_step_dataset(strategy)
+    else:
+        ds = make_dataset(strategy, (style_image, content_image), feats_dict)
 
     # Log distribution statistics of the style image
     log_feat_distribution(raw_feats_dict, 'raw layer average style moments')
     log_feat_distribution(feats_dict, 'projected layer average style moments')
 
     # Plot the gram matrices
-    plot_layer_grams(raw_feats_dict, feats_dict, filepath='./out/gram.jpg')
+    plot_layer_grams(raw_feats_dict, feats_dict, filepath=f'{loss_dir}/gram.jpg', chunk_size=FLAGS.moment_chunk)
 
     # Reset gen image and recompile
-    sc_model.reinit_gen_image()
+    warm_start_image = None
+    if FLAGS.start_image == 'nearest':
+        warm_start_image = find_warm_start(content_descriptor, sc_model.gen_image.shape)
+    sc_model.reinit_gen_image(to_pixel_range(style_image), to_pixel_range(content_image), warm_start_image)
     compile_sc_model(strategy, sc_model, FLAGS.loss, with_metrics=FLAGS.train_metrics)
 
+    # Resume from the cached result. The learning rate schedule and loss warmup continue from its step,
+    # but the optimizer moments start over
+    initial_step = 0
+    if cached is not None:
+        initial_step = cached_steps
+        sc_model.gen_image.assign(result_cache.load_gen_image(entry_dir))
+        sc_model.curr_step.assign(initial_step)
+        sc_model.optimizer.iterations.assign(initial_step)
+
+    # Measure the cost of the loss and metrics per layer
+    if FLAGS.profile_every > 0:
+        log_layer_costs(sc_model, (style_image, content_image), feats_dict, make_style_loss(FLAGS.loss),
+                        make_style_metrics(), filepath=f'{loss_dir}/layer_costs.csv')
+
+    if FLAGS.in_graph_targets:
+        # The model's variables hold the only copies of the targets
+        del feats_dict, raw_feats_dict
+
     # Style transfer
     logging.info(f'loss function: {FLAGS.loss}')
-    train(sc_model, ds, loss_dir)
+    completed_steps = train(sc_model, ds, loss_dir, initial_step)
 
     # Save the images to disk
-    gen_image = sc_model.get_gen_image()
-    for filename, image in [('style.jpg', style_image), ('content.jpg', content_image),
-                            (f'{FLAGS.loss}.jpg', gen_image)]:
-        tf.keras.preprocessing.image.save_img(f'{loss_dir}/{filename}', tf.squeeze(image, 0))
-    logging.info(f'images saved to {loss_dir}')
+    save_images(loss_dir, style_image, content_image, sc_model.get_gen_image())
 
     # Sanity evaluation
     logging.info('evaluating on projected features')
@@ -79,13 +173,22 @@ def main(argv):
     sc_model.evaluate(ds, steps=1, return_dict=True)
 
     # Metrics
-    logs_df = pd.read_csv(f'{loss_dir}/logs.csv')
+    logs_df = read_logs(loss_dir)
 
     logging.info('evaluating on raw features')
     orig_feat_model = sc_model.feat_model
     sc_model.feat_model = raw_feat_model
+    raw_ds = ds
+    if orig_feat_model is not raw_feat_model:
+        # The projected targets don't match the raw features
+        if FLAGS.in_graph_targets:
+            raw_feats_dict = get_raw_targets(raw_feat_model, (style_image, content_image), blend_images)
+            with strategy.scope():
+                sc_model.set_targets((style_image, content_image), raw_feats_dict)
+        else:
+            raw_ds = make_dataset(strategy, (style_image, content_image), raw_feats_dict)
     compile_sc_model(strategy, sc_model, FLAGS.loss, with_metrics=True)
-    all_raw_metrics = sc_model.evaluate(ds, steps=1, return_dict=True)
+    all_raw_metrics = sc_model.evaluate(raw_ds, steps=1, return_dict=True)
     all_raw_metrics = pd.Series(all_raw_metrics)
     for metric in ['_mean', '_var', '_covar', '_gram', '_skew', '_wass']:
         raw_metrics = all_raw_metrics.filter(like=metric)
@@ -99,6 +202,14 @@ def main(argv):
     plot_loss(logs_df, path=f'{loss_dir}/plots.jpg')
     logging.info(f'metrics saved to {loss_dir}')
 
+    # Only finished runs are warm start candidates
+    if completed_steps >= FLAGS.train_steps:
+        add_to_warm_start_index(content_descriptor, sc_model.get_gen_image(),
+                                {'train_steps': completed_steps, 'start_image': FLAGS.start_image})
+    # An interrupted run is cached under the steps it completed, so a rerun resumes from it
+    if result_cache is not None and completed_steps > initial_step:
+        result_cache.save(cache_key, completed_steps, sc_model.gen_image.numpy(), loss_dir)
+
 
 if __name__ == '__main__':
     app.run(main)
@@ -0,0 +1,306 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+import model as scm
+import run  # Defines the flags of the runs
+from distributions import sharded
+from metric_log import open_metric_log, read_logs
+from sweep import get_forwarded_args, get_thread_env
+from utils import load_sc_images, plot_loss, set_threads, to_pixel_range
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('shard_workers', 2, 'local worker processes that the generated image is split between by rows')
+flags.DEFINE_integer('shard_index', None, 'index of this worker. set by the launcher')
+flags.DEFINE_integer('shard_port', 23456, 'localhost port of the first worker. the workers use consecutive ports')
+flags.DEFINE_integer('shard_halo', None, 'rows of the neighboring shards that each worker reads to compute the '
+                                         'features at its edges. defaults to the receptive field of the feature model')
+flags.DEFINE_integer('shard_quantiles', 1024, 'quantiles per shard, layer and channel that summarize the features '
+                                              'of the wass loss')
+
+SHARD_FLAGS = ['shard_workers', 'shard_port', 'shard_halo', 'shard_quantiles']
+
+
+def check_flags():
+    unsupported = {'sample_size': None, 'loss_warmup': 0, 'disc_model': None, 'pca': None, 'ica': None,
+                   'shift': False, 'scale': False, 'strategy': None, 'policy': 'float32', 'blend_styles': None}
+    for name, default in unsupported.items():
+        if FLAGS[name].value != default:
+            raise ValueError(f'--{name} is not supported by sharded transfers')
+    if FLAGS.loss is None:
+        raise ValueError('sharded transfers need a --loss')
+    if FLAGS.start_image == 'nearest':
+        raise ValueError('--start_image=nearest is not supported by sharded transfers')
+
+
+def measure_receptive_field(feat_model, probe_size=64, max_probe_size=4096):
+    # Returns the halo rows and the stride of every output of the feature model.
+    # The rows of the input that the middle row of an output depends on have non-zero gradients
+    while probe_size <= max_probe_size:
+        image = tf.random.uniform([1, probe_size, probe_size, 3], maxval=255)
+        with tf.GradientTape(persistent=True) as tape:
+            tape.watch(image)
+            feats = feat_model((image, image), training=False)
+            middle_sums = [tf.reduce_sum(feat[:, feat.shape[1] // 2]) for feat in tf.nest.flatten(feats)]
+
+        halo, touches_border = 0, False
+        for feat, middle_sum in zip(tf.nest.flatten(feats), middle_sums):
+            stride = probe_size // feat.shape[1]
+            middle = feat.shape[1] // 2
+            grad = tape.gradient(middle_sum, image)
+            rows = tf.where(tf.reduce_any(grad != 0, axis=[0, 2, 3]))[:, 0].numpy()
+            halo = max(halo, middle * stride - rows.min(), rows.max() + 1 - (middle + 1) * stride)
+            touches_border |= rows.min() == 0 or rows.max() == probe_size - 1
+        if not touches_border:
+            strides = tf.nest.map_structure(lambda feat: probe_size // feat.shape[1], feats)
+            return int(halo), strides
+        probe_size *= 2
+    raise ValueError(f'receptive field of the feature model is larger than {max_probe_size}. set --shard_halo')
+
+
+def split_rows(height, num_shards, align):
+    # Rows [start, end) of each shard, starting at multiples of align so the shards share the feature grid
+    units = height // align
+    if units < num_shards:
+        raise ValueError(f'{height} rows can\'t be split into {num_shards} shards of at least {align} rows')
+    starts = [i * units // num_shards * align for i in range(num_shards)]
+    return list(zip(starts, starts[1:] + [height]))
+
+
+def flatten_feats(feats):
+    return tf.reshape(feats, [tf.shape(feats)[0], -1, feats.shape[-1]])
+
+
+class ShardedTransfer:
+    # One worker's rows of the generated image. Its features are computed from its rows and the halo rows
+    # of its neighbors, and its losses from the statistics of all the shards.
+    # Every worker computes the same total loss, so the collectives' gradients sum each gradient num_shards times
+    def __init__(self, feat_model, strides, rows, index, halo, loss_key, num_quantiles):
+        self.feat_model, self.strides = feat_model, strides
+        self.rows, self.index, self.halo = rows, index, halo
+        self.loss_key, self.num_quantiles = loss_key, num_quantiles
+        self.num_shards, self.height = len(rows), rows[-1][1]
+        self.start, self.end = rows[index]
+        if min(end - start for start, end in rows) < halo:
+            raise ValueError(f'shards of {rows} rows are smaller than the halo of {halo} rows. use fewer workers')
+        self.ext_start, self.ext_end = max(0, self.start - halo), min(self.height, self.end + halo)
+        self.cross = sharded.needs_cross_moments(loss_key)
+
+    def crop_feats(self, feats):
+        # The features of the shard's own rows
+        def crop(feat, stride):
+            top = (self.start - self.ext_start) // stride
+            bottom = (self.end - self.ext_start) // stride if self.end < self.height else None
+            return feat[:, top:bottom]
+
+        return tf.nest.map_structure(crop, feats, self.strides)
+
+    def exchange_halo(self, ctx, shard):
+        if self.halo == 0:
+            return shard
+        tops = ctx.all_gather(shard[:, :self.halo], axis=0)
+        bottoms = ctx.all_gather(shard[:, -self.halo:], axis=0)
+        parts = [shard]
+        if self.index > 0:
+            parts.insert(0, bottoms[self.index - 1:self.index])
+        if self.index < self.num_shards - 1:
+            parts.append(tops[self.index + 1:self.index + 2])
+        return tf.concat(parts, axis=1)
+
+    def configure(self, ctx, style_image, content_image):
+        # Global style statistics, and the content targets of the shard
+        ext_rows = slice(self.ext_start, self.ext_end)
+        feats = self.crop_feats(self.feat_model((style_image[:, ext_rows], content_image[:, ext_rows]),
+                                                training=False))
+        style_stats = []
+        for style_feats in feats['style']:
+            x = flatten_feats(style_feats)
+            counts = ctx.all_gather(tf.shape(x)[1:2], axis=0)
+            zeros = tf.zeros([tf.shape(x)[0], x.shape[-1]])
+            pivot = ctx.all_reduce('sum', sharded.compute_shard_sums(x, zeros)['s1']) / tf.cast(
+                tf.reduce_sum(counts), x.dtype)
+            stats = {'counts': counts, 'pivot': pivot}
+            if self.loss_key == 'wass':
+                summaries = ctx.all_gather(sharded.compute_quantile_summary(x, self.num_quantiles)[None], axis=0)
+                stats['values'], stats['levels'] = sharded.merge_quantile_summaries(summaries, counts)
+            else:
+                sums = ctx.all_reduce('sum', sharded.compute_shard_sums(x, pivot, self.cross))
+                stats['moments'] = sharded.moments_from_sums(sums, pivot, self.cross)
+            style_stats.append(stats)
+
+        # Without a content image there are no content terms, like in compile_sc_model
+        content_targets, content_sizes = [], []
+        if FLAGS.content_image is not None:
+            content_targets = [flatten_feats(content_feats) for content_feats in feats['content']]
+            content_sizes = [ctx.all_reduce('sum', tf.cast(tf.size(x), tf.float32)) for x in content_targets]
+        return style_stats, content_targets, content_sizes
+
+    def compute_style_loss(self, ctx, x, stats):
+        if self.loss_key == 'wass':
+            summary = tf.stop_gradient(sharded.compute_quantile_summary(x, self.num_quantiles))
+            values, levels = sharded.merge_quantile_summaries(ctx.all_gather(summary[None], axis=0), stats['counts'])
+            targets = sharded.compute_wass_targets(x, values, levels, stats['values'], stats['levels'])
+            wass_sum = ctx.all_reduce('sum', sharded.compute_shard_wass_sum(x, targets, p=2))
+            return wass_sum / tf.cast(tf.reduce_sum(stats['counts']), wass_sum.dtype)
+
+        sums = ctx.all_reduce('sum', sharded.compute_shard_sums(x, stats['pivot'], self.cross))
+        moments = sharded.moments_from_sums(sums, stats['pivot'], self.cross)
+        return sharded.compute_moment_loss(self.loss_key, stats['moments'], moments, p=2)
+
+    def compute_losses(self, ctx, shard, style_stats, content_targets, content_sizes):
+        ext_image = self.exchange_halo(ctx, shard)
+        gen_feats = self.crop_feats(self.feat_model((ext_image, ext_image), training=False))
+        losses = {}
+        for i, (style_feats, stats) in enumerate(zip(gen_feats['style'], style_stats)):
+            losses[f'style_{i + 1}_loss'] = tf.reduce_mean(self.compute_style_loss(ctx, flatten_feats(style_feats),
+                                                                                   stats))
+        if FLAGS.content_image is None:
+            return losses
+        for i, (content_feats, target, size) in enumerate(zip(gen_feats['content'], content_targets, content_sizes)):
+            squared_error = tf.reduce_sum((tf.cast(flatten_feats(content_feats), tf.float32) - target) ** 2)
+            losses[f'content_{i + 1}_loss'] = ctx.all_reduce('sum', squared_error) / size
+        return losses
+
+
+def make_gen_opt():
+    gen_lr = FLAGS.gen_lr
+    if FLAGS.cosine_decay:
+        gen_lr = tf.keras.experimental.CosineDecay(FLAGS.gen_lr, FLAGS.train_steps)
+    return tf.keras.optimizers.Adam(gen_lr, FLAGS.beta1, FLAGS.beta2, FLAGS.epsilon)
+
+
+def run_worker(loss_dir):
+    index, num_workers = FLAGS.shard_index, FLAGS.shard_workers
+    cluster = {'worker': [f'localhost:{FLAGS.shard_port + i}' for i in range(num_workers)]}
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}})
+    set_threads()
+    if FLAGS.seed is not None:
+        # Different random start images on every shard
+        tf.random.set_seed(FLAGS.seed + index)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    local_result = lambda value: strategy.experimental_local_results(value)[0]
+
+    style_image, content_image = load_sc_images()
+    if style_image.shape != content_image.shape:
+        raise ValueError(f'style and content images have different sizes: {style_image.shape} {content_image.shape}. '
+                         f'set --imsize')
+
+    # The workers' own copies of the feature model, generated rows and optimizer
+    feat_model = scm.make_feat_model([None, None, 3])
+    halo, strides = measure_receptive_field(feat_model)
+    align = max(tf.nest.flatten(strides))
+    if FLAGS.shard_halo is not None:
+        halo = FLAGS.shard_halo
+    halo = -(-halo // align) * align
+    rows = split_rows(style_image.shape[1], num_workers, align)
+    logging.info(f'worker {index}/{num_workers}: rows {rows[index]} with a halo of {halo} rows')
+    transfer = ShardedTransfer(feat_model, strides, rows, index, halo, FLAGS.loss, FLAGS.shard_quantiles)
+
+    start_image = scm.make_start_image(FLAGS.start_image, style_image.shape, tf.float32, to_pixel_range(style_image),
+                                       to_pixel_range(content_image))
+    gen_shard = tf.Variable(start_image[:, transfer.start:transfer.end])
+    gen_opt = make_gen_opt()
+
+    @tf.function
+    def configure():
+        return strategy.run(lambda: transfer.configure(tf.distribute.get_replica_context(), style_image, content_image))
+
+    targets = tf.nest.map_structure(local_result, configure())
+
+    def shard_step():
+        with tf.GradientTape() as tape:
+            losses = transfer.compute_losses(tf.distribute.get_replica_context(), gen_shard, *targets)
+            loss = tf.add_n(list(losses.values()))
+            scaled_loss = loss / num_workers
+        return {'loss': loss, **losses}, tape.gradient(scaled_loss, gen_shard)
+
+    @tf.function
+    def train_step():
+        logs, grad = tf.nest.map_structure(local_result, strategy.run(shard_step))
+        gen_opt.apply_gradients([(grad, gen_shard)])
+        gen_shard.assign(tf.clip_by_value(gen_shard, 0, 255))
+        return logs
+
+    @tf.function
+    def gather_gen_image():
+        # Pad the shards to the same number of rows for the gather
+        def gather():
+            max_rows = max(end - start for start, end in rows)
+            padded = tf.pad(gen_shard, [[0, 0], [0, max_rows - gen_shard.shape[1]], [0, 0], [0, 0]])
+            return tf.distribute.get_replica_context().all_gather(padded, axis=0)
+
+        gathered = local_result(strategy.run(gather))
+        return tf.concat([gathered[i:i + 1, :end - start] for i, (start, end) in enumerate(rows)], axis=1)
+
+    logging.info(f'loss function: {FLAGS.loss}')
+    # Only the first worker writes the logs
+    metric_log = open_metric_log(loss_dir) if index == 0 else None
+    logs = None
+    for step in range(FLAGS.train_steps):
+        logs = {key: float(value) for key, value in train_step().items()}
+        if FLAGS.verbose and index == 0:
+            logging.info(f'step {step}: {logs}')
+        if metric_log is not None:
+            metric_log.log(step, FLAGS.train_steps, logs)
+    logging.info(logs or 'no training steps')
+
+    gen_image = gather_gen_image()
+    if index == 0:
+        metric_log.flush()
+        run.save_images(loss_dir, style_image, content_image, tf.cast(gen_image, tf.uint8))
+        logs_df = read_logs(loss_dir)
+        if logs_df is not None:
+            plot_loss(logs_df, path=f'{loss_dir}/plots.jpg')
+        logging.info(f'metrics saved to {loss_dir}')
+
+
+def launch_workers(loss_dir):
+    # Each worker gets an equal share of the cores
+    threads = FLAGS.intra_threads or max(1, os.cpu_count() // FLAGS.shard_workers)
+    base_args = get_forwarded_args(exclude=['out_dir', 'intra_threads'])
+    base_args += [FLAGS[name].serialize() for name in SHARD_FLAGS if FLAGS[name].value is not None]
+    procs = []
+    for index in range(FLAGS.shard_workers):
+        cmd = [sys.executable, os.path.abspath(__file__), *base_args, f'--out_dir={loss_dir}',
+               f'--intra_threads={threads}', f'--shard_index={index}']
+        log_file = open(f'{loss_dir}/worker{index}.log', 'w')
+        procs.append((subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, env=get_thread_env(threads)),
+                      log_file))
+    logging.info(f'launched {len(procs)} workers with {threads} threads each. logs in {loss_dir}/worker*.log')
+
+    failed = []
+    for index, (proc, log_file) in enumerate(procs):
+        if proc.wait() != 0:
+            failed.append(index)
+            # The other workers would wait for it forever
+            for other, _ in procs:
+                other.kill()
+        log_file.close()
+    if failed:
+        raise SystemExit(f'workers {failed} failed. see {loss_dir}/worker{failed[0]}.log')
+    logging.info(f'sharded transfer saved to {loss_dir}')
+
+
+def main(argv):
+    del argv  # Unused.
+
+    check_flags()
+    loss_dir = FLAGS.out_dir or f'out/{FLAGS.loss}-sharded'
+    if FLAGS.shard_index is None:
+        shutil.rmtree(loss_dir, ignore_errors=True)
+        os.makedirs(loss_dir)
+        launch_workers(loss_dir)
+    else:
+        run_worker(loss_dir)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,63 @@
+from absl import flags
+from absl import logging
+
+from distributions.blending import pool_style_feats
+from utils import load_image
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('blend_styles', None, 'style images to blend with --style_image. their features are pooled once '
+                                        'into one set of style targets, so the steps cost the same as one style '
+                                        '(optional)')
+flags.DEFINE_list('style_weights', None, 'weights of --style_image followed by --blend_styles. '
+                                         'defaults to equal weights')
+
+
+def get_style_weights():
+    num_styles = 1 + len(FLAGS.blend_styles or [])
+    if FLAGS.style_weights is None:
+        return [1.0] * num_styles
+    weights = [float(weight) for weight in FLAGS.style_weights]
+    if len(weights) != num_styles:
+        raise ValueError(f'expected {num_styles} --style_weights for --style_image and --blend_styles '
+                         f'but got {len(weights)}')
+    if min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError(f'--style_weights must be non-negative with a positive sum. got {weights}')
+    return weights
+
+
+def load_blend_images(style_image):
+    # Check the weights before the features are computed
+    get_style_weights()
+    blend_images = []
+    for filepath in FLAGS.blend_styles or []:
+        image = load_image(filepath)
+        if image.shape != style_image.shape:
+            raise ValueError(f'blended style {filepath} has shape {image.shape} but the style image has shape '
+                             f'{style_image.shape}. set --imsize to resize them to the same shape')
+        blend_images.append(image)
+    return blend_images
+
+
+def blend_style_feats(feats_dict, all_blend_feats):
+    # Pools the style features of feats_dict and the blended styles' style features layer by layer
+    if not all_blend_feats:
+        return feats_dict
+    weights = get_style_weights()
+    all_style_feats = [feats_dict['style']] + list(all_blend_feats)
+    style_feats = [pool_style_feats(list(layer_feats), weights, FLAGS.loss) for layer_feats in zip(*all_style_feats)]
+    logging.info(f'pooled the features of {len(all_style_feats)} styles with weights {weights}')
+    return {'style': style_feats, 'content': feats_dict['content']}
+
+
+def read_style_bytes():
+    # Identifies the style, or the blend of styles and their weights.
+    # Each file is prefixed with its length, so the bytes of different files can't run into each other
+    style_bytes = b''
+    for filepath in [FLAGS.style_image] + (FLAGS.blend_styles or []):
+        with open(filepath, 'rb') as f:
+            file_bytes = f.read()
+        style_bytes += len(file_bytes).to_bytes(8, 'little') + file_bytes
+    if FLAGS.blend_styles:
+        style_bytes += str(get_style_weights()).encode()
+    return style_bytes
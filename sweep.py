@@ -0,0 +1,181 @@
+import itertools
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+import run  # Defines the flags of the runs
+from metric_log import read_logs
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_multi_string('sweep_grid', [], 'flag values to sweep over as name=value1,value2,... '
+                                            'can be repeated for a grid over several flags')
+flags.DEFINE_string('sweep_dir', 'out/sweep', 'directory of the runs and the summary')
+flags.DEFINE_integer('sweep_workers', None, 'concurrent runs. defaults to the number of cores divided by '
+                                            '--sweep_threads')
+flags.DEFINE_integer('sweep_threads', None, 'intra op threads per run. defaults to the number of cores divided '
+                                            'by --sweep_workers, or 4 if neither are set')
+flags.DEFINE_bool('sweep_dry_run', False, 'only log the commands of the runs')
+
+RUN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+
+
+def parse_grid(grid):
+    parsed = []
+    for entry in grid:
+        name, _, values = entry.partition('=')
+        if not values:
+            raise ValueError(f'expected name=value1,value2,... but got {entry}')
+        if name not in FLAGS:
+            raise ValueError(f'unknown flag in sweep grid: {name}')
+        parsed.append((name, values.split(',')))
+    return parsed
+
+
+def expand_grid(grid):
+    names = [name for name, _ in grid]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for _, values in grid])]
+
+
+def get_run_name(params):
+    name = '_'.join(f'{key}={value}' for key, value in params.items()) or 'default'
+    return re.sub(r'[^\w.=-]', '-', name)
+
+
+def get_forwarded_args(exclude=(), launcher_modules=()):
+    # Flags set on the command line, other than the ones of the launchers and the excluded ones
+    args = []
+    launcher_modules = [sys.argv[0], __name__, *launcher_modules]
+    for module, module_flags in FLAGS.flags_by_module_dict().items():
+        if module.startswith('absl') or module in launcher_modules:
+            continue
+        for flag in module_flags:
+            if flag.present and flag.name not in exclude:
+                args.append(flag.serialize())
+    return args
+
+
+def prefetch_weights(all_params):
+    # Concurrent runs would otherwise race to download the same pretrained weights
+    feat_models = {params.get('feat_model', FLAGS.feat_model) for params in all_params}
+    if 'vgg19' in feat_models:
+        tf.keras.applications.VGG19(include_top=False)
+    if 'nasnetlarge' in feat_models:
+        tf.keras.applications.NASNetLarge(include_top=False)
+    tf.keras.backend.clear_session()
+
+
+def make_run_cmd(params, out_dir, base_args, intra_threads=None, inter_threads=None):
+    cmd = [sys.executable, RUN_SCRIPT, *base_args, f'--out_dir={out_dir}']
+    cmd.extend(f'--{key}={value}' for key, value in params.items())
+    if intra_threads is not None:
+        cmd.append(f'--intra_threads={intra_threads}')
+    if inter_threads is not None:
+        cmd.append(f'--inter_threads={inter_threads}')
+    return cmd
+
+
+def get_inter_threads(threads):
+    # Ops that run in parallel within a run of this many threads
+    return 2 if threads >= 4 else 1
+
+
+def get_thread_env(threads):
+    # Also limits the thread pools outside of Tensorflow's (e.g. oneDNN's OpenMP threads)
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    env['MKL_NUM_THREADS'] = str(threads)
+    return env
+
+
+def launch_run(cmd, out_dir, env=None, preexec_fn=None):
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    # run.py deletes its output directory, so keep the log next to it
+    with open(f'{out_dir}.log', 'w') as log_file:
+        proc = subprocess.run(cmd, stdout=log_file, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+    return {'returncode': proc.returncode, 'seconds': time.perf_counter() - start}
+
+
+def read_raw_metrics(filepath):
+    raw_metrics = pd.read_csv(filepath, header=None, names=['metric', 'value'], skip_blank_lines=True)
+    return dict(zip(raw_metrics['metric'], raw_metrics['value']))
+
+
+def collect_results(out_dir):
+    results = {}
+    logs_df = read_logs(out_dir)
+    if logs_df is not None and len(logs_df) > 0 and 'loss' in logs_df:
+        results['final_loss'] = logs_df['loss'].iloc[-1]
+    metrics_path = os.path.join(out_dir, 'raw_metrics.csv')
+    if os.path.exists(metrics_path):
+        results.update(read_raw_metrics(metrics_path))
+    return results
+
+
+def get_concurrency(num_runs):
+    cores = os.cpu_count()
+    workers, threads = FLAGS.sweep_workers, FLAGS.sweep_threads
+    if workers is None:
+        workers = max(1, cores // (threads or 4))
+    workers = min(workers, num_runs)
+    if threads is None:
+        threads = max(1, cores // workers)
+    return workers, threads
+
+
+def write_summary(rows, filepath):
+    summary_df = pd.DataFrame(rows)
+    summary_df.to_csv(filepath, index=False)
+    total_cols = [col for col in summary_df.columns if col.startswith('total_') or col == 'final_loss']
+    logging.info('\n' + summary_df[['run', *total_cols]].to_string(index=False))
+    logging.info(f'sweep summary saved to {filepath}')
+    return summary_df
+
+
+def main(argv):
+    del argv  # Unused.
+
+    grid = parse_grid(FLAGS.sweep_grid)
+    all_params = expand_grid(grid)
+    base_args = get_forwarded_args(exclude=[name for name, _ in grid] + ['out_dir', 'feat_cache'])
+    base_args.append(f'--feat_cache={FLAGS.feat_cache or os.path.join(FLAGS.sweep_dir, "feat_cache")}')
+    workers, threads = get_concurrency(len(all_params))
+    logging.info(f'sweeping {len(all_params)} runs with {workers} workers of {threads} threads')
+
+    jobs = []
+    for params in all_params:
+        out_dir = os.path.join(FLAGS.sweep_dir, get_run_name(params))
+        jobs.append((params, out_dir, make_run_cmd(params, out_dir, base_args, threads, get_inter_threads(threads))))
+    if FLAGS.sweep_dry_run:
+        for _, _, cmd in jobs:
+            logging.info(' '.join(cmd))
+        return
+
+    prefetch_weights(all_params)
+
+    def run_job(job):
+        params, out_dir, cmd = job
+        status = launch_run(cmd, out_dir, env=get_thread_env(threads))
+        if status['returncode'] != 0:
+            logging.warning(f'{out_dir} failed. see {out_dir}.log')
+        else:
+            logging.info(f'{out_dir} finished in {status["seconds"]:.0f}s')
+        return {'run': get_run_name(params), **params, **status, **collect_results(out_dir)}
+
+    with ThreadPoolExecutor(workers) as executor:
+        rows = list(executor.map(run_job, jobs))
+    write_summary(rows, os.path.join(FLAGS.sweep_dir, 'summary.csv'))
+
+
+if __name__ == '__main__':
+    app.run(main)
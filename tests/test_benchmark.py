@@ -0,0 +1,27 @@
+from absl import flags
+from absl.testing import absltest
+
+import benchmark
+
+FLAGS = flags.FLAGS
+
+
+class TestBenchmark(absltest.TestCase):
+    def test_time_fn(self):
+        FLAGS(['', '--bench_warmup=1', '--bench_iters=3'])
+        result = benchmark.time_fn(lambda: None)
+        self.assertEqual(result['iters'], 3)
+        self.assertLessEqual(result['min_ms'], result['median_ms'])
+
+    def test_compare_results(self):
+        baseline = {'a': {'median_ms': 10.0}, 'b': {'median_ms': 10.0}}
+        results = {'a': {'median_ms': 5.0}, 'b': {'median_ms': 12.0}, 'c': {'median_ms': 1.0}}
+        comparison = benchmark.compare_results(results, baseline, tolerance=0.1)
+        self.assertEqual(set(comparison), {'a', 'b'})
+        self.assertAlmostEqual(comparison['a']['speedup'], 2.0)
+        self.assertFalse(comparison['a']['regression'])
+        self.assertTrue(comparison['b']['regression'])
+
+
+if __name__ == '__main__':
+    absltest.main()
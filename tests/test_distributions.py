@@ -3,8 +3,11 @@ from absl import flags
 from absl.testing import absltest
 from scipy import stats
 
+from distributions import blending
+from distributions import metrics
+from distributions import sharded
 from distributions import compute_wass_dist, compute_co_raw_m2_loss, compute_mean_loss, compute_var_loss, \
-    compute_covar_loss, compute_skew_loss, sample_k
+    compute_covar_loss, compute_skew_loss, sample_k, compute_chunked_moments, compute_sorted_wass_dist, IncrementalSort
 
 FLAGS = flags.FLAGS
 
@@ -28,6 +31,76 @@ class TestDistributions(absltest.TestCase):
             z2 = fn(x, y, p=2)
             tf.debugging.assert_equal(z1 ** 2, z2, message=fn.__name__)
 
+    def test_low_precision(self):
+        x = tf.random.normal([2, 1024, 8])
+        y = tf.random.normal([2, 1024, 8])
+        for dtype in [tf.bfloat16, tf.float16]:
+            low_x, low_y = tf.cast(x, dtype), tf.cast(y, dtype)
+            for fn in [compute_wass_dist, compute_co_raw_m2_loss, compute_mean_loss, compute_var_loss,
+                       compute_covar_loss, compute_skew_loss]:
+                z = fn(low_x, low_y, p=1)
+                tf.debugging.assert_type(z, tf.float32, message=fn.__name__)
+
+                # Only the rounding of the inputs should differ
+                true_z = fn(tf.cast(low_x, tf.float32), tf.cast(low_y, tf.float32), p=1)
+                tf.debugging.assert_near(true_z, z, message=fn.__name__)
+
+    def test_chunked_moments(self):
+        # Offset features with a number of locations that isn't a multiple of the chunk size
+        x = 10 * tf.random.normal([2, 1000, 8]) + 50
+        moments = compute_chunked_moments(x, chunk_size=128, cross=True, third=True)
+        mu, var = tf.nn.moments(x, axes=1)
+        centered = x - mu[:, None]
+        tf.debugging.assert_near(mu, moments['mean'], rtol=1e-4)
+        tf.debugging.assert_near(var, moments['var'], rtol=1e-4)
+        tf.debugging.assert_near(tf.einsum('bnc,bnd->bcd', centered, centered) / 1000, moments['covar'],
+                                 rtol=1e-3, atol=1e-2)
+        tf.debugging.assert_near(tf.reduce_mean(centered ** 3, axis=1), moments['m3'], rtol=1e-3, atol=1)
+
+    def test_chunked_losses(self):
+        x = 2 * tf.random.normal([2, 1000, 8]) + 1
+        y = tf.random.normal([2, 1000, 8])
+        for fn in [compute_co_raw_m2_loss, compute_var_loss, compute_covar_loss, compute_skew_loss]:
+            with tf.GradientTape(persistent=True) as tape:
+                tape.watch(y)
+                z = fn(x, y, p=2)
+                chunked_z = fn(x, y, p=2, chunk_size=128)
+            tf.debugging.assert_near(z, chunked_z, rtol=1e-4, message=fn.__name__)
+
+            # Still differentiable
+            grad = tape.gradient(z, y)
+            chunked_grad = tape.gradient(chunked_z, y)
+            tf.debugging.assert_near(grad, chunked_grad, rtol=1e-3, atol=1e-6, message=fn.__name__)
+
+            # Also in graph mode, where the gradient is accumulated over the chunks in a loop
+            @tf.function
+            def chunked_grad_fn(y):
+                with tf.GradientTape() as tape:
+                    tape.watch(y)
+                    chunked_z = fn(x, y, p=2, chunk_size=128)
+                return tape.gradient(chunked_z, y)
+
+            tf.debugging.assert_near(grad, chunked_grad_fn(y), rtol=1e-3, atol=1e-6, message=fn.__name__)
+
+    def test_style_metrics(self):
+        x = tf.random.normal([2, 1024, 8])
+        y = 2 * tf.random.normal([2, 1024, 8]) + 1
+        single_metrics = [metrics.WassDist(), metrics.MeanLoss(), metrics.VarLoss(), metrics.CovarLoss(),
+                          metrics.SkewLoss(), metrics.GramLoss()]
+        for chunk_size in [None, 100]:
+            style_metrics = metrics.StyleMetrics(chunk_size=chunk_size)
+            for _ in range(2):
+                style_metrics.update_state(x, y)
+                for metric in single_metrics:
+                    metric.update_state(x, y)
+            results = style_metrics.result()
+            for metric in single_metrics:
+                tf.debugging.assert_near(metric.result(), results[metric.name], rtol=1e-4, message=metric.name)
+
+            style_metrics.reset_state()
+            for value in style_metrics.result().values():
+                tf.debugging.assert_equal(value, 0.0)
+
     def test_wass_dist(self):
         for _ in range(100):
             x = tf.random.normal([2, 1024, 8])
@@ -46,6 +119,77 @@ class TestDistributions(absltest.TestCase):
             our_wass_dist = compute_wass_dist(y, x, p=1)
             tf.debugging.assert_near(true_batch_wass_dist, our_wass_dist)
 
+    def test_incremental_sort(self):
+        # Odd number of locations with ties
+        x = tf.concat([tf.zeros([2, 11, 8]), tf.random.normal([2, 1000, 8])], axis=1)
+        y = tf.random.normal(x.shape)
+        for max_passes in [0, 4]:
+            incremental_sort = IncrementalSort(max_passes)
+            sort_fn = tf.function(incremental_sort)
+            for noise in [0, 0, 1e-3, 1e-3, 1]:
+                x = x + noise * tf.random.normal(x.shape)
+                tf.debugging.assert_equal(sort_fn(x), tf.sort(x, axis=1))
+                tf.debugging.assert_equal(tf.experimental.numpy.take_along_axis(x, incremental_sort.perm, axis=1),
+                                          tf.sort(x, axis=1))
+
+            # Same gradient as the Wasserstein loss
+            with tf.GradientTape(persistent=True) as tape:
+                tape.watch(x)
+                true_loss = compute_wass_dist(y, x, p=2)
+                loss = compute_sorted_wass_dist(tf.sort(y, axis=1), incremental_sort(x), p=2)
+            tf.debugging.assert_near(true_loss, loss)
+            tf.debugging.assert_near(tape.gradient(true_loss, x), tape.gradient(loss, x))
+
+    def test_sharded_stats(self):
+        x = 2 * tf.random.normal([1, 1000, 4]) + 1
+        y = tf.random.normal([1, 1000, 4])
+        shards = tf.split(x, 4, axis=1)
+
+        # The sums of the shards add up to the moments of the whole
+        pivot = tf.reduce_mean(y, axis=1)
+        shard_sums = [sharded.compute_shard_sums(shard, pivot, cross=True) for shard in shards]
+        sums = {key: tf.add_n([s[key] for s in shard_sums]) for key in shard_sums[0]}
+        moments = sharded.moments_from_sums(sums, pivot, cross=True)
+        style_moments = sharded.moments_from_sums(sharded.compute_shard_sums(y, pivot, cross=True), pivot, cross=True)
+        tf.debugging.assert_near(sharded.compute_moment_loss('m1_covar', style_moments, moments, p=2),
+                                 compute_mean_loss(y, x, p=2) + compute_covar_loss(y, x, p=2), rtol=1e-4)
+
+        # The quantile summaries give the exact distance with one full shard, and approximate it with several
+        def merge(shards, num_quantiles):
+            summaries = tf.stack([sharded.compute_quantile_summary(shard, num_quantiles) for shard in shards])
+            return sharded.merge_quantile_summaries(summaries, [shard.shape[1] for shard in shards])
+
+        style_values, style_levels = merge([y], 1000)
+        for shards, num_quantiles, rtol in [([x], 1000, 1e-5), (shards, 64, 0.05)]:
+            values, levels = merge(shards, num_quantiles)
+            wass_sum = 0
+            for shard in shards:
+                targets = sharded.compute_wass_targets(shard, values, levels, style_values, style_levels)
+                wass_sum += sharded.compute_shard_wass_sum(shard, targets, p=2)
+            tf.debugging.assert_near(wass_sum / 1000, compute_wass_dist(y, x, p=2), rtol=rtol)
+
+    def test_pool_style_feats(self):
+        x = tf.nn.relu(tf.random.normal([1, 16, 16, 4]))
+        y = tf.nn.relu(2 * tf.random.normal([1, 16, 16, 4]) + 1)
+        flat_x, flat_y = tf.reshape(x, [1, 256, 4]), tf.reshape(y, [1, 256, 4])
+        # With equal weights and sizes, the mixture of the styles is their concatenation
+        mixture = tf.concat([flat_x, flat_y], axis=1)
+
+        pooled = blending.pool_style_feats([x, y], [1, 1], 'm1_covar')
+        tf.debugging.assert_shapes([(pooled, x.shape)])
+        pooled = tf.reshape(pooled, [1, 256, 4])
+        tf.debugging.assert_near(compute_mean_loss(mixture, pooled, p=2) + compute_covar_loss(mixture, pooled, p=2),
+                                 tf.zeros([1]), atol=1e-8)
+
+        # Every other value of the sorted mixture, averaged with the next one
+        pooled = tf.reshape(blending.pool_style_feats([x, y], [1, 1], 'wass'), [1, 256, 4])
+        pairs = tf.reshape(tf.sort(mixture, axis=1), [1, 256, 2, 4])
+        tf.debugging.assert_near(tf.sort(pooled, axis=1), tf.reduce_mean(pairs, axis=2), atol=1e-5)
+
+        # Blending a style with itself gives back its distribution
+        pooled = blending.pool_style_feats([x, x], [1, 3], 'wass')
+        tf.debugging.assert_near(compute_wass_dist(flat_x, tf.reshape(pooled, [1, 256, 4]), p=2), tf.zeros([1]))
+
     def test_sampling(self):
         x = tf.random.normal([2, 1024, 8])
         sample_x1 = sample_k(x, None)
@@ -0,0 +1,48 @@
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.testing import absltest
+
+import image_store
+
+FLAGS = flags.FLAGS
+
+
+class TestImageStore(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_ingest(self):
+        image_dir = self.create_tempdir().full_path
+        for i in range(3):
+            image = tf.random.uniform([40 + i, 50, 3], maxval=256, dtype=tf.int32)
+            tf.io.write_file(os.path.join(image_dir, f'{i}.png'), tf.io.encode_png(tf.cast(image, tf.uint8)))
+
+        store_dir = self.create_tempdir().full_path
+        store = image_store.ImageStore(store_dir)
+        filepaths = image_store.find_images([image_dir])
+        self.assertEqual(store.ingest(filepaths, [0, 32], workers=2), 6)
+        # Already ingested images are skipped
+        self.assertEqual(store.ingest(filepaths, [32]), 0)
+
+        # Reading a new store from disk gives the decoded images
+        store = image_store.ImageStore(store_dir)
+        for filepath in filepaths:
+            for imsize in [0, 32]:
+                stored = store.read(store.find(filepath, imsize))
+                np.testing.assert_array_equal(stored, image_store.decode_image(filepath, imsize))
+        self.assertIsNone(store.find(filepaths[0], 64))
+
+        # Copies are found by their content hash
+        copy_path = os.path.join(self.create_tempdir().full_path, 'copy.png')
+        shutil.copy(filepaths[1], copy_path)
+        self.assertEqual(store.find(copy_path, 32), store.find(filepaths[1], 32))
+
+
+if __name__ == '__main__':
+    absltest.main()
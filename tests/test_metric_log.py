@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+from absl import flags
+from absl.testing import absltest
+
+import metric_log
+
+FLAGS = flags.FLAGS
+
+
+class TestMetricLog(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_log(self):
+        out_dir = self.create_tempdir().full_path
+        log = metric_log.MetricLog(out_dir, every=3, flush=3)
+        for epoch in range(10):
+            log.log(epoch, 10, {'loss': 1 / (epoch + 1), 'style_1_loss': epoch})
+        # Epochs 2, 5, 8 and the last epoch are logged. The last one is still buffered
+        logs_df = metric_log.read_logs(out_dir)
+        self.assertEqual(list(logs_df.columns), ['epoch', 'loss', 'style_1_loss'])
+        self.assertEqual(list(logs_df['epoch']), [2, 5, 8])
+        log.flush()
+        logs_df = metric_log.read_logs(out_dir)
+        self.assertEqual(list(logs_df['epoch']), [2, 5, 8, 9])
+        np.testing.assert_allclose(logs_df['loss'], [1 / 3, 1 / 6, 1 / 9, 1 / 10], rtol=1e-6)
+
+        # Appending continues the log and drops a partial row of an interrupted flush
+        with open(os.path.join(out_dir, 'logs.bin'), 'ab') as f:
+            f.write(b'\0' * 4)
+        log = metric_log.MetricLog(out_dir, append=True)
+        log.log(10, 11, {'loss': 0.5, 'style_1_loss': 10})
+        log.flush()
+        self.assertEqual(list(metric_log.read_logs(out_dir)['epoch']), [2, 5, 8, 9, 10])
+
+        # A new log replaces the old one
+        metric_log.MetricLog(out_dir)
+        self.assertIsNone(metric_log.read_logs(out_dir))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -1,9 +1,13 @@
 import tensorflow as tf
+import tensorflow_addons as tfa
 from absl import flags
 from absl.testing import absltest
+from absl.testing import flagsaver
 
 import model as scm
 import model.layers
+import distributions
+from distributions import losses, metrics
 
 FLAGS = flags.FLAGS
 
@@ -25,6 +29,238 @@ class TestModel(absltest.TestCase):
             metrics = sc_model.train_step(((x, y), feats))
             self.assertIsInstance(metrics, dict)
 
+    def test_mixed_precision_train_step(self):
+        FLAGS(['', '--feat_model=fast'])
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+        try:
+            feat_model = scm.make_feat_model([32, 32, 3])
+            sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0)
+            sc_model.compile(None, 'adam', loss={'style': [losses.WassLoss(), losses.WassLoss()]})
+            x = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+            y = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+            feats = {'style': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])],
+                     'content': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])]}
+            feats = tf.nest.map_structure(lambda f: tf.cast(f, tf.bfloat16), feats)
+            metrics = sc_model.train_step(((x, y), feats))
+
+            # Low precision features, full precision image and loss
+            tf.debugging.assert_type(sc_model((x, y))['style'][0], tf.bfloat16)
+            tf.debugging.assert_type(sc_model.gen_image, tf.float32)
+            tf.debugging.assert_type(metrics['loss'], tf.float32)
+        finally:
+            tf.keras.mixed_precision.set_global_policy('float32')
+
+    def test_phase_timer(self):
+        FLAGS(['', '--feat_model=fast'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0, profile_every=2)
+        sc_model.compile(None, 'adam',
+                         loss={'style': [tf.keras.losses.MeanSquaredError(), tf.keras.losses.MeanSquaredError()]})
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+        y = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+        feats = {'style': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])],
+                 'content': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])]}
+        train_step = tf.function(sc_model.train_step)
+        for _ in range(3):
+            train_step(((x, y), feats))
+
+        # Only every other step is timed
+        count, averages = sc_model.phase_timer.pop_averages()
+        self.assertEqual(count, 2)
+        self.assertGreater(sum(averages.values()), 0)
+        self.assertGreaterEqual(min(averages.values()), 0)
+        self.assertEqual(averages['disc_forward'], 0)
+        self.assertEqual(int(sc_model.phase_timer.count.numpy()), 0)
+
+        # Every timestamp, including the start, waits on some of the step's tensors
+        graph = train_step.get_concrete_function(((x, y), feats)).graph
+        timestamps = [op for op in graph.get_operations() if op.type == 'Timestamp']
+        self.assertNotEmpty(timestamps)
+        for op in timestamps:
+            self.assertNotEmpty(op.control_inputs)
+
+    def test_model_style_metrics(self):
+        FLAGS(['', '--feat_model=fast'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0)
+        sc_model.compile(None, 'adam',
+                         loss={'style': [tf.keras.losses.MeanSquaredError(), tf.keras.losses.MeanSquaredError()]},
+                         metrics={'style': [[metrics.StyleMetrics()], [metrics.StyleMetrics()]],
+                                  'content': [[], []]})
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+        y = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+        feats = {'style': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])],
+                 'content': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])]}
+        logs = sc_model.train_step(((x, y), feats))
+
+        # One flat entry per layer and metric
+        for name in metrics.StyleMetrics.names:
+            self.assertIn(f'style_1_{name}', logs)
+            self.assertIn(f'style_2_{name}', logs)
+
+    def test_shared_sorts(self):
+        FLAGS(['', '--feat_model=fast'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0)
+        style_losses = [losses.WassLoss(), losses.WassLoss()]
+        style_metrics = [[metrics.StyleMetrics()], [metrics.StyleMetrics()]]
+        sc_model.compile(None, 'adam', loss={'style': style_losses},
+                         metrics={'style': style_metrics, 'content': [[], []]})
+        self.assertEqual(sc_model.sort_sharers, [(style_losses[0], style_metrics[0]),
+                                                 (style_losses[1], style_metrics[1])])
+
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255, dtype=tf.int32)
+        feats = {'style': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])],
+                 'content': [tf.random.uniform([1, 16, 16, 3]), tf.random.uniform([1, 8, 8, 3])]}
+        logs = sc_model.test_step(((x, x), feats))
+
+        # Same values as sorting separately
+        gen_feats = sc_model((x, x))
+        total_loss = 0
+        for i, (y_true, y_pred) in enumerate(zip(feats['style'], gen_feats['style'])):
+            y_true, y_pred = scm.process_spatial_feats(y_true, None), scm.process_spatial_feats(y_pred, None)
+            tf.debugging.assert_near(logs[f'style_{i + 1}_wass_dist'],
+                                     tf.reduce_mean(distributions.compute_wass_dist(y_true, y_pred, p=1)))
+            layer_loss = style_losses[i](y_true, y_pred)
+            tf.debugging.assert_near(logs[f'style_{i + 1}_loss'], layer_loss)
+            total_loss += layer_loss
+        tf.debugging.assert_near(logs['loss'], total_loss)
+
+    def test_grouped_discriminator(self):
+        disc = scm.Discriminator([8, 16, 8], 'mlp')
+        self.assertEqual(disc.group_indices, [[0, 2], [1]])
+
+        feats = [tf.random.normal([1, 32, 8]), tf.random.normal([1, 64, 16]), tf.random.normal([1, 32, 8])]
+        logits = disc(feats, training=False)
+        tf.debugging.assert_shapes([(logits[0], [2, 1, 32, 1]), (logits[1], [1, 1, 64, 1])])
+
+        # Same as running each layer's MLP separately
+        for j, i in enumerate(disc.group_indices[0]):
+            x = feats[i]
+            for k, layer in enumerate(disc.group_layers[0]):
+                x = tf.matmul(x, layer.kernel[j]) + layer.bias[j, 0]
+                if k < len(disc.group_layers[0]) - 1:
+                    x = tf.nn.relu(x)
+            tf.debugging.assert_near(x, logits[0][j], atol=1e-5)
+
+        # Members with different numbers of locations are applied separately
+        feats[2] = tf.random.normal([1, 16, 8])
+        logits = disc(feats, training=False)
+        tf.debugging.assert_shapes([(logits[0], [1, 1, 32, 1]), (logits[1], [1, 1, 16, 1]),
+                                    (logits[2], [1, 1, 64, 1])])
+
+    def test_spectral_norm(self):
+        layer = model.layers.GroupedSNDense(3, 16, 8, power_iterations=20)
+        layer.build(None)
+        # The power iteration estimate persists across calls
+        for _ in range(10):
+            layer.normalize_weights()
+        singular_values = tf.linalg.svd(layer.kernel, compute_uv=False)
+        tf.debugging.assert_near(singular_values[:, 0], tf.ones([3]), rtol=1e-2)
+
+    def test_grouped_init(self):
+        layer = model.layers.GroupedSNDense(3, 16, 8)
+        layer.build(None)
+        # Every member gets its own initial kernel
+        for i, j in [(0, 1), (0, 2), (1, 2)]:
+            self.assertFalse(bool(tf.reduce_all(layer.kernel[i] == layer.kernel[j])))
+        limit = (6 / (16 + 8)) ** 0.5
+        self.assertLessEqual(float(tf.reduce_max(tf.abs(layer.kernel))), limit)
+
+    def test_model_disc_train_step(self):
+        for disc_model in ['fast', 'mlp']:
+            FLAGS(['', '--feat_model=fast', f'--disc_model={disc_model}'])
+            feat_model = scm.make_feat_model([32, 32, 3])
+            sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0)
+            x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+            sc_model.configure(x, x)
+            sc_model.compile(tf.keras.optimizers.Adam(), 'adam',
+                             loss={'style': [tf.keras.losses.MeanSquaredError(), tf.keras.losses.MeanSquaredError()]})
+            feats = sc_model.feat_model((x, x))
+            metrics = tf.function(sc_model.train_step)(((x, x), feats))
+            self.assertIn('d_loss', metrics)
+            self.assertBetween(float(metrics['d_acc']), 0, 1)
+
+    @flagsaver.flagsaver
+    def test_disc_schedule(self):
+        FLAGS(['', '--feat_model=fast', '--disc_model=mlp', '--n_critic=2', '--disc_acc_bounds=0,0',
+               '--disc_max_skip=2'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0, disc_sample_size=64)
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        sc_model.configure(x, x)
+        sc_model.compile(tfa.optimizers.LAMB(), 'adam',
+                         loss={'style': [tf.keras.losses.MeanSquaredError(), tf.keras.losses.MeanSquaredError()]})
+        feats = sc_model.feat_model((x, x))
+        train_fn = tf.function(sc_model.train_step)
+
+        # The first step always updates, then the saturated discriminator is skipped for disc_max_skip steps
+        d_updates = [int(train_fn(((x, x), feats))['d_updates']) for _ in range(4)]
+        self.assertEqual(d_updates, [1, 1, 1, 2])
+        self.assertEqual(int(sc_model.disc_opt.iterations), 2 * 2)
+        self.assertBetween(float(sc_model.last_d_acc), 0, 1)
+
+    @flagsaver.flagsaver
+    def test_disc_schedule_flags(self):
+        # Without any critic update the discriminator loss would be undefined
+        for arg in ['--n_critic=0', '--disc_every=0']:
+            with self.assertRaises(flags.IllegalFlagValueError):
+                FLAGS(['', arg])
+
+    @flagsaver.flagsaver
+    def test_weight_store_flags(self):
+        FLAGS(['', '--weight_store=out/weight_store', '--feat_model=vgg19'])
+        for feat_model in ['nasnetlarge', 'fast']:
+            with self.assertRaises(flags.IllegalFlagValueError):
+                FLAGS(['', '--weight_store=out/weight_store', f'--feat_model={feat_model}'])
+
+    def test_start_images(self):
+        style_image = tf.random.uniform([1, 16, 16, 3], maxval=255)
+        content_image = tf.random.normal([1, 16, 16, 3], mean=100, stddev=20)
+        style_pixels = tf.reshape(style_image, [-1, 3])
+        for match_fn in [scm.match_color, scm.match_histograms, scm.transfer_moments]:
+            pixels = tf.reshape(match_fn(content_image, style_image), [-1, 3])
+            tf.debugging.assert_near(tf.reduce_mean(pixels, 0), tf.reduce_mean(style_pixels, 0), atol=1e-2)
+            tf.debugging.assert_near(tf.math.reduce_std(pixels, 0), tf.math.reduce_std(style_pixels, 0), rtol=1e-2)
+
+        # Histogram matching keeps the order of the content pixels and takes the values of the style pixels
+        matched = tf.reshape(scm.match_histograms(content_image, style_image), [-1, 3])
+        tf.debugging.assert_equal(tf.sort(matched, axis=0), tf.sort(style_pixels, axis=0))
+        tf.debugging.assert_equal(tf.argsort(matched, axis=0), tf.argsort(tf.reshape(content_image, [-1, 3]), axis=0))
+
+        # The moment transfer also matches the covariances
+        pixels = tf.reshape(scm.transfer_moments(content_image, style_image), [-1, 3])
+        centered, style_centered = pixels - tf.reduce_mean(pixels, 0), style_pixels - tf.reduce_mean(style_pixels, 0)
+        tf.debugging.assert_near(tf.matmul(centered, centered, transpose_a=True),
+                                 tf.matmul(style_centered, style_centered, transpose_a=True), rtol=1e-2, atol=1)
+
+        # Working image sizes, where the rank times the number of style pixels doesn't fit in int32
+        content_image = tf.random.uniform([1, 256, 256, 3], maxval=255)
+        style_image = tf.random.uniform([1, 256, 256, 3], maxval=255)
+        matched = tf.reshape(scm.match_histograms(content_image, style_image), [-1, 3])
+        tf.debugging.assert_equal(tf.sort(matched, axis=0), tf.sort(tf.reshape(style_image, [-1, 3]), axis=0))
+
+    def test_in_graph_targets(self):
+        FLAGS(['', '--feat_model=fast'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        feats = feat_model((x, x))
+        loss = {'style': [tf.keras.losses.MeanSquaredError(), tf.keras.losses.MeanSquaredError()]}
+
+        # Same losses as streaming the targets as data
+        logs = []
+        for in_graph in [False, True]:
+            sc_model = scm.SCModel(feat_model, sample_size=None, loss_warmup=0)
+            sc_model.configure(x, x)
+            sc_model.gen_image.assign(tf.fill(sc_model.gen_image.shape, 128.0))
+            sc_model.compile(None, 'adam', loss=loss)
+            if in_graph:
+                sc_model.set_targets((x, x), feats)
+                logs.append(tf.function(sc_model.train_step)(tf.zeros([1])))
+            else:
+                logs.append(tf.function(sc_model.train_step)(((x, x), feats)))
+        tf.debugging.assert_near(logs[0]['loss'], logs[1]['loss'])
+
     def test_model_call(self):
         FLAGS(['', '--feat_model=fast'])
         feat_model = scm.make_feat_model([32, 32, 3])
@@ -74,6 +310,57 @@ class TestModel(absltest.TestCase):
         tf.debugging.assert_near(y_mean, tf.zeros_like(y_mean), atol=1e-5, message='mean not zero')
         tf.debugging.assert_near(y_var, tf.ones_like(y_var), rtol=1e-5, message='variance not one')
 
+    @flagsaver.flagsaver
+    def test_fuse_feat_transforms(self):
+        FLAGS(['', '--feat_model=fast', '--shift', '--scale'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        feats_dict = feat_model((x, x))
+
+        # Chain PCA layers after the standardize layers like SCModel.configure
+        outputs, transforms = {}, {}
+        for key in ['style', 'content']:
+            outputs[key], transforms[key] = [], []
+            for output, feats, standardize in zip(feat_model.output[key], feats_dict[key],
+                                                  feat_model.standardize_layers[key]):
+                proj = model.layers.PCA(2)
+                outputs[key].append(proj(output))
+                proj.configure(feats)
+                transforms[key].append([standardize, proj])
+        chain_model = tf.keras.Model(feat_model.input, outputs)
+        fused_model = scm.fuse_feat_transforms(chain_model, transforms)
+        for layer in fused_model.layers:
+            self.assertNotIsInstance(layer, (model.layers.Standardize, model.layers.PCA))
+
+        x2 = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        chain_feats, fused_feats = chain_model((x2, x2)), fused_model((x2, x2))
+        for key in ['style', 'content']:
+            for chain_out, fused_out in zip(chain_feats[key], fused_feats[key]):
+                tf.debugging.assert_shapes([(fused_out, chain_out.shape)])
+                tf.debugging.assert_near(fused_out, chain_out, atol=1e-4, rtol=1e-4)
+
+    @flagsaver.flagsaver
+    def test_backbone_feats(self):
+        FLAGS(['', '--feat_model=fast'])
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        backbone_feats = scm.make_feat_model([32, 32, 3])((x, x))
+
+        # Undoes the standardization
+        FLAGS(['', '--feat_model=fast', '--shift', '--scale'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        feats = feat_model((x, x))
+        for key in ['style', 'content']:
+            for feats_a, feats_b in zip(scm.get_backbone_feats(feat_model, feats[key], key), backbone_feats[key]):
+                tf.debugging.assert_near(feats_a, feats_b, rtol=1e-4, atol=1e-2)
+
+    def test_style_branch(self):
+        FLAGS(['', '--feat_model=fast'])
+        feat_model = scm.make_feat_model([32, 32, 3])
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        style_branch = scm.get_style_branch(feat_model)
+        self.assertEqual(list(style_branch.output), ['style'])
+        tf.nest.map_structure(tf.debugging.assert_equal, feat_model((x, x))['style'], style_branch(x)['style'])
+
     def test_model_warmup(self):
         FLAGS(['', '--feat_model=fast'])
         feat_model = scm.make_feat_model([32, 32, 3])
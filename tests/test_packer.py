@@ -0,0 +1,38 @@
+from absl import flags
+from absl.testing import absltest
+
+import packer
+
+FLAGS = flags.FLAGS
+
+
+class TestPacker(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_cpu_sets(self):
+        cpu_sets = packer.get_cpu_sets(4, cpus=range(10))
+        self.assertEqual(cpu_sets, [[0, 1], [2, 3], [4, 5], [6, 7]])
+
+        # Disjoint sets
+        cpu_sets = packer.get_cpu_sets(3, cpus=range(64))
+        all_cpus = [cpu for cpus in cpu_sets for cpu in cpus]
+        self.assertEqual(len(all_cpus), len(set(all_cpus)))
+
+        with self.assertRaises(ValueError):
+            packer.get_cpu_sets(8, cpus=range(4))
+
+    def test_candidate_workers(self):
+        self.assertEqual(packer.get_candidate_workers(64, 100), [1, 2, 4, 8, 16, 32, 64])
+        self.assertEqual(packer.get_candidate_workers(64, 5), [1, 2, 4])
+
+    def test_read_jobs(self):
+        filepath = self.create_tempfile(content='# comment\n--loss=wass --style_image="a b.jpg"\n\n--loss=m1\n')
+        jobs = packer.read_jobs(filepath.full_path)
+        self.assertEqual(jobs, [['--loss=wass', '--style_image=a b.jpg'], ['--loss=m1']])
+
+
+if __name__ == '__main__':
+    absltest.main()
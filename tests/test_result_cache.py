@@ -0,0 +1,75 @@
+import os
+import time
+
+import numpy as np
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+import metric_log
+from result_cache import ResultCache, make_result_cache
+
+FLAGS = flags.FLAGS
+
+
+class TestResultCache(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_lookup(self):
+        cache = ResultCache(self.create_tempdir().full_path, max_mb=16)
+        out_dir = self.create_tempdir().full_path
+        log = metric_log.MetricLog(out_dir)
+        log.log(0, 1, {'loss': 1.0})
+        log.flush()
+        key = cache.get_key(b'style', b'content', 'loss=wass')
+        self.assertNotEqual(key, cache.get_key(b'style', b'content', 'loss=m1'))
+
+        gen_image = np.random.uniform(0, 255, [1, 8, 8, 3]).astype(np.float32)
+        cache.save(key, 100, gen_image, out_dir)
+
+        # Exact hit, partial hit with more steps and miss with fewer steps
+        steps, entry_dir = cache.lookup(key, 100)
+        self.assertEqual(steps, 100)
+        np.testing.assert_array_equal(cache.load_gen_image(entry_dir), gen_image)
+        self.assertEqual(cache.lookup(key, 300)[0], 100)
+        self.assertIsNone(cache.lookup(key, 50))
+
+        restore_dir = self.create_tempdir().full_path
+        cache.restore(entry_dir, restore_dir)
+        self.assertEqual(metric_log.read_logs(restore_dir)['loss'].tolist(), [1.0])
+
+    def test_evict(self):
+        cache = ResultCache(self.create_tempdir().full_path, max_mb=1)
+        out_dir = self.create_tempdir().full_path
+        # Each entry is 0.4MB
+        gen_image = np.zeros([1, 200, 256, 2], np.float32)
+        for key in ['a', 'b']:
+            cache.save(key, 10, gen_image, out_dir)
+            time.sleep(0.01)
+        # Reading 'a' makes 'b' the least recently used
+        cache.lookup('a', 10)
+        cache.save('c', 10, gen_image, out_dir)
+        self.assertIsNotNone(cache.lookup('a', 10))
+        self.assertIsNone(cache.lookup('b', 10))
+        self.assertIsNotNone(cache.lookup('c', 10))
+
+
+    @flagsaver.flagsaver
+    def test_blend_key(self):
+        # Blends of the same bytes split differently between the style files are different styles
+        filepaths = []
+        for name, contents in [('a1', b'ab'), ('b1', b'c'), ('a2', b'a'), ('b2', b'bc')]:
+            filepaths.append(self.create_tempfile(name, content=contents).full_path)
+        keys = []
+        for style_image, blend_style in [filepaths[:2], filepaths[2:]]:
+            FLAGS.result_cache = self.create_tempdir().full_path
+            FLAGS.style_image, FLAGS.blend_styles = style_image, [blend_style]
+            keys.append(make_result_cache()[1])
+        self.assertNotEqual(keys[0], keys[1])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,75 @@
+import tensorflow as tf
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+import sharded
+
+FLAGS = flags.FLAGS
+
+
+def make_conv_feat_model():
+    style_input = tf.keras.Input([None, None, 3], name='style')
+    content_input = tf.keras.Input([None, None, 3], name='content')
+    conv1 = tf.keras.layers.Conv2D(4, 3, padding='same', activation='relu')
+    pool = tf.keras.layers.AveragePooling2D(2)
+    conv2 = tf.keras.layers.Conv2D(4, 5, padding='same', activation='relu')
+    style_outputs = [conv1(style_input), conv2(pool(conv1(style_input)))]
+    content_outputs = [conv2(pool(conv1(content_input)))]
+    return tf.keras.Model([style_input, content_input], {'style': style_outputs, 'content': content_outputs})
+
+
+class TestSharded(absltest.TestCase):
+    def test_split_rows(self):
+        rows = sharded.split_rows(100, 3, align=8)
+        self.assertEqual(rows, [(0, 32), (32, 64), (64, 100)])
+        for start, _ in rows:
+            self.assertEqual(start % 8, 0)
+
+        with self.assertRaises(ValueError):
+            sharded.split_rows(16, 3, align=8)
+
+    def test_receptive_field(self):
+        halo, strides = sharded.measure_receptive_field(make_conv_feat_model())
+        # One row for the first convolution, and two pooled rows for the second
+        self.assertEqual(halo, 5)
+        self.assertEqual(strides, {'style': [1, 2], 'content': [2]})
+
+    def test_shard_feats(self):
+        # The features of the shards with their halos are the features of the whole image
+        feat_model = make_conv_feat_model()
+        halo, strides = sharded.measure_receptive_field(feat_model)
+        halo = -(-halo // 2) * 2
+        image = tf.random.uniform([1, 50, 20, 3], maxval=255)
+        feats = feat_model((image, image))
+
+        rows = sharded.split_rows(50, 3, align=2)
+        shard_feats = []
+        for index in range(3):
+            transfer = sharded.ShardedTransfer(feat_model, strides, rows, index, halo, 'm1', num_quantiles=8)
+            ext_image = image[:, transfer.ext_start:transfer.ext_end]
+            shard_feats.append(transfer.crop_feats(feat_model((ext_image, ext_image))))
+        for i, feat in enumerate(tf.nest.flatten(feats)):
+            shard_feat = tf.concat([tf.nest.flatten(f)[i] for f in shard_feats], axis=1)
+            tf.debugging.assert_near(feat, shard_feat, atol=1e-3)
+
+    def test_content_terms(self):
+        feat_model = make_conv_feat_model()
+        halo, strides = sharded.measure_receptive_field(feat_model)
+        transfer = sharded.ShardedTransfer(feat_model, strides, [(0, 16)], 0, halo, 'm1', num_quantiles=8)
+        ctx = tf.distribute.get_replica_context()
+        style_image = tf.random.uniform([1, 16, 16, 3], maxval=255)
+        content_image = tf.random.uniform([1, 16, 16, 3], maxval=255)
+        FLAGS([''])
+
+        # Without a content image, the style image isn't also a content target
+        for content_path, num_content in [(None, 0), ('content.jpg', 1)]:
+            with flagsaver.flagsaver(content_image=content_path):
+                targets = transfer.configure(ctx, style_image, content_image)
+                losses = transfer.compute_losses(ctx, style_image, *targets)
+            self.assertLen(targets[1], num_content)
+            self.assertLen([key for key in losses if key.startswith('content')], num_content)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,45 @@
+import os
+
+from absl import flags
+from absl.testing import absltest
+
+import metric_log
+import sweep
+
+FLAGS = flags.FLAGS
+
+
+class TestSweep(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_expand_grid(self):
+        grid = sweep.parse_grid(['loss=wass,m1_m2', 'gen_lr=1,0.1,0.01'])
+        all_params = sweep.expand_grid(grid)
+        self.assertLen(all_params, 6)
+        self.assertEqual(all_params[0], {'loss': 'wass', 'gen_lr': '1'})
+
+        # Every run gets its own output directory
+        self.assertLen({sweep.get_run_name(params) for params in all_params}, 6)
+
+        with self.assertRaises(ValueError):
+            sweep.parse_grid(['not_a_flag=1,2'])
+
+    def test_collect_results(self):
+        out_dir = self.create_tempdir().full_path
+        log = metric_log.MetricLog(out_dir)
+        log.log(0, 2, {'loss': 2.0})
+        log.log(1, 2, {'loss': 1.5})
+        log.flush()
+        with open(os.path.join(out_dir, 'raw_metrics.csv'), 'w') as f:
+            f.write('style_1_mean_loss,0.5\ntotal_mean_loss,0.5\n\nstyle_1_var_loss,2.0\ntotal_var_loss,2.0\n\n')
+        results = sweep.collect_results(out_dir)
+        self.assertEqual(results['final_loss'], 1.5)
+        self.assertEqual(results['total_mean_loss'], 0.5)
+        self.assertEqual(results['total_var_loss'], 2.0)
+
+
+if __name__ == '__main__':
+    absltest.main()
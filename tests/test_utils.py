@@ -1,7 +1,9 @@
 import tensorflow as tf
 from absl import flags
 from absl.testing import absltest
+from absl.testing import flagsaver
 
+import model as scm
 import utils
 
 FLAGS = flags.FLAGS
@@ -26,6 +28,33 @@ class TestUtils(absltest.TestCase):
             tf.debugging.assert_greater_equal(content_image, tf.zeros_like(content_image))
             tf.debugging.assert_less_equal(content_image, tf.ones_like(content_image))
 
+    def test_to_pixel_range(self):
+        # Same range as the generated image with and without resizing
+        for imsize in [None, 64]:
+            with flagsaver.flagsaver(style_image='../imgs/starry_night.jpg', imsize=imsize):
+                style_image, _ = utils.load_sc_images()
+                image = utils.to_pixel_range(style_image)
+            self.assertGreater(float(tf.reduce_max(image)), 1)
+            tf.debugging.assert_less_equal(image, tf.fill(tf.shape(image), 255.0))
+
+    @flagsaver.flagsaver
+    def test_feat_cache(self):
+        FLAGS(['', '--feat_model=fast', '--shift', '--scale', f'--feat_cache={self.create_tempdir().full_path}'])
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        feat_model = scm.make_feat_model([32, 32, 3])
+        feats_dict = utils.get_feats(feat_model, (x, x))
+
+        # A cache hit configures the standardize layers of a new model like the first features did
+        cached_model = scm.make_feat_model([32, 32, 3])
+        cached_feats = utils.get_feats(cached_model, (x, x))
+        tf.nest.map_structure(tf.debugging.assert_equal, feats_dict, cached_feats)
+        x2 = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        tf.nest.map_structure(tf.debugging.assert_near, feat_model((x2, x2)), cached_model((x2, x2)))
+
+        # Same values with a different shape are a different entry
+        self.assertNotEqual(utils.get_feat_cache_path([tf.zeros([1, 8, 8, 3])]),
+                            utils.get_feat_cache_path([tf.zeros([1, 4, 16, 3])]))
+
 
 if __name__ == '__main__':
     absltest.main()
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.testing import absltest
+
+import warm_start
+
+FLAGS = flags.FLAGS
+
+
+class TestWarmStart(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_nearest(self):
+        index = warm_start.WarmStartIndex(self.create_tempdir().full_path)
+        content_feats = [[tf.random.normal([1, 4, 4, 8])] for _ in range(3)]
+        for i, feats in enumerate(content_feats):
+            gen_image = tf.fill([16, 16, 3], i)
+            index.add(b'style', 'vgg19', warm_start.get_content_descriptor(feats), gen_image, {'train_steps': i})
+
+        # A slightly different content finds its nearest entry
+        query = warm_start.get_content_descriptor([content_feats[1][0] + 0.01 * tf.random.normal([1, 4, 4, 8])])
+        similarity, entry, image = index.nearest(b'style', 'vgg19', query)
+        self.assertGreater(similarity, 0.99)
+        self.assertEqual(entry['train_steps'], 1)
+        np.testing.assert_array_equal(image.numpy(), np.ones([16, 16, 3]))
+
+        # Other styles and feature models have their own entries
+        self.assertIsNone(index.nearest(b'other style', 'vgg19', query))
+        self.assertIsNone(index.nearest(b'style', 'nasnetlarge', query))
+
+    def test_concurrent_adds(self):
+        index = warm_start.WarmStartIndex(self.create_tempdir().full_path)
+        descriptors = [warm_start.get_content_descriptor([tf.random.normal([1, 4, 4, 8])]) for _ in range(8)]
+
+        def add(descriptor):
+            index.add(b'style', 'vgg19', descriptor, tf.zeros([16, 16, 3]), {})
+
+        # Every entry is kept
+        with ThreadPoolExecutor(len(descriptors)) as executor:
+            list(executor.map(add, descriptors))
+        stored, entries = index.load_group(index.get_group_dir(b'style', 'vgg19'))
+        self.assertLen(entries, len(descriptors))
+        self.assertLen(stored, len(descriptors))
+
+
+if __name__ == '__main__':
+    absltest.main()
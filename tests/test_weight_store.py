@@ -0,0 +1,48 @@
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl.testing import absltest
+
+import model as scm
+import weight_store
+
+FLAGS = flags.FLAGS
+
+
+class TestWeightStore(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        # The temporary directories need the flags to be parsed
+        FLAGS([''])
+
+    def test_arrays(self):
+        root = self.create_tempdir().full_path
+        arrays = {'a': np.random.normal(size=[3]), 'b': np.random.normal(size=[5, 7])}
+        weight_store.save_arrays(root, 'foo', arrays)
+        tensors = weight_store.load_arrays(root, 'foo')
+        for key, array in arrays.items():
+            self.assertEqual(tensors[key].dtype, tf.float32)
+            np.testing.assert_array_equal(tensors[key], array.astype(np.float32))
+
+    def test_stored_vgg19(self):
+        root = self.create_tempdir().full_path
+        vgg19 = tf.keras.applications.VGG19(include_top=False, weights=None)
+        weight_store.convert_vgg19(vgg19, root)
+
+        # Only the layers up to the deepest output are built
+        stored_vgg19 = scm.make_stored_vgg19(root, ['block1_conv1', 'block3_conv1'])
+        self.assertEqual(stored_vgg19.layers[-1].name, 'block3_conv1')
+        with self.assertRaises(ValueError):
+            scm.make_stored_vgg19(root, ['block6_conv1'])
+
+        names = ['block1_conv1', 'block3_conv1', 'block5_conv2']
+        stored_vgg19 = scm.make_stored_vgg19(root, names)
+        x = tf.random.uniform([1, 32, 32, 3], maxval=255)
+        feats = tf.keras.Model(vgg19.input, [vgg19.get_layer(name).output for name in names])(x)
+        stored_feats = tf.keras.Model(stored_vgg19.input, [stored_vgg19.get_layer(name).output for name in names])(x)
+        for feat, stored_feat in zip(feats, stored_feats):
+            tf.debugging.assert_near(stored_feat, feat)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -8,6 +8,8 @@ from absl import flags
 from absl import logging
 
 from distributions import losses, metrics
+from metric_log import MetricLogger
+from profiling import make_profiling_callbacks
 
 FLAGS = flags.FLAGS
 
@@ -26,6 +28,10 @@ flags.DEFINE_float('beta1', 0.9, 'optimizer first moment parameter')
 flags.DEFINE_float('beta2', 0.99, 'optimizer second moment parameter')
 flags.DEFINE_float('epsilon', 1e-7, 'epsilon')
 
+flags.DEFINE_integer('moment_chunk', None, 'accumulate the moments of the losses and metrics over chunks of this '
+                                           'many locations to bound the memory of the second and third moments '
+                                           '(optional)')
+
 
 class TransferCheckpoint(tf.keras.callbacks.Callback):
     def __init__(self, out_dir, *args, **kwargs):
@@ -67,32 +73,57 @@ def make_dataset(strategy, images, feats_dict):
     return dist_ds
 
 
-def train(sc_model, ds, out_dir):
+def make_step_dataset(strategy):
+    # The targets are in the model, so the dataset only drives the steps
+    ds = tf.data.Dataset.from_tensors(0).repeat().batch(strategy.num_replicas_in_sync, drop_remainder=True)
+    return strategy.experimental_distribute_dataset(ds)
+
+
+def train(sc_model, ds, out_dir, initial_step=0):
     start_time = datetime.datetime.now()
+    metric_logger = MetricLogger(out_dir, append=initial_step > 0)
     try:
-        callbacks = [
-            tf.keras.callbacks.CSVLogger(f'{out_dir}/logs.csv'),
-        ]
+        callbacks = [metric_logger]
         if FLAGS.checkpoints:
             callbacks.append(TransferCheckpoint(out_dir))
             logging.info('saving checkpoints')
+        callbacks.extend(make_profiling_callbacks(out_dir))
 
         history = sc_model.fit(ds, epochs=FLAGS.train_steps // FLAGS.steps_exec,
+                               initial_epoch=initial_step // FLAGS.steps_exec,
                                steps_per_epoch=FLAGS.steps_exec, verbose=FLAGS.verbose, callbacks=callbacks)
         for key, val in history.history.items():
             history.history[key] = val[-1]
         logging.info(history.history)
     except KeyboardInterrupt:
         logging.info('caught keyboard interrupt. ended training early')
+        metric_logger.metric_log.flush()
     end_time = datetime.datetime.now()
     duration = end_time - start_time
     logging.info(f'training took {duration}')
 
+    # Fewer than --train_steps if training was interrupted
+    return int(sc_model.optimizer.iterations.numpy())
+
+
+def make_style_loss(loss_key):
+    loss_class = losses.loss_dict[loss_key]
+    if issubclass(loss_class, losses.MomentLoss):
+        return loss_class(chunk_size=FLAGS.moment_chunk)
+    return loss_class()
+
+
+def make_style_metrics():
+    return [metrics.StyleMetrics(chunk_size=FLAGS.moment_chunk)]
+
 
 def compile_sc_model(strategy, sc_model, loss_key, with_metrics):
+    if FLAGS.wass_incremental and sc_model.sample_size is not None:
+        logging.warning('--wass_incremental falls back to full sorts with --sample_size, '
+                        'which resamples the features every step')
     with strategy.scope():
         # Style loss
-        loss_dict = {'style': [losses.loss_dict[loss_key]() for _ in sc_model.feat_model.output['style']]}
+        loss_dict = {'style': [make_style_loss(loss_key) for _ in sc_model.feat_model.output['style']]}
 
         # Content loss
         if FLAGS.content_image is not None:
@@ -112,10 +143,7 @@ def compile_sc_model(strategy, sc_model, loss_key, with_metrics):
 
         # Metrics?
         if with_metrics:
-            metric_dict = {'style': [
-                [metrics.WassDist(), metrics.MeanLoss(), metrics.VarLoss(), metrics.CovarLoss(), metrics.SkewLoss(),
-                 metrics.GramLoss()]
-                for _ in sc_model.feat_model.output['style']],
+            metric_dict = {'style': [make_style_metrics() for _ in sc_model.feat_model.output['style']],
                 'content': [[] for _ in sc_model.feat_model.output['content']]}
         else:
             metric_dict = None
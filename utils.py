@@ -1,11 +1,17 @@
+import hashlib
 import os
 import shutil
 
+import numpy as np
 import tensorflow as tf
 from absl import flags, logging
 from matplotlib import pyplot as plt
 from tensorflow.keras import mixed_precision
 
+from distributions import compute_chunked_moments
+from image_store import load_stored_image
+from model.layers import Standardize
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string('style_image', None, 'path to the style image')
@@ -14,14 +20,36 @@ flags.DEFINE_integer('imsize', None, 'image size')
 
 flags.DEFINE_enum('strategy', None, ['tpu', 'multi_cpu'], 'distributed strategy. '
                                                           'multi_cpu is mainly used for debugging purposes.')
-flags.DEFINE_enum('policy', 'float32', ['float32', 'mixed_bfloat16'], 'floating point precision policy')
+flags.DEFINE_enum('policy', 'float32', ['float32', 'mixed_bfloat16', 'mixed_float16'],
+                  'floating point precision policy. '
+                  'the feature model runs in low precision while the losses and metrics accumulate in float32. '
+                  'use mixed_bfloat16 on TPUs and on CPUs with oneDNN bfloat16 support')
+
+flags.DEFINE_integer('seed', None, 'random seed (optional)')
+flags.DEFINE_string('out_dir', None, 'output directory of the run. defaults to out/{loss}-{disc_model}')
+flags.DEFINE_integer('intra_threads', None, 'threads used within an op. defaults to all the cores')
+flags.DEFINE_integer('inter_threads', None, 'ops run in parallel. defaults to all the cores')
+flags.DEFINE_string('feat_cache', None, 'directory to cache the style and content features in. '
+                                        'can be shared between runs (optional)')
+
+
+def set_threads():
+    # Must be set before Tensorflow initializes
+    if FLAGS.intra_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(FLAGS.intra_threads)
+    if FLAGS.inter_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(FLAGS.inter_threads)
 
 
 def setup():
     # Make base dir
-    loss_dir = f'out/{FLAGS.loss}-{FLAGS.disc_model}'
+    loss_dir = FLAGS.out_dir or f'out/{FLAGS.loss}-{FLAGS.disc_model}'
     shutil.rmtree(loss_dir, ignore_errors=True)
-    os.mkdir(loss_dir)
+    os.makedirs(loss_dir)
+
+    set_threads()
+    if FLAGS.seed is not None:
+        tf.random.set_seed(FLAGS.seed)
 
     if FLAGS.strategy == 'tpu':
         resolver = tf.distribute.cluster_resolver.TPUClusterResolver()
@@ -36,28 +64,88 @@ def setup():
     # Policy
     policy = mixed_precision.Policy(FLAGS.policy)
     mixed_precision.set_global_policy(policy)
+    if policy.compute_dtype != 'float32':
+        logging.info(f'computing features in {policy.compute_dtype} with float32 loss accumulation')
 
     return strategy, loss_dir
 
 
+def load_image(filepath):
+    image = load_stored_image(filepath, FLAGS.imsize)
+    if image is not None:
+        image = tf.constant(image)
+        # Resized images are stored rounded from the float values that smart_resize outputs
+        if FLAGS.imsize is not None:
+            image = tf.cast(image, tf.float32)
+    else:
+        image = tf.image.decode_image(tf.io.read_file(filepath))
+        if FLAGS.imsize is not None:
+            image = tf.keras.preprocessing.image.smart_resize(image, [FLAGS.imsize, FLAGS.imsize])
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    return tf.expand_dims(image, 0)
+
+
+def to_pixel_range(image):
+    # The generated image is in [0, 255], but load_image only keeps that range for the resized images
+    if FLAGS.imsize is None:
+        image = image * 255
+    return image
+
+
 def load_sc_images():
-    style_image = tf.image.decode_image(tf.io.read_file(FLAGS.style_image))
-    if FLAGS.imsize is not None:
-        style_image = tf.keras.preprocessing.image.smart_resize(style_image, [FLAGS.imsize, FLAGS.imsize])
-    style_image = tf.image.convert_image_dtype(style_image, tf.float32)
-    style_image = tf.expand_dims(style_image, 0)
+    style_image = load_image(FLAGS.style_image)
 
     content_image = style_image
     if FLAGS.content_image is not None:
-        content_image = tf.image.decode_image(tf.io.read_file(FLAGS.content_image))
-        if FLAGS.imsize is not None:
-            content_image = tf.keras.preprocessing.image.smart_resize(content_image, [FLAGS.imsize, FLAGS.imsize])
-        content_image = tf.image.convert_image_dtype(content_image, tf.float32)
-        content_image = tf.expand_dims(content_image, 0)
+        content_image = load_image(FLAGS.content_image)
 
     return style_image, content_image
 
 
+def get_feat_cache_path(images):
+    # Keyed by the image shapes and contents and the flags that affect the raw features
+    h = hashlib.sha1()
+    for image in images:
+        h.update(f'{list(image.shape)};'.encode())
+        h.update(tf.cast(image, tf.float32).numpy().tobytes())
+    for name in ['feat_model', 'layers', 'shift', 'scale', 'policy']:
+        h.update(f'{name}={FLAGS[name].value};'.encode())
+    return os.path.join(FLAGS.feat_cache, f'{h.hexdigest()}.npz')
+
+
+def get_feats(feat_model, images):
+    if FLAGS.feat_cache is None:
+        return feat_model(images, training=False)
+
+    # The standardize layers are configured on the first features, so their statistics are cached with them
+    standardize_layers = [layer for layer in feat_model.layers if isinstance(layer, Standardize)]
+    filepath = get_feat_cache_path(images)
+    if os.path.exists(filepath):
+        with np.load(filepath) as data:
+            feats_dict = {key: [tf.constant(data[f'{key}_{i}'], dtype=feat_model.output[key][i].dtype)
+                                for i in range(len(feat_model.output[key]))]
+                          for key in feat_model.output}
+            for i, layer in enumerate(standardize_layers):
+                if not layer.configured:
+                    layer.set_weights([data[f'standardize_{i}_{j}'] for j in range(len(layer.weights))])
+        logging.info(f'loaded cached features from {filepath}')
+        return feats_dict
+
+    feats_dict = feat_model(images, training=False)
+    arrays = {f'{key}_{i}': tf.cast(feats, tf.float32).numpy()
+              for key in feats_dict for i, feats in enumerate(feats_dict[key])}
+    for i, layer in enumerate(standardize_layers):
+        arrays.update({f'standardize_{i}_{j}': weight for j, weight in enumerate(layer.get_weights())})
+    # Concurrent runs may write the same entry, so write to a temporary file and move it into place
+    os.makedirs(FLAGS.feat_cache, exist_ok=True)
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, filepath)
+    logging.info(f'cached features to {filepath}')
+    return feats_dict
+
+
 def compute_skewness(x, axes):
     mu, var = tf.nn.moments(x, axes=axes, keepdims=True)
 
@@ -67,9 +155,15 @@ def compute_skewness(x, axes):
     return skew
 
 
-def get_layer_grams(layer_feats):
+def get_layer_grams(layer_feats, chunk_size=None):
     grams = []
     for feats in layer_feats:
+        feats = tf.cast(feats, tf.float32)
+        if chunk_size is not None:
+            shape = tf.shape(feats)
+            moments = compute_chunked_moments(tf.reshape(feats, [shape[0], -1, shape[-1]]), chunk_size, cross=True)
+            grams.append(moments['covar'] + tf.einsum('bc,bd->bcd', moments['mean'], moments['mean']))
+            continue
         num_locs = tf.cast(tf.reduce_prod(feats.shape[:-1]), tf.float32)
         grams.append(tf.einsum('bhwc,bhwd->bcd', feats, feats) / num_locs)
     return grams
@@ -90,6 +184,7 @@ def plot_loss(logs_df, path):
 def log_feat_distribution(feats_dict, title):
     moments = []
     for style_feats in feats_dict['style']:
+        style_feats = tf.cast(style_feats, tf.float32)
         m1 = tf.reduce_mean(style_feats, axis=[1, 2]).numpy()
         m2 = tf.math.reduce_variance(style_feats, axis=[1, 2]).numpy()
         m3 = compute_skewness(style_feats, axes=[1, 2]).numpy()
@@ -102,9 +197,9 @@ def log_feat_distribution(feats_dict, title):
     logging.info('=' * 100)
 
 
-def plot_layer_grams(raw_feats_dict, feats_dict, filepath):
-    raw_grams = get_layer_grams(raw_feats_dict['style'])
-    proj_grams = get_layer_grams(feats_dict['style'])
+def plot_layer_grams(raw_feats_dict, feats_dict, filepath, chunk_size=None):
+    raw_grams = get_layer_grams(raw_feats_dict['style'], chunk_size)
+    proj_grams = get_layer_grams(feats_dict['style'], chunk_size)
     f, ax = plt.subplots(2, len(raw_grams), squeeze=False)
     f.set_size_inches(len(raw_grams) * 4, 5)
     for i, (raw_gram, proj_gram) in enumerate(zip(raw_grams, proj_grams)):
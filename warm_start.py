@@ -0,0 +1,124 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from absl import flags
+from absl import logging
+
+from style_blend import read_style_bytes
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('warm_start_index', None, 'directory of the generated images to warm start from. '
+                                              'every run is added to it, and --start_image=nearest starts from '
+                                              'the nearest generated image of the same style (optional)')
+flags.DEFINE_float('warm_start_min_sim', 0.9, 'minimum cosine similarity of the content descriptors to warm start '
+                                              'from. less similar matches use --warm_start_fallback instead')
+
+
+def get_content_descriptor(content_feats):
+    # Average pooled content features of every content layer, normalized to unit length.
+    # Standardized features average to about zero, so these are the backbone features
+    pooled = [tf.reduce_mean(tf.cast(feats, tf.float32), axis=[1, 2]) for feats in content_feats]
+    descriptor = tf.concat(pooled, axis=-1)[0]
+    return tf.math.l2_normalize(descriptor).numpy()
+
+
+@contextlib.contextmanager
+def _locked(dirpath):
+    # Exclusive lock of the directory, released when its descriptor is closed
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class WarmStartIndex:
+    # Generated images grouped by style image and feature model.
+    # Each group keeps the content descriptors in one matrix, so a lookup is a single matrix-vector product
+    def __init__(self, root):
+        self.root = root
+
+    def get_group_dir(self, style_bytes, feat_model):
+        h = hashlib.sha1(style_bytes)
+        h.update(feat_model.encode())
+        return os.path.join(self.root, h.hexdigest())
+
+    def load_group(self, group_dir):
+        descriptors_path = os.path.join(group_dir, 'descriptors.npy')
+        if not os.path.exists(descriptors_path):
+            return None, []
+        with open(os.path.join(group_dir, 'entries.json')) as f:
+            entries = json.load(f)
+        descriptors = np.load(descriptors_path, mmap_mode='r')
+        # An interrupted add may have written the descriptors but not the entries
+        return descriptors[:len(entries)], entries
+
+    def nearest(self, style_bytes, feat_model, descriptor):
+        # Returns (similarity, entry, image) of the nearest content descriptor or None
+        group_dir = self.get_group_dir(style_bytes, feat_model)
+        descriptors, entries = self.load_group(group_dir)
+        if not entries or descriptors.shape[1] != len(descriptor):
+            return None
+        similarities = descriptors @ descriptor
+        i = int(np.argmax(similarities))
+        image = tf.io.decode_png(tf.io.read_file(os.path.join(group_dir, entries[i]['image'])))
+        return float(similarities[i]), entries[i], image
+
+    def add(self, style_bytes, feat_model, descriptor, gen_image, info):
+        group_dir = self.get_group_dir(style_bytes, feat_model)
+        os.makedirs(group_dir, exist_ok=True)
+        # Concurrent runs of the same style would otherwise drop each other's entries
+        with _locked(group_dir):
+            descriptors, entries = self.load_group(group_dir)
+            if descriptors is not None and descriptors.shape[1] != len(descriptor):
+                logging.warning(f'content descriptor size changed. not adding to {group_dir}')
+                return
+
+            image_name = f'{hashlib.sha1(descriptor.tobytes()).hexdigest()}.png'
+            tf.io.write_file(os.path.join(group_dir, image_name), tf.io.encode_png(tf.cast(gen_image, tf.uint8)))
+            new_descriptors = descriptor[None].astype(np.float32)
+            if descriptors is not None:
+                new_descriptors = np.concatenate([descriptors, new_descriptors])
+            entries = entries + [{'image': image_name, **info}]
+
+            # Write to temporary files and move them into place, so readers never see a partial file
+            for filename, save_fn in [('descriptors.npy', lambda f: np.save(f, new_descriptors)),
+                                      ('entries.json', lambda f: f.write(json.dumps(entries).encode()))]:
+                filepath = os.path.join(group_dir, filename)
+                with open(f'{filepath}.tmp', 'wb') as f:
+                    save_fn(f)
+                os.replace(f'{filepath}.tmp', filepath)
+            logging.info(f'added the generated image to the warm start index ({len(entries)} entries in {group_dir})')
+
+
+def find_warm_start(descriptor, gen_image_shape):
+    # Returns the nearest generated image of the same style, resized to the generated image, or None
+    if FLAGS.warm_start_index is None:
+        return None
+    style_bytes = read_style_bytes()
+    match = WarmStartIndex(FLAGS.warm_start_index).nearest(style_bytes, FLAGS.feat_model, descriptor)
+    if match is None:
+        logging.info('no warm start image of the same style')
+        return None
+    similarity, entry, image = match
+    if similarity < FLAGS.warm_start_min_sim:
+        logging.info(f'nearest warm start image is not similar enough ({similarity:.3f})')
+        return None
+    logging.info(f'warm starting from {entry["image"]} (similarity={similarity:.3f})')
+    image = tf.image.resize(tf.cast(image, tf.float32)[None], gen_image_shape[1:3])
+    return tf.clip_by_value(image, 0, 255)
+
+
+def add_to_warm_start_index(descriptor, gen_image, info):
+    if FLAGS.warm_start_index is None:
+        return
+    style_bytes = read_style_bytes()
+    WarmStartIndex(FLAGS.warm_start_index).add(style_bytes, FLAGS.feat_model, descriptor, tf.squeeze(gen_image, 0),
+                                               info)
@@ -0,0 +1,76 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('weight_store', None, 'directory of the converted backbone weights. vgg19 builds its layers from '
+                                          'the memory-mapped weights, which the processes of a host share '
+                                          '(optional)')
+
+# Offsets of the arrays in the data file, so the mapped arrays are aligned for the tensors that alias them
+ALIGN = 64
+
+
+def save_arrays(root, name, arrays):
+    # Concatenates the float32 arrays into {name}.f32 and writes their offsets and shapes to {name}.json
+    os.makedirs(root, exist_ok=True)
+    index, offset = {}, 0
+    data_path = os.path.join(root, f'{name}.f32')
+    with open(f'{data_path}.tmp', 'wb') as f:
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array, np.float32)
+            padding = -offset % ALIGN
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(array.tobytes())
+            index[key] = {'offset': offset, 'shape': list(array.shape)}
+            offset += array.nbytes
+    with open(os.path.join(root, f'{name}.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{data_path}.tmp', data_path)
+    os.replace(os.path.join(root, f'{name}.json.tmp'), os.path.join(root, f'{name}.json'))
+
+
+def load_arrays(root, name):
+    # Returns the stored arrays as tensors that alias the memory map instead of copying it.
+    # The map is copy-on-write because numpy only exports writable arrays through DLPack,
+    # but nothing writes to it, so its pages stay shared with the page cache and the other processes
+    with open(os.path.join(root, f'{name}.json')) as f:
+        index = json.load(f)
+    data = np.memmap(os.path.join(root, f'{name}.f32'), dtype=np.uint8, mode='c')
+    tensors = {}
+    for key, entry in index.items():
+        size = 4 * int(np.prod(entry['shape']))
+        array = data[entry['offset']:entry['offset'] + size].view(np.float32).reshape(entry['shape'])
+        tensors[key] = tf.experimental.dlpack.from_dlpack(array.__dlpack__())
+    return tensors
+
+
+def convert_vgg19(vgg19, root):
+    arrays = {}
+    for layer in vgg19.layers:
+        if isinstance(layer, tf.keras.layers.Conv2D):
+            kernel, bias = layer.get_weights()
+            arrays[f'{layer.name}/kernel'], arrays[f'{layer.name}/bias'] = kernel, bias
+    save_arrays(root, 'vgg19', arrays)
+    return len(arrays)
+
+
+def main(argv):
+    del argv  # Unused.
+
+    vgg19 = tf.keras.applications.VGG19(include_top=False)
+    num_arrays = convert_vgg19(vgg19, FLAGS.weight_store)
+    data_path = os.path.join(FLAGS.weight_store, 'vgg19.f32')
+    logging.info(f'converted {num_arrays} vgg19 weights to {data_path} ({os.path.getsize(data_path) / 2 ** 20:.1f}MB)')
+
+
+if __name__ == '__main__':
+    flags.mark_flag_as_required('weight_store')
+    app.run(main)